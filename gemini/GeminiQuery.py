@@ -9,14 +9,48 @@ import collections
 import json
 import abc
 import re
+import base64
+import hashlib
+import numpy
 
 # gemini imports
 import gemini_utils as util
 from gemini_constants import *
 from gemini_utils import OrderedSet, OrderedDict, itersubclasses
 import compression
+import regions as region_utils
+import shards
+from profiler import QueryProfiler, timed
 from sql_utils import ensure_columns, get_select_cols_and_rest
 
+# the genotype BLOB columns of the variants table
+GENOTYPE_COLUMNS = ['gts', 'gt_types', 'gt_phases', 'gt_depths',
+                    'gt_ref_depths', 'gt_alt_depths', 'gt_quals']
+# the numpy types of the genotype columns' values. genotypes (e.g., A/G)
+# vary in length, so they are kept as objects
+GENOTYPE_DTYPES = {'gts': object, 'gt_types': numpy.int8,
+                   'gt_phases': numpy.bool_, 'gt_depths': numpy.int32,
+                   'gt_ref_depths': numpy.int32,
+                   'gt_alt_depths': numpy.int32, 'gt_quals': numpy.float32}
+# the integer columns of the variants table that every variant has
+NOT_NULL_COLUMNS = frozenset(['variant_id', 'start', 'end'])
+NO_GENOTYPES_ERROR = ("ERROR: %s has no genotypes (was it loaded with "
+                      "--no-genotypes?).")
+# an aggregate function, e.g. count(*)
+AGGREGATE = re.compile(r"\b(count|sum|total|avg|min|max|group_concat)\s*\(",
+                       re.I)
+# SQLite >= 3.15 compares row values, e.g. (chrom, start) > ('chr1', 100),
+# with a single index range
+ROW_VALUES = sqlite3.sqlite_version_info >= (3, 15, 0)
+
+
+class PageError(ValueError):
+    """
+    A query that cannot be paged, or a page token that is malformed or
+    belongs to another query.
+    """
+    pass
+
 
 class RowFormat:
     """A row formatter to output rows in a custom format.  To provide
@@ -204,6 +238,17 @@ class GeminiQuery(object):
         for row in gq:
             print row
 
+    A LIMIT in the query applies before the genotype filter. To get the
+    first 10 rows that pass the filter, stopping as soon as they are
+    found, use ``limit_after_filter``::
+
+        gq.run(query, gt_filter, limit_after_filter=10)
+
+    To count the rows that a query (and genotype filter) would return,
+    without building or formatting them, use ``count()``::
+
+        print gq.count(query, gt_filter)
+
     Lastly, one can use the ``sample_to_idx`` and ``idx_to_sample``
     dictionaries to gain access to sample-level genotype information
     either by sample name or by sample index::
@@ -223,15 +268,83 @@ class GeminiQuery(object):
             # use the smp2idx dict to access sample genotypes
             idx = smp2idx['NA20814']
             print row, gts[idx]
+
+    To see where the time of a query goes, create the GeminiQuery with
+    ``profile=True`` and report its ``profiler`` once the rows are read::
+
+        gq = GeminiQuery("my.db", profile=True)
+        gq.run(query, gt_filter)
+        for row in gq:
+            pass
+        gq.profiler.report()
+
+    To query many regions (e.g., the targets of a gene panel) at once, use
+    ``run_regions()`` with a list of ``regions.Region``. Each row has a
+    ``region`` column naming the regions that the variant overlaps::
+
+        from gemini.regions import Region, read_bed
+        regions = [Region('chr1', 10000, 20000, 'target1'),
+                   Region('chr2', 500, 700, 'target2')]
+        gq.run_regions("select chrom, start, end from variants", regions,
+                       gt_filter="gt_types.NA20814 == HET")
+        for row in gq:
+            print row['region'], row
+
+    To page through the results of a query, use ``run_page()``. Once a
+    page's rows are read, ``next_page_token`` resumes the query after
+    them (and is None after the last page)::
+
+        token = None
+        while True:
+            gq.run_page(query, gt_filter, page_size=100, page_token=token)
+            rows = list(gq)
+            token = gq.next_page_token
+            if token is None:
+                break
+
+    To run many queries of the variants table (e.g., for a QC report)
+    with one scan of the table, decompressing each row's genotypes
+    once, use ``run_many()`` with a list of (query, gt_filter) pairs.
+    It yields each row with the index of its query, in the order of the
+    variants (or, given a file for each query, writes its rows there)::
+
+        queries = [("select chrom, start from variants where type = 'indel'",
+                    None),
+                   ("select chrom, start from variants",
+                    "gt_types.NA20814 == HET")]
+        for idx, row in gq.run_many(queries):
+            print idx, row
+
+    For numeric analysis, ``genotype_matrix()`` yields the genotypes of
+    a query's variants in chunks, as a structured array of the selected
+    columns and a 2D array (variants x samples) for each genotype field::
+
+        for meta, genotypes in gq.genotype_matrix(
+                "select chrom, start from variants where type = 'snp'",
+                fields=('gt_types', 'gt_depths'),
+                samples=['NA20814', 'NA20815']):
+            print meta['start'], genotypes['gt_types'].sum(axis=1)
     """
 
-    def __init__(self, db, include_gt_cols=False, out_format="default"):
+    def __init__(self, db, include_gt_cols=False, out_format="default",
+                 profile=False):
         assert os.path.exists(db), "%s does not exist." % db
 
         self.db = db
+        self.query = None
+        self.query_params = ()
         self.query_executed = False
         self.for_browser = False
         self.include_gt_cols = include_gt_cols
+        self.out_format = out_format
+
+        # a manifest of database shards may be given in place of a database
+        self.shards = None
+        self.shard_dbs = None
+        self.shard_results = None
+        if shards.is_manifest(db):
+            self.shards = shards.read_manifest(db)
+            self.shard_dbs = [shard['db'] for shard in self.shards]
 
         self._connect_to_database()
         # map sample names to indices. e.g. self.sample_to_idx[NA20814] -> 323
@@ -240,6 +353,30 @@ class GeminiQuery(object):
         self.idx_to_sample = util.map_indicies_to_samples(self.c)
         self.formatter = self._set_formatter(out_format.lower())
         self.predicates = [self.formatter.predicate]
+        self.profiler = QueryProfiler() if profile else None
+        self._bind_stages()
+
+    def _bind_stages(self):
+        """
+        Look up the functions that each row goes through. When
+        profiling, each is timed under its stage of the query.
+        """
+        p = self.profiler
+        self._execute = timed(p, "sqlite cursor", self.c.execute)
+        self._fetch_row = timed(p, "sqlite cursor", self.c.next)
+        self._unpack = dict((col, timed(p, "decompress " + col,
+                                        compression.unpack_genotype_blob))
+                            for col in GENOTYPE_COLUMNS)
+        # without copying the unpickled arrays
+        self._unpack_raw = dict((col, timed(p, "decompress " + col,
+                                            compression.zloads))
+                                for col in GENOTYPE_COLUMNS)
+        self._find_variant_samples = timed(p, "variant samples",
+                                           self._get_variant_samples)
+        self._eval_gt_filter = timed(p, "gt_filter", self._eval_genotypes)
+        self._build_fields = timed(p, "build rows", self._get_fields)
+        self._check_predicates = timed(p, "predicates",
+                                       self._passes_predicates)
 
 
     def _set_formatter(self, out_format):
@@ -258,18 +395,43 @@ class GeminiQuery(object):
 
     def run(self, query, gt_filter=None, show_variant_samples=False,
             variant_samples_delim=',', predicates=None,
-            needs_genotypes=False):
+            needs_genotypes=False, regions=None, page_size=None,
+            page_token=None, limit_after_filter=None):
         """
         Execute a query against a Gemini database. The user may
         specify:
 
             1. (reqd.) an SQL `query`.
             2. (opt.) a genotype filter.
+            3. (opt.) limit_after_filter, the most rows to return that
+               pass the genotype filter and predicates.
         """
+        # the shards of a sharded database each run the original query.
+        # the predicates are only applied here, so without any, each
+        # shard can stop at the row limit too.
+        shard_run_args = (query, gt_filter, show_variant_samples,
+                          variant_samples_delim, None, needs_genotypes,
+                          regions, None, None,
+                          None if predicates else limit_after_filter)
         self.query = self.formatter.format_query(query)
+        self.region_tagger = None
+        self.hidden_cols = []
+        if regions is not None:
+            self.query = self._add_regions_to_query(self.query, regions)
+            self.region_tagger = region_utils.RegionTagger(regions)
+        self.limit_after_filter = limit_after_filter
+        self.rows_returned = 0
+        self.page_size = page_size
+        self.next_page_token = None
+        self.page_key = None
+        self.query_params = ()
+        if page_size is not None:
+            self.page_hash = self._get_page_hash(query, gt_filter)
+            self.query = self._add_page_to_query(self.query, page_token)
         self.gt_filter = gt_filter
         self.show_variant_samples = show_variant_samples
         self.variant_samples_delim = variant_samples_delim
+        self.needs_genotypes = needs_genotypes
         if predicates:
             self.predicates += predicates
 
@@ -288,9 +450,518 @@ class GeminiQuery(object):
                 self.gt_filter = self._correct_genotype_filter()
                 self.query_type = "filter-genotypes"
 
-        self._apply_query()
+        if self.shard_results is not None:
+            self.shard_results.close()
+            self.shard_results = None
+        if self.shard_dbs is not None and \
+                shards.queries_sharded_tables(self.query):
+            self._run_shards(shard_run_args)
+        else:
+            self._apply_query()
         self.query_executed = True
 
+    def run_regions(self, query, regions, gt_filter=None, **kwargs):
+        """
+        Run a query (a SELECT from the variants table, without an
+        ORDER BY, GROUP BY or LIMIT) against a list of regions.Region
+        at once, rather than once per region. The variants that overlap
+        any of the regions are returned in order of position, each
+        once, with a `region` column naming the regions it overlaps.
+        """
+        self.run(query, gt_filter, regions=regions, **kwargs)
+
+    def _add_regions_to_query(self, query, regions):
+        """
+        Restrict the query to the variants that overlap the regions,
+        in order of position. The chrom, start and end of each variant
+        are needed to name its regions, so they are selected (but not
+        reported) if the query doesn't select them.
+        """
+        if re.search(r"\b(order\s+by|group\s+by|limit)\b", query, re.I):
+            sys.exit("ERROR: a query of regions cannot have its own "
+                     "ORDER BY, GROUP BY or LIMIT.")
+        query = self._select_hidden_cols(query, ["chrom", "start", "end"])
+        clause = region_utils.get_regions_clause(self.c, regions)
+        return _add_to_where_clause(query, clause) + " ORDER BY chrom, start"
+
+    def run_page(self, query, gt_filter=None, page_size=100,
+                 page_token=None, **kwargs):
+        """
+        Run a query of the variants table for one page of its results:
+        the first page_size rows that pass the genotype filter, or those
+        after page_token, the next_page_token of the previous page.
+
+        Rather than skipping the earlier pages' rows (as with OFFSET),
+        the query resumes after the last variant of the previous page,
+        so each page takes about as long as the first. Pages are in
+        variant_id order, or in order of position if the query is
+        ORDER BY chrom, start.
+        """
+        self.run(query, gt_filter, page_size=page_size,
+                 page_token=page_token, **kwargs)
+
+    def _get_page_hash(self, query, gt_filter):
+        """
+        Identify the query that a page token belongs to.
+        """
+        return hashlib.sha1(json.dumps([query, gt_filter])).hexdigest()[:16]
+
+    def _get_page_key(self, row):
+        if self.page_by_position:
+            return [row['chrom'], row['start'], row['variant_id']]
+        return [row['variant_id']]
+
+    def _get_page_token(self, key):
+        return base64.urlsafe_b64encode(
+            json.dumps({'query': self.page_hash, 'key': key}))
+
+    def _add_page_to_query(self, query, page_token):
+        """
+        Order the query by variant_id, or by (chrom, start, variant_id)
+        if it is ordered by position, and resume it after the key of the
+        page token. The key columns are selected (but not reported) if
+        the query doesn't select them. Raises a PageError if the query
+        can't be paged or the page token isn't one of its own.
+        """
+        if self.shard_dbs is not None and \
+                shards.queries_sharded_tables(query):
+            raise PageError("queries of a sharded database cannot be paged.")
+        if not re.search(r"\bfrom\s+variants\b", query, re.I) or \
+                re.search(r"\bjoin\b|\bfrom\s+variants\s*,", query, re.I):
+            raise PageError("only queries of the variants table alone "
+                            "can be paged.")
+        if re.search(r"\b(group\s+by|limit)\b", query, re.I):
+            raise PageError("a paged query cannot have its own "
+                            "GROUP BY or LIMIT.")
+        order_by = shards.get_order_by(query)
+        if order_by not in (None, [("chrom", False), ("start", False)]):
+            raise PageError("a paged query can only be ordered by "
+                            "chrom, start.")
+        self.page_by_position = order_by is not None
+        query = re.sub(r"\border\s+by\b.*$", "", query,
+                       flags=re.I | re.S).rstrip()
+        key_cols = ["chrom", "start", "variant_id"] \
+            if self.page_by_position else ["variant_id"]
+        query = self._select_hidden_cols(query, key_cols)
+
+        if page_token is not None:
+            key = self._read_page_token(page_token, len(key_cols))
+            # the key is bound as parameters of the query, as anyone
+            # can write a page token
+            if not self.page_by_position:
+                after = "variant_id > ?"
+                self.query_params = tuple(key)
+            elif ROW_VALUES:
+                after = "(chrom, start, variant_id) > (?, ?, ?)"
+                self.query_params = tuple(key)
+            else:
+                after = ("(chrom > ? OR (chrom = ? AND (start > ? "
+                         "OR (start = ? AND variant_id > ?))))")
+                self.query_params = (key[0], key[0], key[1], key[1], key[2])
+            query = _add_to_where_clause(query, after)
+        return query + " ORDER BY " + ", ".join(key_cols)
+
+    def _read_page_token(self, page_token, key_len):
+        """
+        Return the key of a page token of this query, checking its types.
+        """
+        try:
+            token = json.loads(base64.urlsafe_b64decode(str(page_token)))
+            query_hash, key = token['query'], token['key']
+        except (TypeError, ValueError, KeyError):
+            raise PageError("invalid page token.")
+        if query_hash != self.page_hash or not isinstance(key, list) or \
+                len(key) != key_len:
+            raise PageError("the page token is for another query.")
+        try:
+            if self.page_by_position:
+                if not isinstance(key[0], basestring):
+                    raise ValueError
+                return [key[0], int(key[1]), int(key[2])]
+            return [int(key[0])]
+        except (TypeError, ValueError):
+            raise PageError("invalid page token.")
+
+    def count(self, query, gt_filter=None, predicates=None,
+              needs_genotypes=False):
+        """
+        Return the number of rows that the query would return. Without
+        a genotype filter, SQLite counts them. With one, only the
+        genotype columns that the filter uses are decompressed, and no
+        rows are built. Predicates need the full rows, so with any, the
+        query is run and its rows counted.
+        """
+        sharded = self.shard_dbs is not None and \
+            shards.queries_sharded_tables(query)
+        if "variants" not in query.split():
+            # as with run(), only queries of variants are genotype filtered
+            gt_filter = None
+        if "from" not in query.lower():
+            sys.exit("Malformed query: expected a FROM keyword.")
+        select_tokens, rest_of_query = get_select_cols_and_rest(query)
+        selects_genotypes = any(token.lower().startswith("gt")
+                                for token in select_tokens)
+        distinct = re.match(r"\s*select\s+distinct\b", query, re.I)
+        # the shards' counts only add up for queries whose rows each
+        # come from one shard
+        combines_rows = distinct or \
+            re.search(r"\b(limit|group\s+by)\b", rest_of_query, re.I) or \
+            AGGREGATE.search(query[:len(query) - len(rest_of_query)])
+        if predicates or needs_genotypes or \
+                (sharded and (gt_filter or combines_rows)) or \
+                (distinct and (gt_filter or selects_genotypes)):
+            self.run(query, gt_filter, predicates=predicates,
+                     needs_genotypes=needs_genotypes)
+            if sharded and distinct:
+                # a row can be found in more than one shard
+                return len(set(str(row) for row in self))
+            return sum(1 for row in self)
+
+        self.query_params = ()
+        if gt_filter is None:
+            # genotype columns (e.g., gts.NA12878) can't be selected by
+            # SQLite, but don't change the number of rows
+            if selects_genotypes:
+                query = "select 1 " + rest_of_query
+            self.query = "select count(*) from (%s)" % query
+            if sharded:
+                shard_dbs = shards.select_shards(self.shards, self.query)
+                return sum(row[0] for row in
+                           shards.query_shards(shard_dbs, self.query))
+            self._execute_query()
+            return self.c.fetchone()[0]
+
+        self.gt_filter = gt_filter
+        gt_filter = compile(self._correct_genotype_filter(), "<gt_filter>",
+                            "eval")
+        used_cols = [col for col in GENOTYPE_COLUMNS
+                     if col in gt_filter.co_names]
+        self.query = "select %s %s" % (", ".join(used_cols) or "1",
+                                       rest_of_query)
+        self._execute_query()
+        profiler = self.profiler
+        num_rows = 0
+        genotypes = {}
+        while True:
+            try:
+                row = self._fetch_row()
+            except StopIteration:
+                break
+            if profiler is not None:
+                profiler.rows_scanned += 1
+            for idx, col in enumerate(used_cols):
+                genotypes[col] = self._unpack[col](row[idx])
+            if self._eval_gt_filter(gt_filter, genotypes):
+                num_rows += 1
+        if profiler is not None:
+            profiler.rows_emitted = num_rows
+        return num_rows
+
+    def run_many(self, queries, outputs=None):
+        """
+        Run several queries of the variants table, given as (query,
+        gt_filter) pairs, in one scan of the table. The columns that any
+        of them select are fetched once, and each row's genotype columns
+        are decompressed once, for all of the queries whose WHERE clause
+        it passes. Returns an iterator of (query index, row) pairs, as
+        the rows are found, or, given an output file for each query,
+        writes each query's rows to its file and returns a list of the
+        number of rows written. No query's rows are held in memory.
+        """
+        if outputs is not None and len(outputs) != len(queries):
+            sys.exit("ERROR: run_many needs an output for each query.")
+        self.c.execute("PRAGMA table_info(variants)")
+        variant_cols = [str(col[1]) for col in self.c.fetchall()
+                        if not col[1].startswith("gt")]
+        # the queries are checked now, rather than once the rows are read
+        plans = [self._plan_query_of_many(query, gt_filter, variant_cols)
+                 for query, gt_filter in queries]
+        rows = self._scan_many(plans)
+        if outputs is None:
+            return rows
+        num_rows = [0] * len(plans)
+        for idx, gemini_row in rows:
+            outputs[idx].write(str(gemini_row) + "\n")
+            num_rows[idx] += 1
+        return num_rows
+
+    def _scan_many(self, plans):
+        """
+        Yield the (query index, row) pairs of the planned queries of
+        run_many(), from one SELECT of all of their columns with a flag
+        for each query's WHERE clause.
+        """
+        select_cols = list(OrderedSet(col for plan in plans
+                                      for col in plan['sql_cols']))
+        gt_cols = [col for col in GENOTYPE_COLUMNS
+                   if any(col in plan['gt_cols'] for plan in plans)]
+        wheres = [plan['where'] for plan in plans]
+        self.query = "select %s from variants" % ", ".join(
+            select_cols + gt_cols +
+            ["(%s) AS gemini_match_%d" % (where or "1", idx)
+             for idx, where in enumerate(wheres)])
+        if all(wheres):
+            self.query += " where " + " or ".join("(%s)" % where
+                                                  for where in wheres)
+        first_match = len(select_cols) + len(gt_cols)
+
+        profiler = self.profiler
+        for cursor in self._execute_on_shards(self.query):
+            fetch_row = timed(profiler, "sqlite cursor", cursor.next)
+            while True:
+                try:
+                    row = fetch_row()
+                except StopIteration:
+                    break
+                if profiler is not None:
+                    profiler.rows_scanned += 1
+                matched = [idx for idx in range(len(plans))
+                           if row[first_match + idx]]
+                genotypes = dict.fromkeys(GENOTYPE_COLUMNS)
+                for col in gt_cols:
+                    if any(col in plans[idx]['gt_cols'] for idx in matched):
+                        genotypes[col] = self._unpack[col](row[col])
+
+                for idx in matched:
+                    plan = plans[idx]
+                    if plan['gt_filter'] is not None and \
+                            not self._eval_gt_filter(plan['gt_filter'],
+                                                     genotypes):
+                        continue
+                    fields = OrderedDict((col, row[col])
+                                         for col in plan['report_cols'])
+                    for name, col in plan['gt_report_cols']:
+                        if '[' in col:
+                            fields[name] = self._eval_genotypes(col,
+                                                                genotypes)
+                        elif col == "gts":
+                            fields[name] = ','.join(genotypes[col])
+                        elif col in GENOTYPE_COLUMNS:
+                            fields[name] = \
+                                ','.join(str(v) for v in genotypes[col])
+                    gemini_row = GeminiRow(fields, genotypes['gts'],
+                                           genotypes['gt_types'],
+                                           genotypes['gt_phases'],
+                                           genotypes['gt_depths'],
+                                           genotypes['gt_ref_depths'],
+                                           genotypes['gt_alt_depths'],
+                                           genotypes['gt_quals'],
+                                           formatter=self.formatter)
+                    if not self._check_predicates(gemini_row):
+                        continue
+                    if profiler is not None:
+                        profiler.rows_emitted += 1
+                    yield idx, gemini_row
+
+    def genotype_matrix(self, query, fields=('gt_types', 'gt_depths'),
+                        samples=None, chunk_variants=10000):
+        """
+        Run a query of the variants table and yield its results in
+        chunks of up to chunk_variants variants, as pairs of:
+
+            1. a numpy structured array of the (non-genotype) columns
+               that the query selects, one record per variant.
+            2. a dict mapping each of the genotype fields to a 2D numpy
+               array of variants x samples (all of the samples, in
+               sample_to_idx order, or else those named, in order).
+
+        Each chunk's rows are fetched at once and their genotype BLOBs
+        are unpacked straight into the arrays, without building rows.
+        The columns' dtypes are the same in every chunk, so the chunks
+        can be concatenated.
+        """
+        for field in fields:
+            if field not in GENOTYPE_DTYPES:
+                sys.exit("ERROR: %s is not a genotype column (%s)."
+                         % (field, ", ".join(GENOTYPE_COLUMNS)))
+        if not self.idx_to_sample:
+            sys.exit(NO_GENOTYPES_ERROR % self.db)
+        if samples is None:
+            # each row is copied whole
+            sample_idxs = None
+            num_samples = len(self.idx_to_sample)
+        else:
+            unknown = [s for s in samples if s not in self.sample_to_idx]
+            if unknown:
+                sys.exit("ERROR: unknown samples: %s." % ", ".join(unknown))
+            sample_idxs = numpy.array([self.sample_to_idx[s]
+                                       for s in samples], dtype=numpy.intp)
+            num_samples = len(sample_idxs)
+
+        if "from" not in query.lower():
+            sys.exit("Malformed query: expected a FROM keyword.")
+        select_tokens, rest_of_query = get_select_cols_and_rest(query)
+        # the genotypes come from the fields, not the selected columns
+        meta_cols = [token for token in select_tokens
+                     if not token.startswith("gt") and
+                     not token.startswith("GT")] or ["variant_id"]
+        self.query = "select %s, %s %s" % (", ".join(meta_cols),
+                                          ", ".join(fields), rest_of_query)
+
+        # each column's dtype comes from the schema rather than from
+        # each chunk's values, so that every chunk (and shard) agrees
+        self.c.execute("PRAGMA table_info(variants)")
+        col_types = dict((str(col[1]), (col[2].lower(), col[5]))
+                         for col in self.c.fetchall())
+
+        profiler = self.profiler
+        for cursor in self._execute_on_shards(self.query):
+            names = [str(col[0]) for col in cursor.description]
+            # the fields come last, after the (possibly expanded) columns
+            num_meta = len(names) - len(fields)
+            meta_names = [name for name in names[:num_meta]
+                          if not name.startswith("gt")]
+            meta_dtype = [(name, _get_meta_dtype(name,
+                                                 *col_types.get(name,
+                                                                ("", 0))))
+                          for name in meta_names]
+            meta_idxs = [idx for idx, name in enumerate(names[:num_meta])
+                         if not name.startswith("gt")]
+            fetch_rows = timed(profiler, "sqlite cursor", cursor.fetchmany)
+            while True:
+                rows = fetch_rows(chunk_variants)
+                if not rows:
+                    break
+                if profiler is not None:
+                    profiler.rows_scanned += len(rows)
+                    profiler.rows_emitted += len(rows)
+                meta = numpy.rec.fromrecords(
+                    [tuple(row[idx] for idx in meta_idxs) for row in rows],
+                    dtype=meta_dtype)
+                matrices = {}
+                for field_idx, field in enumerate(fields, num_meta):
+                    matrix = numpy.empty((len(rows), num_samples),
+                                         dtype=GENOTYPE_DTYPES[field])
+                    unpack = self._unpack_raw[field]
+                    for row_idx, row in enumerate(rows):
+                        blob = row[field_idx]
+                        values = None if blob is None else unpack(blob)
+                        if values is None:
+                            sys.exit(NO_GENOTYPES_ERROR % self.db)
+                        if sample_idxs is None:
+                            matrix[row_idx] = values
+                        elif getattr(values, 'dtype', None) == matrix.dtype:
+                            numpy.take(values, sample_idxs,
+                                       out=matrix[row_idx])
+                        else:
+                            # e.g., the genotype strings, which are kept
+                            # as objects
+                            matrix[row_idx] = numpy.take(values, sample_idxs)
+                    matrices[field] = matrix
+                yield meta, matrices
+
+    def _execute_on_shards(self, query):
+        """
+        Execute the query against the database and yield its cursor or,
+        for a sharded database, against each of the shards in turn.
+        """
+        for shard_idx, db in enumerate(self.shard_dbs or [self.db]):
+            if shard_idx == 0:
+                cursor = self.c
+            else:
+                conn = sqlite3.connect(db)
+                conn.row_factory = sqlite3.Row
+                cursor = conn.cursor()
+            try:
+                try:
+                    timed(self.profiler, "sqlite cursor",
+                          cursor.execute)(query)
+                except sqlite3.OperationalError as e:
+                    print "SQLite error: {0}".format(e)
+                    sys.exit("The query issued (%s) has a syntax error."
+                             % query)
+                yield cursor
+            finally:
+                # the caller is done with this shard's rows
+                if shard_idx > 0:
+                    conn.close()
+
+    def _plan_query_of_many(self, query, gt_filter, variant_cols):
+        """
+        Split a query of run_many() into the columns that it selects
+        (and reports), the genotype columns that it needs, its WHERE
+        clause and its compiled genotype filter.
+        """
+        query = self.formatter.format_query(query)
+        if "from" not in query.lower():
+            sys.exit("Malformed query: expected a FROM keyword.")
+        select_tokens, rest_of_query = get_select_cols_and_rest(query)
+        match = re.match(r"from\s+variants\b\s*(?:where\b(.*))?$",
+                         rest_of_query.strip(), re.I | re.S)
+        if match is None or \
+                re.match(r"\s*select\s+distinct\b", query, re.I) or \
+                re.search(r"\b(group\s+by|order\s+by|limit|having)\b",
+                          rest_of_query, re.I):
+            sys.exit("ERROR: run_many can only run queries of the variants "
+                     "table alone, without DISTINCT, GROUP BY, ORDER BY "
+                     "or LIMIT: %s" % query)
+
+        plan = {'sql_cols': [], 'report_cols': [], 'gt_report_cols': [],
+                'gt_cols': set(), 'where': match.group(1),
+                'gt_filter': None}
+        for token in select_tokens:
+            if token.startswith("gt") or token.startswith("GT"):
+                col = self._correct_genotype_col(token)
+                plan['gt_report_cols'].append((token, col))
+                plan['gt_cols'].add(col.split('[')[0])
+            elif token == "*":
+                plan['sql_cols'] += variant_cols
+                plan['report_cols'] += variant_cols
+            elif re.match(r"^\w+$", token):
+                plan['sql_cols'].append(token)
+                plan['report_cols'].append(token)
+            else:
+                sys.exit("ERROR: run_many can only select columns of the "
+                         "variants table, not %s." % token)
+        if gt_filter is not None:
+            self.gt_filter = gt_filter
+            plan['gt_filter'] = compile(self._correct_genotype_filter(),
+                                        "<gt_filter>", "eval")
+            plan['gt_cols'].update(col for col in GENOTYPE_COLUMNS
+                                   if col in plan['gt_filter'].co_names)
+        return plan
+
+    def _select_hidden_cols(self, query, cols):
+        """
+        Add any of cols that the query doesn't select to its SELECT
+        clause, and to the hidden columns, which are not reported.
+        """
+        from_match = re.search(r"\bfrom\b", query, re.I)
+        if from_match is None:
+            sys.exit("Malformed query: expected a FROM keyword.")
+        select_tokens, rest_of_query = get_select_cols_and_rest(query)
+        selected = [token.split('.')[-1].lower() for token in select_tokens]
+        if "*" in selected:
+            return query
+        hidden = [col for col in cols if col not in selected]
+        if not hidden:
+            return query
+        self.hidden_cols += hidden
+        return "%s, %s %s" % (query[:from_match.start()].rstrip(),
+                              ", ".join(hidden), query[from_match.start():])
+
+    def _run_shards(self, run_args):
+        """
+        Run the query against each shard of a sharded database,
+        each in its own process. Chromosome shards that cannot hold
+        any of the results are skipped.
+        """
+        task = {'include_gt_cols': self.include_gt_cols,
+                'out_format': self.out_format,
+                'run_args': run_args}
+        try:
+            limit = shards.get_limit(self.query)
+        except shards.ShardQueryError as e:
+            sys.exit("ERROR: " + str(e))
+        shard_dbs = shards.select_shards(self.shards, self.query)
+        # rows can only be merged on the columns that are reported;
+        # otherwise, each shard's rows are reported in turn
+        order_by = None if self.hidden_cols \
+            else shards.get_order_by(self.query)
+        self.shard_results = \
+            shards.ShardedResults(shard_dbs, task, order_by=order_by,
+                                  limit=limit)
+
 
     def __iter__(self):
         return self
@@ -304,6 +975,9 @@ class GeminiQuery(object):
         if self.formatter.name in ["json"]:
             return None
 
+        if self.shard_results is not None:
+            return self.shard_results.header
+
         if self.query_type == "no-genotypes":
             h = [col for col in self.all_query_cols]
         else:
@@ -312,6 +986,8 @@ class GeminiQuery(object):
                  - OrderedSet(self.select_columns)]
         if self.show_variant_samples:
             h += ["variant_samples", "HET_samples", "HOM_ALT_samples"]
+        if self.region_tagger is not None:
+            h += ["region"]
         return GeminiRow(OrderedDict(itertools.izip(h, h)),
                          formatter=self.formatter)
 
@@ -347,88 +1023,55 @@ class GeminiQuery(object):
         """
         Return the GeminiRow object for the next query result.
         """
+        if self._has_all_rows():
+            raise StopIteration
+        if self.shard_results is not None:
+            return self._next_shard_row()
+        row, result = self._next_row()
+        if self.profiler is not None:
+            self.profiler.rows_emitted += 1
+        self.rows_returned += 1
+        if self.rows_returned == self.page_size:
+            # the next page starts after this row, if there are more
+            self.page_key = self._get_page_key(row)
+        return result
+
+    def _next_row(self):
+        """
+        Return the next database row that passes the genotype filter
+        and predicates, along with the GeminiRow (or, for the browser,
+        the fields) to report for it.
+        """
         # we use a while loop since we may skip records based upon
         # genotype filters.  if we need to skip a record, we just
         # throw a continue and keep trying. the alternative is to just
         # recursively call self.next() if we need to skip, but this
         # can quickly exceed the stack.
+        profiler = self.profiler
         while (1):
             try:
-                row = self.c.next()
+                row = self._fetch_row()
             except Exception as e:
                 raise StopIteration
-            gts = None
-            gt_types = None
-            gt_phases = None
-            gt_depths = None
-            gt_ref_depths = None
-            gt_alt_depths = None
-            gt_quals = None
+            if profiler is not None:
+                profiler.rows_scanned += 1
+            genotypes = dict.fromkeys(GENOTYPE_COLUMNS)
             variant_names = []
             het_names = []
             hom_alt_names = []
 
-            if self._query_needs_genotype_info():
-                gts = compression.unpack_genotype_blob(row['gts'])
-                gt_types = \
-                    compression.unpack_genotype_blob(row['gt_types'])
-                gt_phases = \
-                    compression.unpack_genotype_blob(row['gt_phases'])
-                gt_depths = \
-                    compression.unpack_genotype_blob(row['gt_depths'])
-                gt_ref_depths = \
-                    compression.unpack_genotype_blob(row['gt_ref_depths'])
-                gt_alt_depths = \
-                    compression.unpack_genotype_blob(row['gt_alt_depths'])
-                gt_quals = \
-                    compression.unpack_genotype_blob(row['gt_quals'])
-                variant_samples = [x for x, y in enumerate(gt_types) if y == HET or
-                                   y == HOM_ALT]
-                variant_names = [self.idx_to_sample[x] for x in variant_samples]
-                het_samples = [x for x, y in enumerate(gt_types) if y == HET]
-                het_names = [self.idx_to_sample[x] for x in het_samples]
-                hom_alt_samples = [x for x, y in enumerate(gt_types) if y == HOM_ALT]
-                hom_alt_names = [self.idx_to_sample[x] for x in hom_alt_samples]
+            if self.needs_genotype_info:
+                for col in GENOTYPE_COLUMNS:
+                    genotypes[col] = self._unpack[col](row[col])
+                (variant_names, het_names, hom_alt_names) = \
+                    self._find_variant_samples(genotypes['gt_types'])
 
                 # skip the record if it does not meet the user's genotype filter
-                if self.gt_filter and not eval(self.gt_filter):
+                if self.gt_filter and \
+                        not self._eval_gt_filter(self.gt_filter, genotypes):
                     continue
 
-            fields = OrderedDict()
-
-            for idx, col in enumerate(self.report_cols):
-                if col == "*":
-                    continue
-                if not col.startswith("gt") and not col.startswith("GT"):
-                    fields[col] = row[col]
-                else:
-                    # reuse the original column anme user requested
-                    # e.g. replace gts[1085] with gts.NA20814
-                    if '[' in col:
-                        orig_col = self.gt_idx_to_name_map[col]
-                        fields[orig_col] = eval(col.strip())
-                    else:
-                        # asked for "gts" or "gt_types", e.g.
-                        if col == "gts":
-                            fields[col] = ','.join(gts)
-                        elif col == "gt_types":
-                            fields[col] = \
-                                ','.join(str(t) for t in gt_types)
-                        elif col == "gt_phases":
-                            fields[col] = \
-                                ','.join(str(p) for p in gt_phases)
-                        elif col == "gt_depths":
-                            fields[col] = \
-                                ','.join(str(d) for d in gt_depths)
-                        elif col == "gt_quals":
-                            fields[col] = \
-                                ','.join(str(d) for d in gt_quals)
-                        elif col == "gt_ref_depths":
-                            fields[col] = \
-                                ','.join(str(d) for d in gt_ref_depths)
-                        elif col == "gt_alt_depths":
-                            fields[col] = \
-                                ','.join(str(d) for d in gt_alt_depths)
+            fields = self._build_fields(row, genotypes)
 
             if self.show_variant_samples:
                 fields["variant_samples"] = \
@@ -437,27 +1080,142 @@ class GeminiQuery(object):
                     self.variant_samples_delim.join(het_names)
                 fields["HOM_ALT_samples"] = \
                     self.variant_samples_delim.join(hom_alt_names)
-
-            gemini_row = GeminiRow(fields, gts, gt_types, gt_phases,
-                                   gt_depths, gt_ref_depths, gt_alt_depths,
-                                   gt_quals, variant_names, het_names, hom_alt_names,
+            if self.region_tagger is not None:
+                fields["region"] = self.region_tagger.names(
+                    row['chrom'], row['start'], row['end'])
+
+            gemini_row = GeminiRow(fields, genotypes['gts'],
+                                   genotypes['gt_types'],
+                                   genotypes['gt_phases'],
+                                   genotypes['gt_depths'],
+                                   genotypes['gt_ref_depths'],
+                                   genotypes['gt_alt_depths'],
+                                   genotypes['gt_quals'],
+                                   variant_names, het_names, hom_alt_names,
                                    formatter=self.formatter)
 
-            if not all([predicate(gemini_row) for predicate in self.predicates]):
+            if not self._check_predicates(gemini_row):
                 continue
 
+            if not self.for_browser:
+                return row, gemini_row
+            else:
+                return row, fields
+
+    def _get_variant_samples(self, gt_types):
+        """
+        Return the names of the samples that have the variant, those
+        that are heterozygous and those that are homozygous for it.
+        """
+        variant_samples = [x for x, y in enumerate(gt_types) if y == HET or
+                           y == HOM_ALT]
+        variant_names = [self.idx_to_sample[x] for x in variant_samples]
+        het_samples = [x for x, y in enumerate(gt_types) if y == HET]
+        het_names = [self.idx_to_sample[x] for x in het_samples]
+        hom_alt_samples = [x for x, y in enumerate(gt_types) if y == HOM_ALT]
+        hom_alt_names = [self.idx_to_sample[x] for x in hom_alt_samples]
+        return (variant_names, het_names, hom_alt_names)
+
+    def _eval_genotypes(self, expression, genotypes):
+        """
+        Evaluate a genotype filter or column (e.g. "gt_types[11] == HET")
+        against the genotype arrays of a row.
+        """
+        return eval(expression, globals(), genotypes)
+
+    def _get_fields(self, row, genotypes):
+        """
+        Return the columns to report for a row, in order.
+        """
+        fields = OrderedDict()
+
+        for idx, col in enumerate(self.report_cols):
+            if col == "*":
+                continue
+            if not col.startswith("gt") and not col.startswith("GT"):
+                fields[col] = row[col]
+            else:
+                # reuse the original column anme user requested
+                # e.g. replace gts[1085] with gts.NA20814
+                if '[' in col:
+                    orig_col = self.gt_idx_to_name_map[col]
+                    fields[orig_col] = \
+                        self._eval_genotypes(col.strip(), genotypes)
+                else:
+                    # asked for "gts" or "gt_types", e.g.
+                    if col == "gts":
+                        fields[col] = ','.join(genotypes[col])
+                    elif col in GENOTYPE_COLUMNS:
+                        fields[col] = \
+                            ','.join(str(v) for v in genotypes[col])
+        return fields
+
+    def _passes_predicates(self, gemini_row):
+        return all([predicate(gemini_row) for predicate in self.predicates])
+
+    def _has_all_rows(self):
+        """
+        Have we returned the limit_after_filter rows, or a full page?
+        If so, we stop without fetching (or decompressing) any more.
+        """
+        if self.page_key is not None:
+            self._set_next_page_token()
+        for limit in (self.limit_after_filter, self.page_size):
+            if limit is not None and self.rows_returned >= limit:
+                if self.shard_results is not None:
+                    self.shard_results.close()
+                return True
+        return False
+
+    def _set_next_page_token(self):
+        """
+        The page is full: it has a next page only if one more row
+        passes the genotype filter and predicates. Otherwise the page
+        ended at the last row, and next_page_token stays None.
+        """
+        key, self.page_key = self.page_key, None
+        try:
+            self._next_row()
+        except StopIteration:
+            return
+        self.next_page_token = self._get_page_token(key)
+
+    def _next_shard_row(self):
+        """
+        Return the next row from a sharded database that passes the
+        predicates. The genotype filter has already been applied
+        by the shard processes.
+        """
+        while (1):
+            try:
+                gemini_row = self.shard_results.next()
+            except shards.ShardQueryError as e:
+                sys.exit("ERROR: " + str(e))
+            if self.profiler is not None:
+                self.profiler.rows_scanned += 1
+
+            if not self._check_predicates(gemini_row):
+                continue
+
+            if self.profiler is not None:
+                self.profiler.rows_emitted += 1
+            self.rows_returned += 1
+
             if not self.for_browser:
                 return gemini_row
             else:
-                return fields
+                return gemini_row.row
 
     def _connect_to_database(self):
         """
         Establish a connection to the requested Gemini database.
+        For a sharded database, we connect to the first shard, which
+        holds the samples and other tables common to all of the shards.
         """
+        db = self.db if self.shard_dbs is None else self.shard_dbs[0]
         # open up a new database
-        if os.path.exists(self.db):
-            self.conn = sqlite3.connect(self.db)
+        if os.path.exists(db):
+            self.conn = sqlite3.connect(db)
             self.conn.isolation_level = None
             # allow us to refer to columns by name
             self.conn.row_factory = sqlite3.Row
@@ -465,7 +1223,7 @@ class GeminiQuery(object):
 
     def _execute_query(self):
         try:
-            self.c.execute(self.query)
+            self._execute(self.query, self.query_params)
         except sqlite3.OperationalError as e:
             print "SQLite error: {0}".format(e)
             sys.exit("The query issued (%s) has a syntax error." % self.query)
@@ -475,8 +1233,9 @@ class GeminiQuery(object):
         Execute a query. Intercept gt* columns and
         replace sample names with indices where necessary.
         """
-
-        if self._query_needs_genotype_info():
+        # decided once, rather than by tokenizing the query for each row
+        self.needs_genotype_info = self._query_needs_genotype_info()
+        if self.needs_genotype_info:
             # break up the select statement into individual
             # pieces and replace genotype columns using sample
             # names with sample indices
@@ -506,6 +1265,13 @@ class GeminiQuery(object):
                                    if not tuple[0].startswith("gt")]
             self.report_cols = self.all_query_cols
 
+        if self.hidden_cols:
+            # the hidden columns come last among the non-genotype columns
+            num_shown = len(self.all_query_cols) - len(self.hidden_cols)
+            self.report_cols = self.all_query_cols[:num_shown] + \
+                self.report_cols[len(self.all_query_cols):]
+            self.all_query_cols = self.all_query_cols[:num_shown]
+
     def _correct_genotype_col(self, raw_col):
         """
         Convert a _named_ genotype index to a _numerical_
@@ -640,11 +1406,43 @@ class GeminiQuery(object):
 
     def _query_needs_genotype_info(self):
         tokens = self._tokenize_query()
-        requested_genotype = "variants" in tokens and any([x.startswith("gt") for x in tokens])
+        queries_variants = "variants" in tokens
+        requested_genotype = queries_variants and any([x.startswith("gt") for x in tokens])
+        # genotype filters and sample predicates need the genotypes too
+        filters_genotypes = queries_variants and \
+            (self.gt_filter is not None or self.needs_genotypes)
         return requested_genotype or \
+               filters_genotypes or \
                self.include_gt_cols or \
                self.show_variant_samples
 
+def _get_meta_dtype(col, col_type, primary_key):
+    """
+    Return the numpy dtype of a column of a genotype_matrix() chunk,
+    given its declared type in the variants table. REAL (and decimal)
+    columns are floats, with NULL as nan. Any other column (including
+    the expressions that aren't in the table) may hold NULLs and is
+    kept as an object, but for the integer primary key and positions.
+    """
+    if any(name in col_type for name in ("real", "floa", "doub", "dec")):
+        return numpy.float64
+    if "int" in col_type and (primary_key or col in NOT_NULL_COLUMNS):
+        return numpy.int64
+    return object
+
+
+def _add_to_where_clause(query, condition):
+    """
+    AND a condition to the WHERE clause of a query that has no
+    GROUP BY, ORDER BY or LIMIT.
+    """
+    where_match = re.search(r"\bwhere\b", query, re.I)
+    if where_match is None:
+        return query + " WHERE " + condition
+    return "%s WHERE %s AND (%s)" % (query[:where_match.start()], condition,
+                                     query[where_match.end():])
+
+
 def flatten(l):
     """
     flatten an irregular list of lists
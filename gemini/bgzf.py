@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+    Split a VCF into byte ranges and read the lines of each range
+    independently, so that chunks of the VCF can be loaded in parallel
+    without grabix.
+
+    Uncompressed files are split at arbitrary byte offsets.  BGZF files
+    (i.e., written by bgzip) are split at block boundaries, and each
+    block is inflated on its own with zlib.  Either way, each line
+    belongs to exactly one range: the range holding the newline that
+    precedes it (the first line of the file belongs to the first range).
+"""
+
+import bisect
+import gzip
+import os
+import struct
+import zlib
+
+# the gzip magic number, DEFLATE method and FEXTRA flag of a BGZF block
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+# the fixed-length portion of a block's gzip header, through XLEN
+BGZF_HEADER_SIZE = 12
+# the CRC32 and ISIZE fields that end each block
+BGZF_FOOTER_SIZE = 8
+# uncompressed files are read in pieces of this many bytes
+PLAIN_PIECE_SIZE = 1024 * 1024
+
+
+def is_gz_file(fname):
+    return fname.endswith(".gz")
+
+
+def is_bgzf(fname):
+    """
+    Is fname a BGZF file, rather than a plain gzip file?
+    """
+    with open(fname, 'rb') as handle:
+        header = handle.read(BGZF_HEADER_SIZE)
+        if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC:
+            return False
+        xlen = struct.unpack('<H', header[10:12])[0]
+        return _get_block_size(handle.read(xlen)) is not None
+
+
+def _get_block_size(extra):
+    """
+    Return the total size of a block from the BC subfield
+    of its gzip header's extra field.
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        subfield_len = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == "BC" and subfield_len == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + subfield_len
+    return None
+
+
+def _read_block(handle):
+    """
+    Read the BGZF block at the current position of handle.
+    Return the block's total size and its compressed payload,
+    or (0, None) at the end of the file.
+    """
+    header = handle.read(BGZF_HEADER_SIZE)
+    if not header:
+        return 0, None
+    if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC:
+        raise IOError("%s is not a valid BGZF file." % handle.name)
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = handle.read(xlen)
+    block_size = _get_block_size(extra)
+    if block_size is None:
+        raise IOError("%s is not a valid BGZF file." % handle.name)
+    payload = handle.read(block_size - BGZF_HEADER_SIZE - xlen)
+    return block_size, payload[:-BGZF_FOOTER_SIZE]
+
+
+def get_block_offsets(fname):
+    """
+    Return the file offset of each block in a BGZF file, reading
+    only the block headers.
+    """
+    offsets = []
+    offset = 0
+    with open(fname, 'rb') as handle:
+        while True:
+            header = handle.read(BGZF_HEADER_SIZE)
+            if not header:
+                break
+            if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC:
+                raise IOError("%s is not a valid BGZF file." % fname)
+            xlen = struct.unpack('<H', header[10:12])[0]
+            block_size = _get_block_size(handle.read(xlen))
+            if block_size is None:
+                raise IOError("%s is not a valid BGZF file." % fname)
+            offsets.append(offset)
+            offset += block_size
+            handle.seek(offset)
+    return offsets
+
+
+def split_file(fname, num_chunks):
+    """
+    Split fname into (at most) num_chunks byte ranges of
+    roughly equal size. Returns a list of (start, end) tuples.
+    """
+    file_size = os.path.getsize(fname)
+    targets = [(i * file_size) / num_chunks for i in range(1, num_chunks)]
+    if is_gz_file(fname):
+        # BGZF files can only be split at block boundaries.
+        offsets = get_block_offsets(fname)
+        starts = [offsets[min(bisect.bisect_left(offsets, target),
+                              len(offsets) - 1)]
+                  for target in targets]
+    else:
+        starts = targets
+    starts = sorted(set([0] + [s for s in starts if 0 < s < file_size]))
+    return zip(starts, starts[1:] + [file_size])
+
+
+def _iter_pieces(fname, start, end):
+    """
+    Yield (offset, data) for the (uncompressed) data of fname, from
+    start onward.  For BGZF files, offset is that of the block the
+    data came from.  No piece spans the end of the range.
+    """
+    with open(fname, 'rb') as handle:
+        handle.seek(start)
+        offset = start
+        if is_gz_file(fname):
+            while True:
+                block_size, payload = _read_block(handle)
+                if payload is None:
+                    break
+                yield offset, zlib.decompress(payload, -15)
+                offset += block_size
+        else:
+            while True:
+                if offset < end:
+                    size = min(PLAIN_PIECE_SIZE, end - offset)
+                else:
+                    size = PLAIN_PIECE_SIZE
+                data = handle.read(size)
+                if not data:
+                    break
+                yield offset, data
+                offset += len(data)
+
+
+def iter_lines(fname, start, end):
+    """
+    Yield each line of fname that belongs to the (start, end) range.
+    The last line may be finished by reading beyond end.
+    """
+    # the line in progress, or None until we pass the first newline.
+    line = '' if start == 0 else None
+    for offset, data in _iter_pieces(fname, start, end):
+        if offset >= end:
+            # all that is left is to finish the line we are on, if any.
+            if line is None:
+                return
+            newline = data.find('\n')
+            if newline < 0:
+                line += data
+                continue
+            yield line + data[:newline + 1]
+            return
+        if line is None:
+            newline = data.find('\n')
+            if newline < 0:
+                continue
+            line = ''
+            data = data[newline + 1:]
+        lines = data.split('\n')
+        if len(lines) > 1:
+            yield line + lines[0] + '\n'
+            for complete in lines[1:-1]:
+                yield complete + '\n'
+            line = lines[-1]
+        else:
+            line += lines[0]
+    if line:
+        yield line
+
+
+def read_header(fname):
+    """
+    Return the header lines (i.e., those starting with '#') of a VCF.
+    """
+    if is_gz_file(fname):
+        handle = gzip.open(fname, 'rb')
+    else:
+        handle = open(fname)
+    header = []
+    for line in handle:
+        if not line.startswith('#'):
+            break
+        header.append(line)
+    handle.close()
+    return header
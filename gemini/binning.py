@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+    UCSC-style genomic bins (Kent et al., Genome Res. 2002), which let an
+    ordinary index find the variants that overlap a region.
+
+    Each variant is stored with the smallest bin that holds all of it,
+    in a hierarchy of 128Kb, 1Mb, 8Mb, 64Mb and 512Mb bins. The variants
+    that overlap a region can only be in the handful of bins at each
+    level that overlap the region, so a region query looks up those bins
+    with the (chrom, bin) index instead of scanning for long variants
+    (e.g., structural variants) that start well before the region.
+"""
+
+# the first bin of each level, from the smallest (128Kb) bins up to
+# the single 512Mb bin
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+# the smallest bins are 2^17 bp, and each level's bins are 2^3 times
+# larger than the last
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+
+def bin_from_range(start, end):
+    """
+    Return the smallest bin that holds the (0-based, half-open)
+    interval [start, end).
+    """
+    end = max(end, start + 1)
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    # an interval that crosses 512Mb (on a very long contig) goes in
+    # the first, largest bin
+    return 0
+
+
+def overlapping_bins(start, end):
+    """
+    Return the bins that may hold an interval overlapping the
+    (0-based, half-open) interval [start, end).
+    """
+    end = max(end, start + 1)
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    if bins[-1] != 0:
+        bins.append(0)
+    return bins
@@ -2,50 +2,186 @@
 
 import sqlite3
 import sys
+import json
+import time
 from itertools import repeat
 
 from ped import get_ped_fields, default_ped_fields
+import binning
+
+
+# the indices of the gemini tables: name -> (table and columns, unique?)
+INDICES = {
+    'var_chr_start_idx': ('variants(chrom, start)', False),
+    'var_type_idx': ('variants(type)', False),
+    'var_gt_counts_idx': ('variants(num_hom_ref, num_het, '
+                          'num_hom_alt, num_unknown)', False),
+    'var_aaf_idx': ('variants(aaf)', False),
+    'var_in_dbsnp_idx': ('variants(in_dbsnp)', False),
+    'var_in_call_rate_idx': ('variants(call_rate)', False),
+    'var_exonic_idx': ('variants(is_exonic)', False),
+    'var_coding_idx': ('variants(is_coding)', False),
+    'var_lof_idx': ('variants(is_lof)', False),
+    'var_depth_idx': ('variants(depth)', False),
+    'var_gene_idx': ('variants(gene)', False),
+    'varimp_exonic_idx': ('variant_impacts(is_exonic)', False),
+    'varimp_coding_idx': ('variant_impacts(is_coding)', False),
+    'varimp_lof_idx': ('variant_impacts(is_lof)', False),
+    'varimp_impact_idx': ('variant_impacts(impact)', False),
+    'sample_name_idx': ('samples(name)', True),
+    # covers region lookups, see variant_bins
+    'varbin_chr_bin_idx': ('variant_bins(chrom, bin, start, end)', False),
+    # covers gene lookups, see gene_variants
+    'genevar_gene_idx': ('gene_variants(gene, variant_id)', False),
+}
+
+# the indices built by each choice of --indexes, in the order they are
+# built. minimal covers region and gene lookups and finding samples by name.
+# default also covers the LoF tools, which look up the (few) LoF impacts.
+INDEX_LEVELS = {
+    'minimal': ['var_chr_start_idx', 'varbin_chr_bin_idx', 'var_gene_idx',
+                'genevar_gene_idx', 'sample_name_idx'],
+    'default': ['var_chr_start_idx', 'varbin_chr_bin_idx', 'var_gene_idx',
+                'genevar_gene_idx', 'sample_name_idx', 'var_type_idx',
+                'var_gt_counts_idx', 'var_aaf_idx', 'var_in_dbsnp_idx',
+                'var_in_call_rate_idx', 'var_exonic_idx', 'var_coding_idx',
+                'var_lof_idx', 'var_depth_idx', 'varimp_lof_idx'],
+}
+INDEX_LEVELS['all'] = INDEX_LEVELS['default'] + \
+    ['varimp_exonic_idx', 'varimp_coding_idx', 'varimp_impact_idx']
+
+# the number of columns in the variants and variant_impacts tables
+NUM_VARIANT_COLUMNS = 108
+NUM_VARIANT_IMPACT_COLUMNS = 18
+INSERT_VARIANT = "insert into variants values (%s)" % \
+    ",".join("?" * NUM_VARIANT_COLUMNS)
+INSERT_VARIANT_IMPACT = "insert into variant_impacts values (%s)" % \
+    ",".join("?" * NUM_VARIANT_IMPACT_COLUMNS)
+
+# the bulk-load profile. the page size of a database is fixed when its first
+# table is created; larger pages hold the genotype BLOBs of more samples
+# before spilling into overflow pages.
+LOAD_PAGE_SIZE = 16384
+# the page cache (KB) and memory map (bytes) of a loading connection
+LOAD_CACHE_KB = 64 * 1024
+LOAD_MMAP_BYTES = 1024 * 1024 * 1024
+
+# the page cache (KB) that SQLite may use to sort each index
+INDEX_CACHE_KB = 512 * 1024
+# the rows of each index that ANALYZE samples (with SQLite >= 3.32)
+ANALYSIS_LIMIT = 1000
+
+
+def set_load_pragmas(cursor, new_db=False):
+    """
+    Tune a connection for bulk loading: no syncing, a large page cache,
+    temporary tables in memory and a memory map for reads. new_db sets
+    the page size of a database that has no tables yet.
+    """
+    if new_db:
+        cursor.execute("PRAGMA page_size = %d" % LOAD_PAGE_SIZE)
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA cache_size = -%d" % LOAD_CACHE_KB)
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA mmap_size = %d" % LOAD_MMAP_BYTES)
+
+
+def vacuum(cursor):
+    """
+    Rebuild the database file so that each table and index is stored
+    contiguously, reporting how long it took.
+    """
+    start = time.time()
+    cursor.execute("VACUUM")
+    sys.stderr.write("vacuumed the database in %.2f seconds.\n"
+                     % (time.time() - start))
+
+
+def create_index(cursor, name):
+    """
+    Create one of the INDICES, if it doesn't exist yet.
+    """
+    columns, unique = INDICES[name]
+    cursor.execute("create {0}index if not exists {1} on {2}".format(
+                   "unique " if unique else "", name, columns))
+
+
+def fill_variant_bins(cursor):
+    """
+    Add the bin of each variant that isn't in the variant_bins table
+    yet (i.e., those loaded, or appended, since it was last filled).
+    Returns the number of variants binned.
+    """
+    cursor.connection.create_function("gemini_bin", 2,
+                                      binning.bin_from_range)
+    cursor.execute("insert into variant_bins "
+                   "select variant_id, chrom, gemini_bin(start, end), "
+                   "start, end from variants where variant_id > "
+                   "(select ifnull(max(variant_id), -1) from variant_bins)")
+    return cursor.rowcount
+
+
+def fill_gene_variants(cursor):
+    """
+    Map each gene to the variants that any of its transcripts is
+    affected by (variant_impacts.gene), as well as those whose most
+    severe impact is on it (variants.gene), for the variants that
+    aren't in the gene_variants table yet. Returns the number of
+    (gene, variant) pairs added.
+    """
+    cursor.execute("select ifnull(max(variant_id), -1) from gene_variants")
+    last_variant_id = cursor.fetchone()[0]
+    cursor.execute("insert into gene_variants "
+                   "select gene, variant_id from variant_impacts "
+                   "where gene is not null and variant_id > ? "
+                   "union "
+                   "select gene, variant_id from variants "
+                   "where gene is not null and variant_id > ?",
+                   (last_variant_id, last_variant_id))
+    return cursor.rowcount
+
+
+def has_index(cursor, name):
+    """
+    Does the database have the index? Databases made before the
+    variant_bins and gene_variants tables were added lack their indices,
+    and lookups of them fall back to the variants table.
+    """
+    cursor.execute("select count(*) from sqlite_master "
+                   "where type = 'index' and name = ?", (name, ))
+    return cursor.fetchone()[0] > 0
 
 
-def index_variation(cursor):
-    cursor.execute('''create index var_chr_start_idx on\
-                      variants(chrom, start)''')
-    cursor.execute('''create index var_type_idx on variants(type)''')
-    cursor.execute('''create index var_gt_counts_idx on \
-                      variants(num_hom_ref, num_het, \
-                               num_hom_alt, num_unknown)''')
-    cursor.execute('''create index var_aaf_idx on variants(aaf)''')
-    cursor.execute('''create index var_in_dbsnp_idx on variants(in_dbsnp)''')
-    cursor.execute('''create index var_in_call_rate_idx on \
-                      variants(call_rate)''')
-    cursor.execute('''create index var_exonic_idx on variants(is_exonic)''')
-    cursor.execute('''create index var_coding_idx on variants(is_coding)''')
-    cursor.execute('''create index var_lof_idx on variants(is_lof)''')
-    cursor.execute('''create index var_depth_idx on variants(depth)''')
-    cursor.execute('''create index var_gene_idx on variants(gene)''')
-
-
-def index_variation_impacts(cursor):
-    cursor.execute('''create index varimp_exonic_idx on \
-                      variant_impacts(is_exonic)''')
-    cursor.execute('''create index varimp_coding_idx on \
-                      variant_impacts(is_coding)''')
-    cursor.execute(
-        '''create index varimp_lof_idx on variant_impacts(is_lof)''')
-    cursor.execute('''create index varimp_impact_idx on \
-                      variant_impacts(impact)''')
-
-
-def index_samples(cursor):
-    cursor.execute('''create unique index sample_name_idx on samples(name)''')
-
-
-def create_indices(cursor):
+def create_indices(cursor, indexes='default', threads=1):
     """
-    Index our master DB tables for speed
+    Index our master DB tables for speed, then ANALYZE them so that
+    the query planner knows which index to use.
+
+    indexes is a key of INDEX_LEVELS. SQLite builds one index at a time
+    per database, so the indices are built in turn, but each is sorted
+    with up to `threads` threads and a large in-memory cache.
     """
-    index_variation(cursor)
-    index_samples(cursor)
+    cursor.execute("PRAGMA cache_size = -%d" % INDEX_CACHE_KB)
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA threads = %d" % threads)
+    total_start = time.time()
+    num_binned = fill_variant_bins(cursor)
+    num_pairs = fill_gene_variants(cursor)
+    sys.stderr.write("binned %d variants and mapped %d gene/variant pairs "
+                     "in %.2f seconds.\n"
+                     % (num_binned, num_pairs, time.time() - total_start))
+    for name in INDEX_LEVELS[indexes]:
+        start = time.time()
+        create_index(cursor, name)
+        sys.stderr.write("built index %s in %.2f seconds.\n"
+                         % (name, time.time() - start))
+    start = time.time()
+    cursor.execute("PRAGMA analysis_limit = %d" % ANALYSIS_LIMIT)
+    cursor.execute("ANALYZE")
+    sys.stderr.write("analyzed the indices in %.2f seconds.\n"
+                     % (time.time() - start))
+    sys.stderr.write("indexing took %.2f seconds.\n"
+                     % (time.time() - total_start))
 
 
 def create_tables(cursor):
@@ -184,6 +320,20 @@ def create_tables(cursor):
                     sift_score float,                                 \
                     PRIMARY KEY(variant_id ASC, anno_id ASC))''')
 
+    # the UCSC bin of each variant, for region queries (see binning.py)
+    cursor.execute('''create table if not exists variant_bins (  \
+                    variant_id integer,                          \
+                    chrom text,                                  \
+                    bin integer,                                 \
+                    start integer,                               \
+                    end integer,                                 \
+                    PRIMARY KEY(variant_id ASC))''')
+
+    # the variants affecting each gene, on any transcript, for gene queries
+    cursor.execute('''create table if not exists gene_variants (  \
+                    gene text,                                    \
+                    variant_id integer)''')
+
     cursor.execute('''create table if not exists sample_genotypes (  \
                     sample_id integer,                               \
                     gt_types BLOB,                                   \
@@ -203,6 +353,12 @@ def create_tables(cursor):
 
     cursor.execute('''create table if not exists version (version text)''')
 
+    # the progress of the load that is writing the database
+    cursor.execute('''create table if not exists load_state ( \
+                     key text,                                \
+                     value text,                              \
+                     PRIMARY KEY(key ASC))''')
+
 def create_sample_table(cursor, args):
     NUM_BUILT_IN = 6
     fields = get_ped_fields(args.ped_file)
@@ -215,65 +371,27 @@ def create_sample_table(cursor, args):
     creation = "create table if not exists samples ({0})".format(structure)
     cursor.execute(creation)
 
-def _insert_variation_one_per_transaction(cursor, buffer):
-    for variant in buffer:
-        try:
-            cursor.execute("BEGIN TRANSACTION")
-            cursor.execute('insert into variants values     (?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?,?,?, \
-                                                             ?,?,?,?,?,?,?,?)', variant)
-            cursor.execute("END TRANSACTION")
-        # skip repeated keys until we get to the failed variant
-        except sqlite3.IntegrityError, e:
-            cursor.execute("END TRANSACTION")
-            continue
-        except sqlite3.ProgrammingError, e:
-            print variant
-            print "Error %s:" % (e.args[0])
-            sys.exit(1)
-
-def insert_variation(cursor, buffer):
+def insert_batch(cursor, variants, variant_impacts):
     """
-    Populate the variants table with each variant in the buffer.
+    Insert a batch of variants and their impacts as part of the caller's
+    transaction. The INSERT statements are the same for every batch, so
+    sqlite3 prepares each of them only once per connection.
     """
+    cursor.execute("SAVEPOINT batch")
     try:
-        cursor.execute("BEGIN TRANSACTION")
-        cursor.executemany('insert into variants values (?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?,?,?, \
-                                                         ?,?,?,?,?,?,?,?)', buffer)
-
-        cursor.execute("END TRANSACTION")
-    except sqlite3.ProgrammingError:
-        cursor.execute("END TRANSACTION")
-        _insert_variation_one_per_transaction(cursor, buffer)
-
-
-def insert_variation_impacts(cursor, buffer):
-    """
-    Populate the variant_impacts table with each variant in the buffer.
-    """
-    cursor.execute("BEGIN TRANSACTION")
-    cursor.executemany('insert into variant_impacts values (?,?,?,?,?,?,?,?, \
-                                                            ?,?,?,?,?,?,?,?, \
-                                                            ?,?)',
-                       buffer)
-    cursor.execute("END")
+        cursor.executemany(INSERT_VARIANT, variants)
+    except (sqlite3.ProgrammingError, sqlite3.InterfaceError):
+        # undo the partial batch and insert it one variant at a time
+        # to find the variant that can't be stored.
+        cursor.execute("ROLLBACK TO SAVEPOINT batch")
+        for variant in variants:
+            try:
+                cursor.execute(INSERT_VARIANT, variant)
+            except (sqlite3.ProgrammingError, sqlite3.InterfaceError), e:
+                sys.exit("ERROR: could not store the variant at %s:%s: %s"
+                         % (variant[0], variant[1], e))
+    cursor.execute("RELEASE SAVEPOINT batch")
+    cursor.executemany(INSERT_VARIANT_IMPACT, variant_impacts)
 
 
 def insert_sample(cursor, sample_list):
@@ -306,6 +424,27 @@ def insert_version(cursor, version):
     cursor.execute("END")
 
 
+def set_load_state(cursor, state):
+    """
+    Record the progress of a load (a dict of JSON-able values).
+    """
+    cursor.executemany('''insert or replace into load_state values (?,?)''',
+                       [(key, json.dumps(value))
+                        for key, value in state.items()])
+
+
+def get_load_state(cursor):
+    """
+    Return the recorded progress of a load as a dict, which is empty if
+    the database predates the load_state table or wasn't written by a load.
+    """
+    try:
+        cursor.execute('''select key, value from load_state''')
+    except sqlite3.OperationalError:
+        return {}
+    return dict((key, json.loads(value)) for key, value in cursor)
+
+
 def close_and_commit(cursor, connection):
     """
     Commit changes to the DB and close out DB cursor.
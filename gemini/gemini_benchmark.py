@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""
+    Time gemini on synthetic data: a VCF of N variants x M samples (in
+    trios, described by a PED file) annotated as if by snpEff or VEP.
+    Each run's timings are appended to a JSON history, and compared with
+    the last run with the same settings, to catch performance regressions.
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import GeminiQuery
+import version
+
+# run the gemini command line with this same python
+GEMINI_CMD = [sys.executable, "-c",
+              "import gemini.gemini_main; gemini.gemini_main.main()"]
+
+# the steps that are timed, in the order they are run
+STEPS = ['load', 'load_multicore', 'query', 'query_gts', 'query_gt_filter',
+         'stats_mds', 'comp_hets', 'autosomal_recessive', 'burden']
+
+NUM_CHROMS = 22
+# the number of consecutive variants in each gene
+VARIANTS_PER_GENE = 10
+# the fraction of genotypes that are missing
+MISSING_RATE = 0.01
+BASES = "ACGT"
+
+SNPEFF_HEADER = [
+    '##SnpEffVersion="SnpEff 3.0g (build 2012-08-31), by Pablo Cingolani"',
+    '##INFO=<ID=EFF,Number=.,Type=String,Description="Predicted effects '
+    'for this variant.Format: \'Effect ( Effect_Impact | Functional_Class '
+    '| Codon_Change | Amino_Acid_change| Amino_Acid_length | Gene_Name | '
+    'Gene_BioType | Coding | Transcript | Exon [ | ERRORS | WARNINGS ] )\' ">']
+# effect name and details, with the gene and transcript to be filled in
+SNPEFF_EFFECTS = [
+    "NON_SYNONYMOUS_CODING(MODERATE|MISSENSE|Gcc/Acc|A{aa}T|400|{gene}|"
+    "protein_coding|CODING|{transcript}|exon_1_1_1000)",
+    "STOP_GAINED(HIGH|NONSENSE|Cga/Tga|R{aa}*|400|{gene}|"
+    "protein_coding|CODING|{transcript}|exon_1_1_1000)",
+    "SYNONYMOUS_CODING(LOW|SILENT|gcC/gcT|A{aa}|400|{gene}|"
+    "protein_coding|CODING|{transcript}|exon_1_1_1000)",
+    "INTRON(MODIFIER||||400|{gene}|protein_coding|CODING|{transcript}|)"]
+
+VEP_HEADER = [
+    '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence type as '
+    'predicted by VEP. Format: Consequence|Codons|Amino_acids|Gene|HGNC|'
+    'Feature|EXON|PolyPhen|SIFT">']
+VEP_EFFECTS = [
+    "missense_variant|Gcc/Acc|A/T|ENSG{num}|{gene}|{transcript}|1/10|"
+    "probably_damaging(0.95)|deleterious(0.01)",
+    "stop_gained|Cga/Tga|R/*|ENSG{num}|{gene}|{transcript}|1/10||",
+    "synonymous_variant|gcC/gcT|A|ENSG{num}|{gene}|{transcript}|1/10||",
+    "intron_variant|||ENSG{num}|{gene}|{transcript}|||"]
+
+
+def get_sample_names(num_samples):
+    return ["S%d" % idx for idx in range(1, num_samples + 1)]
+
+
+def write_ped(path, samples):
+    """
+    Write a PED file grouping the samples into trios of an unaffected
+    father and mother and an affected child (any leftover samples are
+    unrelated and unaffected).
+    """
+    with open(path, 'w') as ped:
+        ped.write("#family_id\tname\tpaternal_id\tmaternal_id\t"
+                  "sex\tphenotype\n")
+        for idx, sample in enumerate(samples):
+            family = idx / 3 + 1
+            in_trio = (idx / 3 + 1) * 3 <= len(samples)
+            if in_trio and idx % 3 == 2:
+                ped.write("%d\t%s\t%s\t%s\t%d\t2\n"
+                          % (family, sample, samples[idx - 2],
+                             samples[idx - 1], random.choice([1, 2])))
+            else:
+                sex = 2 if in_trio and idx % 3 == 1 else 1
+                ped.write("%d\t%s\t0\t0\t%d\t1\n" % (family, sample, sex))
+
+
+def write_vcf(path, num_variants, samples, min_aaf, max_aaf, anno_type):
+    """
+    Write a VCF of num_variants variants spread across the autosomes and
+    grouped into genes. Each variant's alternate allele frequency is drawn
+    from [min_aaf, max_aaf], and its genotypes are drawn from that
+    frequency assuming Hardy-Weinberg equilibrium.
+    """
+    num_samples = len(samples)
+    # genotype type -> FORMAT values: hom_ref, het, hom_alt, missing
+    calls = np.array(["0/0:30,0:30:99", "0/1:15,15:30:99",
+                      "1/1:0,30:30:99", "./.:.:.:."])
+    if anno_type == "VEP":
+        header, effects, tag = VEP_HEADER, VEP_EFFECTS, "CSQ"
+    else:
+        header, effects, tag = SNPEFF_HEADER, SNPEFF_EFFECTS, "EFF"
+    per_chrom = max(1, num_variants / NUM_CHROMS + 1)
+    with open(path, 'w') as vcf:
+        vcf.write("##fileformat=VCFv4.1\n")
+        vcf.write('##INFO=<ID=DP,Number=1,Type=Integer,'
+                  'Description="Total Depth">\n')
+        vcf.write("\n".join(header) + "\n")
+        vcf.write('##FORMAT=<ID=GT,Number=1,Type=String,'
+                  'Description="Genotype">\n'
+                  '##FORMAT=<ID=AD,Number=.,Type=Integer,'
+                  'Description="Allelic depths">\n'
+                  '##FORMAT=<ID=DP,Number=1,Type=Integer,'
+                  'Description="Read depth">\n'
+                  '##FORMAT=<ID=GQ,Number=1,Type=Integer,'
+                  'Description="Genotype quality">\n')
+        vcf.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
+                             "FILTER", "INFO", "FORMAT"] + samples) + "\n")
+        pos = 0
+        for idx in xrange(num_variants):
+            if idx % per_chrom == 0:
+                chrom = "chr%d" % (idx / per_chrom + 1)
+                pos = 10000
+            pos += random.randint(50, 500)
+            gene_num = idx / VARIANTS_PER_GENE + 1
+            gene = "GENE%d" % gene_num
+            ref = random.choice(BASES)
+            alt = random.choice(BASES.replace(ref, ""))
+
+            aaf = random.uniform(min_aaf, max_aaf)
+            cutoffs = np.cumsum([(1 - aaf) ** 2, 2 * aaf * (1 - aaf),
+                                 aaf ** 2]) * (1 - MISSING_RATE)
+            gt_types = np.searchsorted(cutoffs, np.random.random(num_samples))
+
+            annos = [effect.format(gene=gene, num=gene_num,
+                                   transcript="ENST%d" % idx,
+                                   aa=idx % 400 + 1)
+                     for effect in random.sample(effects, 2)]
+            info = "DP=%d;%s=%s" % (30 * num_samples, tag, ",".join(annos))
+            vcf.write("%s\t%d\t.\t%s\t%s\t50\tPASS\t%s\tGT:AD:DP:GQ\t%s\n"
+                      % (chrom, pos, ref, alt, info,
+                         "\t".join(calls[gt_types])))
+
+
+def run_gemini(args):
+    """
+    Run a gemini command, discarding its output. Returns the
+    time it took, or None if it failed.
+    """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        status = subprocess.call(GEMINI_CMD + args, stdout=devnull,
+                                 stderr=devnull)
+    if status != 0:
+        sys.stderr.write("WARNING: gemini %s failed.\n" % " ".join(args))
+        return None
+    return time.time() - start
+
+
+def time_query(db, query, gt_filter=None):
+    """
+    Time running a GeminiQuery and reading all of its rows.
+    """
+    start = time.time()
+    gq = GeminiQuery.GeminiQuery(db)
+    gq.run(query, gt_filter)
+    for row in gq:
+        pass
+    return time.time() - start
+
+
+def run_steps(args, vcf, ped, workdir):
+    """
+    Run each of the benchmark steps on the synthetic data, returning
+    the time that each took (None if it failed).
+    """
+    db = os.path.join(workdir, "benchmark.db")
+    mc_db = os.path.join(workdir, "benchmark.multicore.db")
+    load = ["load", "-v", vcf, "-t", args.anno_type, "-p", ped]
+    first, second = get_sample_names(2)
+    steps = {
+        'load': lambda: run_gemini(load + [db]),
+        'load_multicore': lambda: run_gemini(load + ["--cores",
+                                                     str(args.cores), mc_db]),
+        'query': lambda: time_query(db, "select chrom, start, end, gene, "
+                                        "impact from variants"),
+        'query_gts': lambda: time_query(db, "select chrom, start, gts, "
+                                            "gt_types from variants"),
+        'query_gt_filter': lambda: time_query(
+            db, "select chrom, start, gene from variants",
+            "gt_types.%s == HET and gt_types.%s != HOM_REF"
+            % (first, second)),
+        'stats_mds': lambda: run_gemini(["stats", "--mds", db]),
+        'comp_hets': lambda: run_gemini(["comp_hets", "--ignore-phasing",
+                                         db]),
+        'autosomal_recessive': lambda: run_gemini(["autosomal_recessive",
+                                                   db]),
+        'burden': lambda: run_gemini(["burden", db])}
+
+    timings = {}
+    if 'load' not in args.steps and os.path.exists(db):
+        sys.stderr.write("benchmark: using the database that an earlier "
+                         "run left in %s.\n" % workdir)
+    for step in args.steps:
+        sys.stderr.write("benchmark: running %s.\n" % step)
+        if step != 'load' and step != 'load_multicore' and \
+                not os.path.exists(db):
+            sys.stderr.write("WARNING: skipping %s, which needs the "
+                             "load step (or the database of an earlier "
+                             "run in --dir).\n" % step)
+            timings[step] = None
+            continue
+        timings[step] = steps[step]()
+    return timings
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as handle:
+        return json.load(handle)['runs']
+
+
+def write_history(path, runs):
+    with open(path, 'w') as handle:
+        json.dump({'runs': runs}, handle, indent=2, sort_keys=True,
+                  separators=(",", ": "))
+        handle.write("\n")
+
+
+def report(run, previous):
+    """
+    Print the time of each step, and how it compares to the
+    previous run with the same settings (if any).
+    """
+    if previous is not None:
+        print "compared with gemini {0} on {1}:".format(previous['version'],
+                                                      previous['date'])
+    print "\t".join(["step", "seconds", "previous", "change"])
+    for step in STEPS:
+        if step not in run['timings']:
+            continue
+        seconds = run['timings'][step]
+        before = None
+        if previous is not None:
+            before = previous['timings'].get(step)
+        change = "NA"
+        if seconds is not None and before:
+            change = "{0:+.1f}%".format(100.0 * (seconds - before) / before)
+        print "\t".join([step, format_seconds(seconds),
+                         format_seconds(before), change])
+
+
+def format_seconds(seconds):
+    return "NA" if seconds is None else "{0:.2f}".format(seconds)
+
+
+def benchmark(parser, args):
+    if args.num_variants < 1 or args.num_samples < 3:
+        sys.exit("ERROR: the benchmark needs at least 1 variant "
+                 "and 3 samples.\n")
+    if not 0.0 <= args.min_aaf <= args.max_aaf <= 1.0:
+        sys.exit("ERROR: need 0 <= --min-aaf <= --max-aaf <= 1.\n")
+    args.steps = args.steps.split(",") if args.steps else STEPS
+    unknown = [step for step in args.steps if step not in STEPS]
+    if unknown:
+        sys.exit("ERROR: unknown benchmark steps: %s. Choose from: %s.\n"
+                 % (", ".join(unknown), ", ".join(STEPS)))
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    workdir = args.dir or tempfile.mkdtemp(prefix="gemini_benchmark.")
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    try:
+        samples = get_sample_names(args.num_samples)
+        vcf = os.path.join(workdir, "benchmark.vcf")
+        ped = os.path.join(workdir, "benchmark.ped")
+        sys.stderr.write("benchmark: writing %d variants x %d samples "
+                         "to %s.\n" % (args.num_variants, args.num_samples,
+                                       vcf))
+        write_ped(ped, samples)
+        write_vcf(vcf, args.num_variants, samples, args.min_aaf,
+                  args.max_aaf, args.anno_type)
+        timings = run_steps(args, vcf, ped, workdir)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(workdir)
+
+    settings = {'num_variants': args.num_variants,
+                'num_samples': args.num_samples,
+                'min_aaf': args.min_aaf, 'max_aaf': args.max_aaf,
+                'anno_type': args.anno_type, 'cores': args.cores,
+                'seed': args.seed}
+    run = {'version': version.__version__,
+           'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+           'settings': settings, 'timings': timings}
+    runs = read_history(args.history)
+    previous = None
+    for earlier in runs:
+        if earlier['settings'] == settings:
+            previous = earlier
+    report(run, previous)
+    runs.append(run)
+    write_history(args.history, runs)
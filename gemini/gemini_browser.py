@@ -18,6 +18,7 @@ import tool_autosomal_dominant as dominant_tool
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     from bottle import TEMPLATE_PATH, Bottle, run, static_file, debug, request
+    from bottle import response
     from bottle import jinja2_view as view, jinja2_template as template
 
 debug(True)
@@ -50,12 +51,34 @@ def index():
 @app.route('/query_json', method='GET')
 def query_json():
     query = request.GET.get('query', '').strip()
-    
+    # page through the results with ?page_size=N, then
+    # &page_token=<the next_page_token of the previous page>
+    page_size = request.GET.get('page_size', '').strip()
+    page_token = request.GET.get('page_token', '').strip() or None
+
     gq = GeminiQuery.GeminiQuery(database)
     gq._set_gemini_browser(True)
-    gq.run(query)
-    
-    return {'gemini_results': [dict(row) for row in gq]}
+    if not page_size:
+        gq.run(query)
+        return {'gemini_results': [dict(row) for row in gq]}
+
+    # a bad request is answered with an error, rather than letting
+    # sys.exit() stop the server
+    try:
+        page_size = int(page_size)
+        if page_size < 1:
+            raise ValueError
+    except ValueError:
+        response.status = 400
+        return {'error': "page_size must be a positive integer."}
+    try:
+        gq.run_page(query, page_size=page_size, page_token=page_token)
+    except GeminiQuery.PageError as e:
+        response.status = 400
+        return {'error': str(e)}
+    results = [dict(row) for row in gq]
+    return {'gemini_results': results,
+            'next_page_token': gq.next_page_token}
 
 
 @app.route('/query', method='GET')
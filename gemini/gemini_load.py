@@ -3,13 +3,40 @@
 # native Python imports
 import os.path
 import sys
+import copy
+import sqlite3
+import itertools
+import multiprocessing
+import traceback
 
 import annotations
+import bgzf
+import database
+import shards
 from gemini_constants import *
-import subprocess
 from cluster_helper.cluster import cluster_view
-from gemini_load_chunk import GeminiLoader
-import uuid
+from gemini_load_chunk import GeminiLoader, report_peak_memory, \
+    get_peak_memory_mb, get_load_identity
+from gemini_merge_chunks import merge_chunk_dbs
+from profiler import StageProfiler, timed
+import time
+
+# a VCF is cut into (up to) this many chunks per core, so that a
+# slow chunk (e.g., from a gene-dense region) doesn't leave the other
+# cores idle while it finishes...
+CHUNKS_PER_CORE = 8
+# ...but the chunks are kept at least this big (--chunk-mb).
+DEFAULT_CHUNK_MB = 4
+
+# the process that opened the annotation files
+_annos_pid = None
+
+
+class ChunkLoadError(Exception):
+    """
+    A chunk of the VCF could not be loaded.
+    """
+    pass
 
 
 def load(parser, args):
@@ -23,304 +50,464 @@ def load(parser, args):
     # collect of the the add'l annotation files
     annotations.load_annos()
 
+    # chromosome shards are never merged
+    if args.shard_by is not None:
+        args.no_merge = True
+    if args.profile_json is not None:
+        args.profile = True
+
+    if args.append and (args.cores > 1 or args.shard_by is not None or
+                        args.no_merge or use_scheduler(args)):
+        sys.exit("ERROR: --append loads on a single core, without "
+                 "--cores, --shard-by, --no-merge or a scheduler.\n")
+
     if use_scheduler(args):
         load_ipython(args)
-    elif args.cores > 1:
+    elif args.cores > 1 or args.shard_by is not None:
         load_multicore(args)
     else:
         load_singlecore(args)
 
 
 def load_singlecore(args):
+    start_time = time.time()
     # create a new gemini loader and populate
     # the gemini db and files from the VCF
     gemini_loader = GeminiLoader(args)
+    if gemini_loader.load_complete:
+        print "{0} is already completely loaded.".format(args.db)
+        return
     gemini_loader.store_resources()
     gemini_loader.store_version()
     gemini_loader.populate_from_vcf()
-    gemini_loader.build_indices_and_disconnect()
+    timed(gemini_loader.profiler, "indices",
+          gemini_loader.build_indices_and_disconnect)()
 
     if not args.no_genotypes and not args.no_load_genotypes:
         gemini_loader.store_sample_gt_counts()
+    gemini_loader.mark_load_complete()
+    if args.vacuum:
+        database.vacuum(gemini_loader.c)
+
+    report_peak_memory()
+    if gemini_loader.profiler is not None:
+        report_profile(gemini_loader.profiler, args, time.time() - start_time)
 
 def load_multicore(args):
-    grabix_file = bgzip(args.vcf)
-    chunks = load_chunks_multicore(grabix_file, args)
-    merge_chunks_multicore(chunks, args.db)
+    start_time = time.time()
+    check_vcf_is_splittable(args)
+    chunks, profiler = load_chunks_multicore(args)
+    timed(profiler, "merge and indices", finish_load)(chunks, args)
+    if profiler is not None:
+        report_profile(profiler, args, time.time() - start_time)
 
 def load_ipython(args):
-    grabix_file = bgzip(args.vcf)
+    start_time = time.time()
+    check_vcf_is_splittable(args)
     with cluster_view(*get_ipython_args(args)) as view:
-        chunks = load_chunks_ipython(grabix_file, args, view)
-        merge_chunks_ipython(chunks, args.db, view)
-
-def merge_chunks(chunks, db):
-    cmd = get_merge_chunks_cmd(chunks, db)
-    print "Merging chunks."
-    subprocess.check_call(cmd, shell=True)
-    cleanup_temp_db_files(chunks)
-    return db
+        chunks, profiler = load_chunks_ipython(args, view)
+    timed(profiler, "merge and indices", finish_load)(chunks, args)
+    if profiler is not None:
+        report_profile(profiler, args, time.time() - start_time)
 
-def get_merge_chunks_cmd(chunks, db):
-    chunk_names = ""
-    for chunk in chunks:
-        chunk_names += " --chunkdb  " + chunk
-    return "gemini merge_chunks {chunk_names} --db {db}".format(**locals())
-
-def merge_chunks_ipython(chunks, db, view):
-    if len(chunks) == 1:
-        os.rename(chunks[0], db)
-        return db
+def report_profile(profiler, args, elapsed):
+    """
+    Report where the time of a --profile'd load went, and write
+    the profile to the --profile-json file, if any.
+    """
+    profiler.elapsed = elapsed
+    profiler.peak_memory_mb = max(profiler.peak_memory_mb,
+                                  get_peak_memory_mb())
+    profiler.report()
+    if args.profile_json is not None:
+        profiler.write_json(args.profile_json)
+
+def check_vcf_is_splittable(args):
+    if args.vcf == "-":
+        sys.exit("ERROR: loading with --cores or --shard-by requires a VCF "
+                 "file, not STDIN.\n")
+    if bgzf.is_gz_file(args.vcf) and not bgzf.is_bgzf(args.vcf):
+        sys.exit("ERROR: %s must be compressed with bgzip (or not at all) "
+                 "to be loaded with --cores or --shard-by.\n" % args.vcf)
+
+def finish_load(chunks, args):
+    if args.no_merge:
+        write_shard_manifest(chunks, args.db)
     else:
-        sub_merges = get_chunks_to_merge(chunks)
-        tmp_dbs = get_temp_dbs(len(sub_merges), os.path.dirname(sub_merges[0][0]))
-        view.map(merge_chunks, sub_merges, tmp_dbs)
-        merge_chunks_ipython(tmp_dbs, db, view)
+        merge_chunks([chunk['db'] for chunk in chunks], args.db,
+                     args.indexes, args.cores, args.vacuum)
 
-def merge_chunks_multicore(chunks, db):
+def write_shard_manifest(chunks, db):
+    """
+    Keep the chunk databases as they are, as the shards of a sharded
+    database, and write a manifest listing them to db.
+    """
+    shards.share_sample_genotype_counts([chunk['db'] for chunk in chunks])
+    if os.path.exists(db):
+        os.remove(db)
+    shards.write_manifest(db, chunks)
+    print "Wrote a manifest of {0} database shards to {1}.".format(len(chunks),
+                                                                 db)
+
+def merge_chunks(chunks, db, indexes='default', threads=1, vacuum=False):
+    """
+    Merge the chunk databases into the final database in a single pass,
+    and index it with up to `threads` threads.
+    """
     if len(chunks) == 1:
         os.rename(chunks[0], db)
+        # the chunk was loaded without indices, to be merged
+        conn = sqlite3.connect(db)
+        database.create_indices(conn.cursor(), indexes, threads)
+        conn.commit()
+        if vacuum:
+            database.vacuum(conn.cursor())
+        conn.close()
         return db
-    else:
-        procs = []
-        sub_merges = get_chunks_to_merge(chunks)
-        tmp_dbs = get_temp_dbs(len(sub_merges), os.path.dirname(sub_merges[0][0]))
-        for sub_merge, tmp_db in zip(sub_merges, tmp_dbs):
-            cmd = get_merge_chunks_cmd(sub_merge, tmp_db)
-            procs.append(subprocess.Popen(cmd, shell=True))
-        wait_until_finished(procs)
-        cleanup_temp_db_files(chunks)
-        merge_chunks_multicore(tmp_dbs, db)
-
-def get_chunks_to_merge(chunks):
-    sublist = list_to_sublists(chunks, 2)
-    if len(sublist[-1]) > 1:
-        return sublist
-    else:
-        sublist[-2].extend(sublist[-1])
-        return sublist[:-1]
-
-def list_to_sublists(l, n):
-    """ convert list l to sublists of length n """
-    return [l[i:i+n] for i in xrange(0, len(l), n)]
-
-def get_temp_dbs(n, tmp_dir):
-    return [os.path.join(tmp_dir, str(uuid.uuid4())) + ".db" for _ in xrange(n)]
-
-def get_chunk_name(chunk):
-    return "--chunkdb " + chunk
+    print "Merging chunks."
+    merge_chunk_dbs(chunks, db, indexes, threads, vacuum)
+    cleanup_temp_db_files(chunks)
+    return db
 
-def load_chunks_multicore(grabix_file, args):
+def load_chunks_multicore(args):
+    """
+    Load chunks of the VCF into chunk databases with a pool of worker
+    processes. Each worker takes the next chunk as soon as it is free.
+    """
     cores = args.cores
+    chunk_steps = get_chunk_steps(args, cores)
+
+    pool = multiprocessing.Pool(cores)
+    results = []
+    try:
+        # count the variants in each chunk so that
+        # each chunk knows where its variant_ids start.
+        chrom_counts = run_pool(pool, count_chunk_variants,
+                                [(args.vcf, chunk)
+                                 for _, chunk in chunk_steps])
+        load_steps, counts = get_load_steps(args, chunk_steps, chrom_counts)
+        # the chunks share this machine, so they share the memory budget
+        max_buffer_mb = None
+        if args.max_buffer_mb is not None:
+            max_buffer_mb = args.max_buffer_mb / cores
+        tasks = get_chunk_tasks(args, load_steps, counts, max_buffer_mb)
+        results, tasks = get_finished_chunks(args, tasks)
+
+        loaded = pool.imap_unordered(load_chunk_native, tasks)
+        for _ in tasks:
+            # a timeout keeps the wait interruptible by Ctrl-C
+            results.append(loaded.next(sys.maxint))
+            report_chunk_time(results[-1], len(results), len(load_steps))
+    except KeyboardInterrupt:
+        stop_pool(pool, args, results)
+        raise
+    except Exception as e:
+        # ChunkLoadErrors, but also, e.g., a sqlite3.Error or IOError
+        stop_pool(pool, args, results)
+        sys.exit("ERROR: " + str(e))
+    pool.close()
+    pool.join()
+
+    return finish_chunks(results, args.profile)
+
+def load_chunks_ipython(args, view):
+    """
+    Load chunks of the VCF into chunk databases on the cluster.
+    The chunks are handed out to engines as they become free.
+    """
+    chunk_steps = get_chunk_steps(args, args.cores)
+    vcfs = [args.vcf] * len(chunk_steps)
+    results = []
+    loading = False
+    try:
+        chrom_counts = view.map(count_chunk_variants,
+                                zip(vcfs, [chunk for _, chunk in chunk_steps]))
+        load_steps, counts = get_load_steps(args, chunk_steps, chrom_counts)
+        # each engine gets the full memory budget
+        tasks = get_chunk_tasks(args, load_steps, counts, args.max_buffer_mb)
+        results, tasks = get_finished_chunks(args, tasks)
+        if tasks:
+            loading = True
+            results += view.map(load_chunk_native, tasks)
+    except Exception as e:
+        # the engines' results only come back once all of them finish,
+        # so once they have started, some chunks may have been kept
+        if results or loading:
+            report_kept_chunks(args)
+        sys.exit("ERROR: " + str(e))
+    for idx, result in enumerate(results):
+        report_chunk_time(result, idx + 1, len(results))
+
+    return finish_chunks(results, args.profile)
+
+def get_chunk_steps(args, cores):
+    """
+    Cut the VCF into many more chunks than cores, of roughly equal size.
+    """
+    vcf = args.vcf
+    chunk_mb = getattr(args, 'chunk_mb', None) or DEFAULT_CHUNK_MB
+    if chunk_mb <= 0:
+        sys.exit("ERROR: --chunk-mb must be greater than 0.\n")
+    num_chunks = int(os.path.getsize(vcf) / (chunk_mb * 1024 * 1024))
+    num_chunks = max(cores, min(cores * CHUNKS_PER_CORE, num_chunks))
+    chunk_steps = list(enumerate(bgzf.split_file(vcf, num_chunks)))
+    print "Breaking {0} into {1} chunks.".format(vcf, len(chunk_steps))
+    return chunk_steps
+
+def get_load_steps(args, chunk_steps, chrom_counts):
+    """
+    Decide what each worker loads, given the variants counted on each
+    chromosome of each chunk. Returns a list of (chunk_num, chunks, chrom)
+    steps, where chunks is the list of byte ranges to read and chrom (if
+    not None) restricts the step to one chromosome, along with the
+    number of variants in each step.
+    """
+    if args.shard_by == "chrom":
+        return get_chrom_steps(chunk_steps, chrom_counts)
+    steps = [(chunk_num, [chunk], None) for chunk_num, chunk in chunk_steps]
+    counts = [sum(count for _, count in chroms) for chroms in chrom_counts]
+    return steps, counts
 
-    # specify the PED file if given one
-    ped_file = ""
-    if args.ped_file is not None:
-        ped_file = "-p " + args.ped_file
-
-    # specify the annotation type if given one
-    anno_type = ""
-    if args.anno_type is not None:
-        anno_type = "-t " + args.anno_type
-
-    no_genotypes = ""
-    if args.no_genotypes is True:
-        no_genotypes = "--no-genotypes"
-
-    no_load_genotypes = ""
-    if args.no_load_genotypes is True:
-        no_load_genotypes = "--no-load-genotypes"
-        
-    load_gerp_bp = ""
-    if args.load_gerp_bp is True:
-        load_gerp_bp = "--load-gerp-bp"
-
-    submit_command = get_submit_command(args)
-    vcf, _ = os.path.splitext(grabix_file)
-    chunk_steps = get_chunk_steps(grabix_file, args)
-    chunk_vcfs = []
-    chunk_dbs = []
-    procs = []
-
-    for chunk_num, chunk in chunk_steps:
-        start, stop = chunk
-        print "Loading chunk " + str(chunk_num) + "." + ped_file
-        gemini_load = gemini_pipe_load_cmd().format(**locals())
-        procs.append(subprocess.Popen(submit_command.format(cmd=gemini_load),
-                                      shell=True))
-
-        chunk_vcf = vcf + ".chunk" + str(chunk_num)
-        chunk_vcfs.append(chunk_vcf)
-        chunk_dbs.append(chunk_vcf + ".db")
-
-    wait_until_finished(procs)
-    print "Done loading {0} variants in {1} chunks.".format(stop, chunk_num)
-    return chunk_dbs
-
-def load_chunks_ipython(grabix_file, args, view):
-    # specify the PED file if given one
-    ped_file = ""
-    if args.ped_file is not None:
-        ped_file = "-p " + args.ped_file
-
-    # specify the annotation type if given one
-    anno_type = ""
-    if args.anno_type is not None:
-        anno_type = "-t " + args.anno_type
-
-    no_genotypes = ""
-    if args.no_genotypes is True:
-        no_genotypes = "--no-genotypes"
-
-    no_load_genotypes = ""
-    if args.no_load_genotypes is True:
-        no_load_genotypes = "--no-load-genotypes"
-        
-    load_gerp_bp = ""
-    if args.load_gerp_bp is True:
-        load_gerp_bp = "--load-gerp-bp"
-
-    vcf, _ = os.path.splitext(grabix_file)
-    chunk_steps = get_chunk_steps(grabix_file, args)
-    total_chunks = len(chunk_steps)
-    scheduler, queue, cores = get_ipython_args(args)
-    load_args = {"ped_file": ped_file,
-                 "anno_type": anno_type,
-                 "vcf": vcf,
-                 "grabix_file": grabix_file,
-                 "no_genotypes": no_genotypes,
-                 "no_load_genotypes": no_load_genotypes,
-                 "load_gerp_bp": load_gerp_bp}
-    chunk_dbs = view.map(load_chunk, chunk_steps, [load_args] * total_chunks)
-
-    print "Done loading variants in {0} chunks.".format(total_chunks)
-    return chunk_dbs
-
-def load_chunk(chunk_step, kwargs):
-    chunk_num, chunk = chunk_step
-    start, stop = chunk
-    args = combine_dicts(locals(), kwargs)
-    gemini_load = gemini_pipe_load_cmd().format(**args)
-    subprocess.check_call(gemini_load, shell=True)
-    chunk_db = args["vcf"] + ".chunk" + str(chunk_num) + ".db"
-    return chunk_db
-
-def wait_until_finished(procs):
-    [p.wait() for p in procs]
-
-def cleanup_temp_db_files(chunk_dbs):
-    for chunk_db in chunk_dbs:
-        os.remove(chunk_db)
-
-def gemini_pipe_load_cmd():
-    grabix_cmd = "grabix grab {grabix_file} {start} {stop}"
-    gemini_load_cmd = ("gemini load_chunk -v - {anno_type} {ped_file}"
-                       " {no_genotypes} {no_load_genotypes} {no_genotypes}"
-                       " {load_gerp_bp}"
-                       " -o {start} {vcf}.chunk{chunk_num}.db")
-    return " | ".join([grabix_cmd, gemini_load_cmd])
-
-def get_chunk_steps(grabix_file, args):
-    index_file = grabix_index(grabix_file)
-    num_lines = get_num_lines(index_file)
-    chunk_size = int(num_lines) / int(args.cores)
-    print "Breaking {0} into {1} chunks.".format(grabix_file, args.cores)
-
-    starts = []
-    stops = []
-    for chunk in range(0, int(args.cores)):
-        start = (chunk * chunk_size) + 1
-        stop  = start + chunk_size - 1
-        # make sure the last chunk covers the remaining lines
-        if chunk >= (args.cores - 1) and stop < num_lines:
-            stop = num_lines
-        starts.append(start)
-        stops.append(stop)
-    return list(enumerate(zip(starts, stops)))
-
-def get_num_lines(index_file):
-    with open(index_file) as index_handle:
-        index_handle.next()
-        num_lines = int(index_handle.next().strip())
-    print "Loading %d variants." % (num_lines)
-    return num_lines
-
-def grabix_index(fname):
-    if not which("grabix"):
-        print_cmd_not_found_and_exit("grabix")
-    index_file = fname + ".gbi"
-    if file_exists(index_file):
-        return index_file
-    print "Indexing {0} with grabix.".format(fname)
-    subprocess.check_call("grabix index {fname}".format(fname=fname), shell=True)
-    return index_file
-
-def bgzip(fname):
-
-    if not which("bgzip"):
-        print_cmd_not_found_and_exit("bgzip")
-
-    if is_gz_file(fname):
-        return fname
-
-    vcf_time = os.path.getmtime(fname)
-    bgzip_file = fname + ".gz"
-    
-    if not file_exists(bgzip_file) or \
-       (file_exists(bgzip_file) and os.path.getmtime(bgzip_file) < vcf_time):
-        print "Bgzipping {0} into {1}.".format(fname, fname + ".gz")
-        subprocess.check_call("bgzip -c {fname} > \
-                              {fname}.gz".format(fname=fname),
-                              shell=True)
-    elif file_exists(bgzip_file) and os.path.getmtime(bgzip_file) > vcf_time:
-        print "Loading with existing bgzip ({0}) version of {1}.".format(fname + ".gz", fname)
-
-    return bgzip_file
-
-
-def is_gz_file(fname):
-    _, ext = os.path.splitext(fname)
-    if ext == ".gz":
-        return True
-    else:
-        return False
-
-def get_submit_command(args):
-    if args.lsf_queue:
-        return get_lsf_command(args.lsf_queue)
-    else:
-        return "{cmd}"
+def get_chrom_steps(chunk_steps, chrom_counts):
+    """
+    Group the chunks by chromosome, so that each chromosome is loaded into
+    its own shard from the chunks that hold its variants. Each chromosome's
+    variants must be contiguous in the VCF, so that they get a contiguous
+    range of variant_ids.
+    """
+    steps = []
+    counts = []
+    for (_, chunk), chroms in zip(chunk_steps, chrom_counts):
+        for chrom, count in chroms:
+            if steps and steps[-1][2] == chrom:
+                if steps[-1][1][-1] != chunk:
+                    steps[-1][1].append(chunk)
+                counts[-1] += count
+            elif chrom in [step[2] for step in steps]:
+                raise ChunkLoadError("the variants on %s are not contiguous. "
+                                     "--shard-by chrom requires a VCF that "
+                                     "is sorted by chromosome." % chrom)
+            else:
+                steps.append((len(steps), [chunk], chrom))
+                counts.append(count)
+    if not steps:
+        # no variants at all: load the (empty) VCF into a single shard.
+        steps = [(0, [chunk for _, chunk in chunk_steps], None)]
+        counts = [0]
+    print "Loading {0} chromosomes into separate shards.".format(len(steps))
+    return steps, counts
+
+def get_chunk_tasks(args, load_steps, counts, max_buffer_mb):
+    """
+    Build the arguments for loading each step with load_chunk_native.
+    """
+    offsets = [1 + sum(counts[:idx]) for idx in range(len(counts))]
+    print "Loading %d variants." % (sum(counts))
 
-def get_lsf_command(queue):
-    return "bsub -K -q %s {cmd}" % (queue)
+    chunk_args = copy.copy(args)
+    chunk_args.max_buffer_mb = max_buffer_mb
+    header = bgzf.read_header(args.vcf)
+    return [(chunk_num, chunks, chrom, offset, header, chunk_args)
+            for (chunk_num, chunks, chrom), offset in zip(load_steps, offsets)]
 
-def file_exists(fname):
-    """Check if a file exists and is non-empty.
+def get_finished_chunks(args, tasks):
+    """
+    When resuming, find the chunks that an earlier load of the same
+    VCF already finished. Returns their results and the tasks that
+    are left to do (which pick up from their own last checkpoint).
+    """
+    if not args.resume:
+        return [], tasks
+    finished = []
+    remaining = []
+    for task in tasks:
+        chunk_args = get_chunk_args(task)
+        state = {}
+        if os.path.exists(chunk_args.db):
+            conn = sqlite3.connect(chunk_args.db)
+            state = database.get_load_state(conn.cursor())
+            conn.close()
+        identity = get_load_identity(chunk_args)
+        if state.get('complete') and not state.get('shared_counts') and \
+                all(state.get(key) == value
+                    for key, value in identity.items()):
+            finished.append((task[0], chunk_args.db, state['num_records'],
+                             0.0, task[2], None))
+        else:
+            remaining.append(task)
+    print "Resuming: {0} of {1} chunks were already " \
+          "loaded.".format(len(finished), len(tasks))
+    return finished, remaining
+
+def report_chunk_time(result, num_done, num_chunks):
+    chunk_num, _, num_variants, elapsed, chrom, _ = result
+    if chrom is not None:
+        chunk_num = "{0} ({1})".format(chunk_num, chrom)
+    print "Loaded chunk {0} ({1} variants) in {2:.1f}s " \
+          "[{3} of {4} chunks done].".format(chunk_num, num_variants,
+                                              elapsed, num_done, num_chunks)
+
+def finish_chunks(results, profile=False):
+    """
+    Summarize the chunk load times and return the chunk databases in
+    the order of the VCF, as dicts with the path to each database under
+    'db' (and its chromosome under 'chrom', for chromosome shards).
+    Also returns the combined profile of the chunks if profile is True,
+    or else None.
+    """
+    results = sorted(results)
+    times = sorted(result[3] for result in results)
+    num_variants = sum(result[2] for result in results)
+    print "Done loading {0} variants in {1} chunks.".format(num_variants,
+                                                          len(results))
+    print "Chunk load times: fastest {0:.1f}s, median {1:.1f}s, " \
+          "slowest {2:.1f}s.".format(times[0], times[len(times) / 2],
+                                    times[-1])
+    chunks = []
+    for _, chunk_db, _, _, chrom, _ in results:
+        chunk = {'db': chunk_db}
+        if chrom is not None:
+            chunk['chrom'] = chrom
+        chunks.append(chunk)
+    profiler = None
+    if profile:
+        # chunks that were loaded before a --resume have no profile
+        profiler = StageProfiler.combine([result[5] for result in results
+                                          if result[5] is not None])
+    return chunks, profiler
+
+def run_pool(pool, func, tasks):
+    """
+    Map func over tasks with the pool, in order.
     """
-    return os.path.exists(fname) and os.path.getsize(fname) > 0
+    # a timeout keeps the wait interruptible by Ctrl-C
+    return pool.map_async(func, tasks, chunksize=1).get(sys.maxint)
 
-def which(program):
-    """ returns the path to an executable or None if it can't be found
-     http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
-     """
+def stop_pool(pool, args, results):
+    """
+    Kill the workers, keeping the chunk databases they wrote, which
+    are reported if any chunks (with results) had finished.
+    """
+    pool.terminate()
+    pool.join()
+    if results:
+        report_kept_chunks(args)
 
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+def report_kept_chunks(args):
+    print "The chunk databases loaded so far ({0}) were kept. Rerun the " \
+          "load with --resume to continue from them.".format(
+              get_chunk_db_name(args, "*"))
 
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ["PATH"].split(os.pathsep):
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
+def init_load_worker():
+    """
+    Open the annotation files once in each worker process (or
+    cluster engine), rather than sharing the parent's file handles.
+    """
+    global _annos_pid
+    if _annos_pid != os.getpid():
+        annotations.load_annos()
+        _annos_pid = os.getpid()
 
-    return None
+def get_chunk_db_name(args, chunk_num):
+    """
+    Chunks that are kept as the shards of a sharded database are named
+    after the database (manifest); otherwise, they're named after the VCF.
+    """
+    if args.no_merge:
+        base, _ = os.path.splitext(args.db)
+        return base + ".shard" + str(chunk_num) + ".db"
+    vcf = args.vcf
+    if bgzf.is_gz_file(vcf):
+        vcf, _ = os.path.splitext(vcf)
+    return vcf + ".chunk" + str(chunk_num) + ".db"
+
+def iter_chunk_variants(vcf, chunks, chrom=None):
+    """
+    Yield the variant (i.e., not header or blank) lines of a list
+    of chunks, optionally only those on one chromosome.
+    """
+    prefix = "" if chrom is None else chrom + "\t"
+    for start, end in chunks:
+        for line in bgzf.iter_lines(vcf, start, end):
+            if not line.startswith("#") and line.strip() and \
+                    line.startswith(prefix):
+                yield line
+
+def count_chunk_variants(task):
+    """
+    Count the variants in a chunk, by chromosome. Returns a list of
+    [chrom, count] pairs in the order in which they appear in the chunk.
+    """
+    vcf, chunk = task
+    try:
+        chroms = []
+        for line in iter_chunk_variants(vcf, [chunk]):
+            chrom = line[:line.find("\t")]
+            if chroms and chroms[-1][0] == chrom:
+                chroms[-1][1] += 1
+            else:
+                chroms.append([chrom, 1])
+        return chroms
+    except Exception:
+        raise ChunkLoadError("counting variants in chunk %s failed:\n%s"
+                             % (str(chunk), traceback.format_exc()))
+
+def get_chunk_args(task):
+    """
+    The load options for one chunk: its own database,
+    starting variant_id and place in the VCF.
+    """
+    chunk_num, chunks, chrom, offset, header, args = task
+    args = copy.copy(args)
+    args.db = get_chunk_db_name(args, chunk_num)
+    args.offset = offset
+    args.chunk = [chunks, chrom]
+    return args
+
+def load_chunk_native(task):
+    """
+    Load the variants in one chunk of the VCF into a chunk database.
+    Errors are re-raised as ChunkLoadErrors so that they make it
+    back to the parent process.
+    """
+    chunk_num, chunks, chrom, offset, header, args = task
+    args = get_chunk_args(task)
+    start_time = time.time()
+    try:
+        init_load_worker()
+        lines = itertools.chain(header,
+                                iter_chunk_variants(args.vcf, chunks, chrom))
+        gemini_loader = GeminiLoader(args, vcf_handle=lines)
+        gemini_loader.store_resources()
+        gemini_loader.store_version()
+        gemini_loader.populate_from_vcf()
+        if not args.no_genotypes and not args.no_load_genotypes:
+            gemini_loader.store_sample_gt_counts()
+        # shards are queried as they are, so they need their own indices
+        if args.no_merge:
+            timed(gemini_loader.profiler, "indices",
+                  database.create_indices)(gemini_loader.c, args.indexes)
+        gemini_loader.mark_load_complete()
+        database.close_and_commit(gemini_loader.c, gemini_loader.conn)
+        if args.no_merge and args.vacuum:
+            database.vacuum(gemini_loader.c)
+        gemini_loader.conn.close()
+    except SystemExit as e:
+        raise ChunkLoadError("chunk %d failed: %s" % (chunk_num, e.code))
+    except Exception:
+        raise ChunkLoadError("chunk %d failed:\n%s"
+                             % (chunk_num, traceback.format_exc()))
+    report_peak_memory()
+    profile = None
+    if gemini_loader.profiler is not None:
+        gemini_loader.profiler.peak_memory_mb = get_peak_memory_mb()
+        profile = gemini_loader.profiler.to_dict()
+    return (chunk_num, args.db, gemini_loader.counter,
+            time.time() - start_time, chrom, profile)
 
-def combine_dicts(d1, d2):
-    return dict(d1.items() + d2.items())
+def cleanup_temp_db_files(chunk_dbs):
+    for chunk_db in chunk_dbs:
+        os.remove(chunk_db)
 
 def get_ipython_args(args):
     if args.lsf_queue:
@@ -332,11 +519,6 @@ def get_ipython_args(args):
     else:
         raise ValueError("ipython argument parsing failed for some reason.")
 
-def print_cmd_not_found_and_exit(cmd):
-    sys.stderr.write("Cannot find {cmd}, install it or put it in your "
-                     "path.".format(cmd=cmd))
-    exit(1)
-
 def use_scheduler(args):
     if any([args.lsf_queue, args.sge_queue, args.torque_queue]):
         return True
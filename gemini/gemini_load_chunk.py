@@ -3,9 +3,14 @@
 # native Python imports
 import os.path
 import sys
+import gzip
+import hashlib
+import json
+import resource
 import sqlite3
+import time
 import numpy as np
-from itertools import repeat
+from itertools import repeat, islice
 
 # third-party imports
 import cyvcf as vcf
@@ -15,12 +20,30 @@ import version
 from ped import get_ped_fields, default_ped_fields
 import infotag
 import database
+from genotypes import GenotypeParser, MISSING_GENOTYPE, spread
 import annotations
 import func_impact
 import severe_impact
 import popgen
+import shards
+from profiler import StageProfiler, timed, timed_module
 from gemini_constants import *
-from compression import pack_blob
+from compression import pack_blob, unpack_genotype_blob
+
+# rough in-memory cost (bytes) of a buffered row beyond its BLOBs,
+# i.e., the row list itself and the Python objects it refers to.
+VARIANT_ROW_OVERHEAD = 2048
+IMPACT_ROW_OVERHEAD = 768
+# rough size of the compressed genotype BLOBs, per sample, used
+# to guess the buffer capacity before any variants have been seen.
+BLOB_BYTES_PER_SAMPLE = 4
+# the positions of the genotype BLOBs in a variants row
+GT_BLOB_COLUMNS = range(12, 19)
+# the genotype BLOB columns, in the same order
+GT_BLOB_NAMES = ['gts', 'gt_types', 'gt_phases', 'gt_depths',
+                 'gt_ref_depths', 'gt_alt_depths', 'gt_quals']
+# the number of variants re-encoded at a time when samples are appended
+WIDEN_BATCH_SIZE = 10000
 
 
 class GeminiLoader(object):
@@ -28,26 +51,54 @@ class GeminiLoader(object):
     Object for creating and populating a gemini
     database and auxillary data files.
     """
-    def __init__(self, args, buffer_size=10000):
+    def __init__(self, args, buffer_size=10000, vcf_handle=None):
+        """
+        vcf_handle optionally supplies the lines of the VCF (header
+        included) in place of reading args.vcf.
+        """
         self.args = args
-
-        # create the gemini database
-        self._create_db()
+        self.appending = getattr(self.args, 'append', False)
+
+        # pick up where an earlier load of this database left off, or
+        # else create the gemini database (or open it to append to it)
+        self.load_state = None
+        if getattr(self.args, 'resume', False):
+            self.load_state = self._open_db_to_resume()
+        self.resumed = self.load_state is not None
+        if not self.resumed:
+            if self.appending:
+                self._open_db_to_append()
+            else:
+                self._create_db()
         # create a reader for the VCF file
-        self.vcf_reader = self._get_vcf_reader()
+        self.vcf_reader = self._get_vcf_reader(vcf_handle)
         # load sample information
 
+        # where each VCF sample goes in the genotype arrays, when
+        # that isn't simply the order of the samples in the VCF
+        self.sample_positions = None
         if not self.args.no_genotypes and not self.args.no_load_genotypes:
             # load the sample info from the VCF file.
-            self._prepare_samples()
+            if self.appending:
+                self._prepare_appended_samples()
+            else:
+                self._prepare_samples()
             # initialize genotype counts for each sample
             self._init_sample_gt_counts()
+            if self.resumed or self.appending:
+                self._restore_sample_gt_counts()
             self.num_samples = len(self.samples)
+            # parse the sample columns straight into numpy arrays
+            self.gt_parser = GenotypeParser(len(self.vcf_reader.samples))
         else:
             self.num_samples = 0
+            self.gt_parser = None
 
         self.buffer_size = buffer_size
+        self._set_buffer_budget()
         self._get_anno_version()
+        # compile the INFO column lookups once for this VCF
+        self.info_extractor = infotag.InfoExtractor(self.vcf_reader.infos)
 
         if self.args.anno_type == "VEP":
             if not self._is_proper_vep_input():
@@ -55,15 +106,59 @@ class GeminiLoader(object):
                         "\nhttp://gemini.readthedocs.org/en/latest/content/functional_annotation.html#stepwise-installation-and-usage-of-vep"
                 sys.exit(error)
 
+        self.profiler = None
+        if getattr(self.args, 'profile', False):
+            self.profiler = StageProfiler()
+        self._bind_stages()
+
+    def _bind_stages(self):
+        """
+        Look up the functions that each variant goes through. When
+        profiling, each is timed under its stage of the load.
+        """
+        p = self.profiler
+        self._annos = timed_module(p, annotations, "annotation: ")
+        self._parse_site = timed(p, "parse VCF sites", self.vcf_reader.parse)
+        if self.gt_parser is not None:
+            self._parse_genotypes = timed(p, "parse genotypes",
+                                          self.gt_parser.parse)
+        self._get_hwe_likelihood = timed(p, "genotype statistics",
+                                         popgen.get_hwe_likelihood)
+        self._interpret_impact = timed(p, "impacts",
+                                       func_impact.interpret_impact)
+        self._interpret_severe_impact = \
+            timed(p, "impacts", severe_impact.interpret_severe_impact)
+        self._extract_info = timed(p, "INFO fields",
+                                   self.info_extractor.extract)
+        self._pack_blob = timed(p, "pack genotype BLOBs", pack_blob)
+        self._timed_flush = timed(p, "database writes", self._flush_buffers)
+
+    @property
+    def load_complete(self):
+        """
+        Did the load that we are resuming already finish?
+        """
+        return self.resumed and self.load_state['complete']
+
     def store_resources(self):
         """Create table of annotation resources used in this gemini database.
         """
-        database.insert_resources(self.c, annotations.get_resources())
+        # a resumed load stored them when it started, and an
+        # appended load uses those of the existing database
+        if not self.resumed and not self.appending:
+            database.insert_resources(self.c, annotations.get_resources())
 
     def store_version(self):
         """Create table documenting which gemini version was used for this db.
         """
-        database.insert_version(self.c, version.__version__)
+        if not self.resumed and not self.appending:
+            database.insert_version(self.c, version.__version__)
+
+    def mark_load_complete(self):
+        """
+        Record that the load finished, once everything has been stored.
+        """
+        database.set_load_state(self.c, {'complete': True})
 
     def _get_vid(self):
         if hasattr(self.args, 'offset'):
@@ -72,43 +167,110 @@ class GeminiLoader(object):
             v_id = 1
         return v_id
 
+    def _set_buffer_budget(self):
+        """
+        Use --max-buffer-mb (if given) to cap the memory held by the
+        variant buffers, rather than a fixed number of variants.
+        """
+        self.max_buffer_bytes = None
+        max_buffer_mb = getattr(self.args, 'max_buffer_mb', None)
+        if max_buffer_mb is None:
+            return
+        if max_buffer_mb <= 0:
+            sys.exit("ERROR: --max-buffer-mb must be greater than 0.\n")
+        self.max_buffer_bytes = int(max_buffer_mb * 1024 * 1024)
+        est_row_bytes = VARIANT_ROW_OVERHEAD + \
+            BLOB_BYTES_PER_SAMPLE * self.num_samples
+        sys.stderr.write("pid " + str(os.getpid()) + ": buffering at most " +
+                         str(max_buffer_mb) + " MB (~" +
+                         str(max(1, self.max_buffer_bytes / est_row_bytes)) +
+                         " variants) between database writes.\n")
+
+    def _row_bytes(self, variant, variant_impacts):
+        """
+        Estimate the memory held by a buffered variant and its impacts
+        from the actual size of its genotype BLOBs.
+        """
+        blob_bytes = 0
+        for idx in GT_BLOB_COLUMNS:
+            if variant[idx] is not None:
+                blob_bytes += len(variant[idx])
+        return VARIANT_ROW_OVERHEAD + blob_bytes + \
+            IMPACT_ROW_OVERHEAD * len(variant_impacts)
+
+    def _flush_buffers(self):
+        """
+        Insert the buffered variants and impacts into the DB, and record
+        our progress, in a single transaction.
+        """
+        self.c.execute("BEGIN TRANSACTION")
+        database.insert_batch(self.c, self.var_buffer,
+                              self.var_impacts_buffer)
+        self._checkpoint()
+        self.c.execute("END")
+        # reset for the next batch
+        self.var_buffer = []
+        self.var_impacts_buffer = []
+
+    def _checkpoint(self):
+        """
+        Record the last variant stored and the genotype counts so far,
+        so that an interrupted load can be resumed from this point.
+        """
+        if self.gt_parser is not None:
+            self._write_sample_gt_counts()
+        database.set_load_state(self.c, {'last_variant_id': self.v_id - 1,
+                                         'num_records': self.counter})
+
     def populate_from_vcf(self):
         """
         """
         self.v_id = self._get_vid()
         self.counter = 0
+        if self.resumed:
+            # skip the records that were loaded before
+            self.v_id = self.load_state['last_variant_id'] + 1
+            self.counter = self.load_state['num_records']
+            sys.stderr.write("pid " + str(os.getpid()) + ": resuming after " +
+                             str(self.counter) + " variants.\n")
         self.var_buffer = []
         self.var_impacts_buffer = []
         buffer_count = 0
+        buffer_bytes = 0
+        start_time = time.time()
+        start_counter = self.counter
 
         # process and load each variant in the VCF file
-        for var in self.vcf_reader:
-            (variant, variant_impacts) = self._prepare_variation(var)
+        for (var, genotypes) in self._iter_records(skip=self.counter):
+            (variant, variant_impacts) = \
+                self._prepare_variation(var, genotypes)
             # add the core variant info to the variant buffer
             self.var_buffer.append(variant)
             # add each of the impact for this variant (1 per gene/transcript)
             for var_impact in variant_impacts:
                 self.var_impacts_buffer.append(var_impact)
+            self.v_id += 1
+            self.counter += 1
 
             buffer_count += 1
+            if self.max_buffer_bytes is not None:
+                buffer_bytes += self._row_bytes(variant, variant_impacts)
+                buffer_full = buffer_bytes >= self.max_buffer_bytes
+            else:
+                buffer_full = buffer_count >= self.buffer_size
             # buffer full - time to insert into DB
-            if buffer_count >= self.buffer_size:
+            if buffer_full:
                 sys.stderr.write("pid " + str(os.getpid()) + ": " +
                                  str(self.counter) + " variants processed.\n")
-                database.insert_variation(self.c, self.var_buffer)
-                database.insert_variation_impacts(self.c,
-                                                  self.var_impacts_buffer)
-                # binary.genotypes.append(var_buffer)
-                # reset for the next batch
-                self.var_buffer = []
-                self.var_impacts_buffer = []
+                self._timed_flush()
                 buffer_count = 0
-            self.v_id += 1
-            self.counter += 1
+                buffer_bytes = 0
         # final load to the database
+        self._timed_flush()
         self.v_id -= 1
-        database.insert_variation(self.c, self.var_buffer)
-        database.insert_variation_impacts(self.c, self.var_impacts_buffer)
+        if self.profiler is not None:
+            self.profiler.num_variants = self.counter - start_counter
+            self.profiler.elapsed = time.time() - start_time
         sys.stderr.write("pid " + str(os.getpid()) + ": " +
                          str(self.counter) + " variants processed.\n")
 
@@ -117,21 +279,61 @@ class GeminiLoader(object):
         Create the db table indicies and close up
         db connection
         """
-        # index our tables for speed
-        database.create_indices(self.c)
+        # index our tables for speed. the indices of a database that we
+        # appended to already exist and were updated with each insert,
+        # but the appended variants must be binned.
+        if not self.appending:
+            database.create_indices(self.c,
+                                    getattr(self.args, 'indexes', 'default'))
+        else:
+            database.fill_variant_bins(self.c)
+            database.fill_gene_variants(self.c)
+            database.create_index(self.c, 'varbin_chr_bin_idx')
+            database.create_index(self.c, 'genevar_gene_idx')
         # commit data and close up
         database.close_and_commit(self.c, self.conn)
 
-    def _get_vcf_reader(self):
+    def _get_vcf_reader(self, vcf_handle=None):
+        # we keep our own handle on the VCF so that we can read the
+        # raw records once the reader has consumed the header.
+        # the VCF lines were handed to us
+        if vcf_handle is not None:
+            self.vcf_handle = vcf_handle
         # the VCF is a proper file
-        if self.args.vcf != "-":
+        elif self.args.vcf != "-":
             if self.args.vcf.endswith(".gz"):
-                return vcf.VCFReader(open(self.args.vcf), 'rb', compressed=True)
+                self.vcf_handle = gzip.GzipFile(self.args.vcf, 'rb')
             else:
-                return vcf.VCFReader(open(self.args.vcf), 'rb')
+                self.vcf_handle = open(self.args.vcf)
         # the VCF is being passed in via STDIN
         else:
-            return vcf.VCFReader(sys.stdin, 'rb')
+            self.vcf_handle = sys.stdin
+        return vcf.VCFReader(self.vcf_handle, 'rb')
+
+    def _iter_records(self, skip=0):
+        """
+        Yield a (var, genotypes) tuple for each record in the VCF,
+        after skipping the first `skip` records unparsed.
+
+        Only the site-level columns of each line are handed to cyvcf.
+        When genotypes are being loaded, the sample columns are parsed
+        straight into numpy arrays by a GenotypeParser; otherwise
+        genotypes is None.
+        """
+        parse_site = self._parse_site
+        for line in islice(self.vcf_handle, skip, None):
+            fields = line.rstrip("\r\n").split("\t", 9)
+            var = parse_site("\t".join(fields[:8]))
+            genotypes = None
+            if self.gt_parser is not None:
+                format = fields[8] if len(fields) > 8 else None
+                samples = fields[9] if len(fields) > 9 else ""
+                genotypes = self._parse_genotypes(format, samples,
+                                                  var.alleles)
+                if self.sample_positions is not None:
+                    genotypes = genotypes.spread(self.sample_positions,
+                                                 self.num_samples)
+            yield var, genotypes
 
     def _get_anno_version(self):
         """
@@ -186,19 +388,119 @@ class GeminiLoader(object):
         # open up a new database
         if os.path.exists(self.args.db):
             os.remove(self.args.db)
+        self._connect(new_db=True)
+        # create the gemini database tables for the new DB
+        database.create_tables(self.c)
+        database.create_sample_table(self.c, self.args)
+        # record what is being loaded, so that the load can be resumed
+        state = get_load_identity(self.args)
+        state.update({'last_variant_id': self._get_vid() - 1,
+                      'num_records': 0, 'complete': False})
+        database.set_load_state(self.c, state)
+
+    def _connect(self, new_db=False):
         self.conn = sqlite3.connect(self.args.db)
         self.conn.isolation_level = None
         self.c = self.conn.cursor()
-        self.c.execute('PRAGMA synchronous = OFF')
-        self.c.execute('PRAGMA journal_mode=MEMORY')
-        # create the gemini database tables for the new DB
+        database.set_load_pragmas(self.c, new_db)
+        # the journal is kept on disk so that a load that is killed
+        # part way through a write can be resumed.
+        self.c.execute('PRAGMA journal_mode=DELETE')
+
+    def _open_db_to_resume(self):
+        """
+        Reopen the database of an earlier load of the same VCF, with the
+        same annotations and options, and throw away anything stored after
+        its last checkpoint. Returns the recorded load state, or None if
+        there is no earlier load to resume.
+        """
+        if self.args.vcf == "-":
+            sys.exit("ERROR: a load from STDIN cannot be resumed.\n")
+        if not os.path.exists(self.args.db):
+            return None
+        self._connect()
+        state = database.get_load_state(self.c)
+        if self.appending:
+            # the appended variants were numbered after those already
+            # in the database when the append started
+            self.args.offset = state.get('first_variant_id', 1)
+        identity = get_load_identity(self.args)
+        if any(state.get(key) != value for key, value in identity.items()) \
+                or state.get('shared_counts'):
+            self.conn.close()
+            # a chunk of a parallel load that no longer matches the chunks
+            # of the VCF, or a shard whose genotype counts were replaced
+            # with the totals across the shards, is simply loaded again.
+            # likewise, a new append starts once the last load finished.
+            if identity['chunk'] is not None or \
+                    (self.appending and state.get('complete')):
+                return None
+            if not state:
+                sys.exit("ERROR: %s has no record of an earlier load "
+                         "to resume.\n" % self.args.db)
+            sys.exit("ERROR: cannot resume loading %s: the VCF, annotations "
+                     "or load options have changed since the load "
+                     "started.\n" % self.args.db)
+        if not state['complete']:
+            self.c.execute("BEGIN TRANSACTION")
+            self.c.execute("DELETE FROM variants WHERE variant_id > ?",
+                           (state['last_variant_id'], ))
+            self.c.execute("DELETE FROM variant_impacts WHERE variant_id > ?",
+                           (state['last_variant_id'], ))
+            self.c.execute("DELETE FROM variant_bins WHERE variant_id > ?",
+                           (state['last_variant_id'], ))
+            self.c.execute("DELETE FROM gene_variants WHERE variant_id > ?",
+                           (state['last_variant_id'], ))
+            self.c.execute("END")
+        return state
+
+    def _open_db_to_append(self):
+        """
+        Open an existing gemini database to append the variants of the
+        VCF to it, numbering them after the variants already there.
+        """
+        if not os.path.exists(self.args.db):
+            sys.exit("ERROR: cannot append to %s: no such database.\n"
+                     % self.args.db)
+        if shards.is_manifest(self.args.db):
+            sys.exit("ERROR: cannot append to the sharded database %s.\n"
+                     % self.args.db)
+        self._connect()
+        state = database.get_load_state(self.c)
+        if state and not state.get('complete'):
+            sys.exit("ERROR: cannot append to %s until its load has "
+                     "finished.\n" % self.args.db)
+        # the new variants must be annotated just like the old ones
+        self.c.execute("select name, resource from resources")
+        resources = [tuple(row) for row in self.c]
+        if sorted(resources) != sorted(annotations.get_resources()):
+            sys.exit("ERROR: cannot append to %s: it was loaded with "
+                     "different annotation files.\n" % self.args.db)
+        self.c.execute("select count(*) from samples")
+        has_samples = self.c.fetchone()[0] > 0
+        loads_genotypes = not self.args.no_genotypes and \
+            not self.args.no_load_genotypes
+        if has_samples != loads_genotypes:
+            sys.exit("ERROR: cannot append to %s: genotypes must be loaded "
+                     "for both or neither of the VCFs.\n" % self.args.db)
+
+        # a database made by an older gemini may lack some of our tables
         database.create_tables(self.c)
-        database.create_sample_table(self.c, self.args)
+        self.c.execute("select max(variant_id) from variants")
+        self.args.offset = (self.c.fetchone()[0] or 0) + 1
+        # record what is being appended, so that the append can be resumed
+        state = get_load_identity(self.args)
+        state.update({'last_variant_id': self.args.offset - 1,
+                      'num_records': 0, 'complete': False})
+        self.c.execute("BEGIN TRANSACTION")
+        database.set_load_state(self.c, state)
+        self.c.execute("END")
 
-    def _prepare_variation(self, var):
+    def _prepare_variation(self, var, genotypes=None):
         """
         private method to collect metrics for
         a single variant (var) in a VCF file.
+        genotypes holds the parsed sample columns for var.
         """
         # these metric require that genotypes are present in the file
         call_rate = None
@@ -208,46 +510,46 @@ class GeminiLoader(object):
         hom_ref = het = hom_alt = unknown = None
 
         # only compute certain metrics if genoypes are available
-        if not self.args.no_genotypes and not self.args.no_load_genotypes:
-            hom_ref = var.num_hom_ref
-            hom_alt = var.num_hom_alt
-            het = var.num_het
-            unknown = var.num_unknown
-            call_rate = var.call_rate
-            aaf = var.aaf
+        if genotypes is not None:
+            hom_ref = genotypes.num_hom_ref
+            hom_alt = genotypes.num_hom_alt
+            het = genotypes.num_het
+            unknown = genotypes.num_unknown
+            call_rate = genotypes.call_rate
+            aaf = genotypes.aaf
             hwe_p_value, inbreeding_coeff = \
-                popgen.get_hwe_likelihood(hom_ref, het, hom_alt, aaf)
-            pi_hat = var.nucl_diversity
+                self._get_hwe_likelihood(hom_ref, het, hom_alt, aaf)
+            pi_hat = genotypes.nucl_diversity
         else:
             aaf = infotag.extract_aaf(var)
 
         ############################################################
         # collect annotations from gemini's custom annotation files
         ############################################################
-        pfam_domain = annotations.get_pfamA_domains(var)
-        cyto_band = annotations.get_cyto_info(var)
-        rs_ids = annotations.get_dbsnp_info(var)
-        clinvar_info = annotations.get_clinvar_info(var)
+        pfam_domain = self._annos.get_pfamA_domains(var)
+        cyto_band = self._annos.get_cyto_info(var)
+        rs_ids = self._annos.get_dbsnp_info(var)
+        clinvar_info = self._annos.get_clinvar_info(var)
         in_dbsnp = 0 if rs_ids is None else 1
-        rmsk_hits = annotations.get_rmsk_info(var)
-        in_cpg = annotations.get_cpg_island_info(var)
-        in_segdup = annotations.get_segdup_info(var)
-        is_conserved = annotations.get_conservation_info(var)
-        esp = annotations.get_esp_info(var)
-        thousandG = annotations.get_1000G_info(var)
-        recomb_rate = annotations.get_recomb_info(var)
-        gms = annotations.get_gms(var)
-        grc = annotations.get_grc(var)
-        in_cse = annotations.get_cse(var)
-        encode_tfbs = annotations.get_encode_tfbs(var)
-        encode_dnaseI = annotations.get_encode_dnase_clusters(var)
-        encode_cons_seg = annotations.get_encode_consensus_segs(var)
-        gerp_el = annotations.get_gerp_elements(var)
+        rmsk_hits = self._annos.get_rmsk_info(var)
+        in_cpg = self._annos.get_cpg_island_info(var)
+        in_segdup = self._annos.get_segdup_info(var)
+        is_conserved = self._annos.get_conservation_info(var)
+        esp = self._annos.get_esp_info(var)
+        thousandG = self._annos.get_1000G_info(var)
+        recomb_rate = self._annos.get_recomb_info(var)
+        gms = self._annos.get_gms(var)
+        grc = self._annos.get_grc(var)
+        in_cse = self._annos.get_cse(var)
+        encode_tfbs = self._annos.get_encode_tfbs(var)
+        encode_dnaseI = self._annos.get_encode_dnase_clusters(var)
+        encode_cons_seg = self._annos.get_encode_consensus_segs(var)
+        gerp_el = self._annos.get_gerp_elements(var)
 
         # grab the GERP score for this variant if asked.
         gerp_bp = None
         if self.args.load_gerp_bp is True:
-            gerp_bp = annotations.get_gerp_bp(var)
+            gerp_bp = self._annos.get_gerp_bp(var)
 
         # impact is a list of impacts for this variant
         impacts = None
@@ -260,9 +562,8 @@ class GeminiLoader(object):
         polyphen_pred = polyphen_score = sift_pred = sift_score = anno_id = None
 
         if self.args.anno_type is not None:
-            impacts = func_impact.interpret_impact(self.args, var)
-            severe_impacts = \
-                severe_impact.interpret_severe_impact(self.args, var)
+            impacts = self._interpret_impact(self.args, var)
+            severe_impacts = self._interpret_severe_impact(self.args, var)
             if severe_impacts:
                 gene = severe_impacts.gene
                 transcript = severe_impacts.transcript
@@ -297,14 +598,14 @@ class GeminiLoader(object):
         # build up numpy arrays for the genotype information.
         # these arrays will be pickled-to-binary, compressed,
         # and loaded as SqlLite BLOB values (see compression.pack_blob)
-        if not self.args.no_genotypes and not self.args.no_load_genotypes:
-            gt_bases = np.array(var.gt_bases, np.str)  # 'A/G', './.'
-            gt_types = np.array(var.gt_types, np.int8)  # -1, 0, 1, 2
-            gt_phases = np.array(var.gt_phases, np.bool)  # T F F
-            gt_depths = np.array(var.gt_depths, np.int32)  # 10 37 0
-            gt_ref_depths = np.array(var.gt_ref_depths, np.int32)  # 2 21 0 -1
-            gt_alt_depths = np.array(var.gt_alt_depths, np.int32)  # 8 16 0 -1
-            gt_quals = np.array(var.gt_quals, np.float32)  # 10.78 22 99 -1
+        if genotypes is not None:
+            gt_bases = genotypes.gt_bases  # 'A/G', './.'
+            gt_types = genotypes.gt_types  # -1, 0, 1, 2
+            gt_phases = genotypes.gt_phases  # T F F
+            gt_depths = genotypes.gt_depths  # 10 37 0
+            gt_ref_depths = genotypes.gt_ref_depths  # 2 21 0 -1
+            gt_alt_depths = genotypes.gt_alt_depths  # 8 16 0 -1
+            gt_quals = genotypes.gt_quals  # 10.78 22 99 -1
 
             # tally the genotypes
             self._update_sample_gt_counts(gt_types)
@@ -339,10 +640,10 @@ class GeminiLoader(object):
         variant = [chrom, var.start, var.end,
                    vcf_id, self.v_id, anno_id, var.REF, ','.join(var.ALT),
                    var.QUAL, filter, var.var_type,
-                   var.var_subtype, pack_blob(gt_bases), pack_blob(gt_types),
-                   pack_blob(gt_phases), pack_blob(gt_depths),
-                   pack_blob(gt_ref_depths), pack_blob(gt_alt_depths),
-                   pack_blob(gt_quals),
+                   var.var_subtype, self._pack_blob(gt_bases),
+                   self._pack_blob(gt_types), self._pack_blob(gt_phases),
+                   self._pack_blob(gt_depths), self._pack_blob(gt_ref_depths),
+                   self._pack_blob(gt_alt_depths), self._pack_blob(gt_quals),
                    call_rate, in_dbsnp,
                    rs_ids,
                    clinvar_info.clinvar_in_omim,
@@ -363,33 +664,23 @@ class GeminiLoader(object):
                    recomb_rate, gene, transcript,
                    is_exonic, is_coding, is_lof, exon, codon_change,
                    aa_change, aa_length, biotype, consequence, effect_severity,
-                   polyphen_pred, polyphen_score, sift_pred, sift_score,
-                   infotag.get_ancestral_allele(var), infotag.get_rms_bq(var),
-                   infotag.get_cigar(var),
-                   infotag.get_depth(var), infotag.get_strand_bias(var),
-                   infotag.get_rms_map_qual(var), infotag.get_homopol_run(var),
-                   infotag.get_map_qual_zero(var),
-                   infotag.get_num_of_alleles(var),
-                   infotag.get_frac_dels(var),
-                   infotag.get_haplotype_score(var),
-                   infotag.get_quality_by_depth(var),
-                   infotag.get_allele_count(var), infotag.get_allele_bal(var),
-                   infotag.in_hm2(var), infotag.in_hm3(var),
-                   infotag.is_somatic(var),
-                   esp.found, esp.aaf_EA,
-                   esp.aaf_AA, esp.aaf_ALL, esp.exome_chip, thousandG.found,
-                   thousandG.aaf_AMR, thousandG.aaf_ASN, thousandG.aaf_AFR,
-                   thousandG.aaf_EUR, thousandG.aaf_ALL, grc,
-                   gms.illumina, gms.solid, gms.iontorrent, in_cse,
-                   encode_tfbs,
-                   encode_dnaseI.cell_count,
-                   encode_dnaseI.cell_list,
-                   encode_cons_seg.gm12878,
-                   encode_cons_seg.h1hesc,
-                   encode_cons_seg.helas3,
-                   encode_cons_seg.hepg2,
-                   encode_cons_seg.huvec,
-                   encode_cons_seg.k562]
+                   polyphen_pred, polyphen_score, sift_pred, sift_score]
+        # the INFO-derived columns (anc_allele ... is_somatic)
+        variant.extend(self._extract_info(var))
+        variant.extend([esp.found, esp.aaf_EA,
+                        esp.aaf_AA, esp.aaf_ALL, esp.exome_chip, thousandG.found,
+                        thousandG.aaf_AMR, thousandG.aaf_ASN, thousandG.aaf_AFR,
+                        thousandG.aaf_EUR, thousandG.aaf_ALL, grc,
+                        gms.illumina, gms.solid, gms.iontorrent, in_cse,
+                        encode_tfbs,
+                        encode_dnaseI.cell_count,
+                        encode_dnaseI.cell_list,
+                        encode_cons_seg.gm12878,
+                        encode_cons_seg.h1hesc,
+                        encode_cons_seg.helas3,
+                        encode_cons_seg.hepg2,
+                        encode_cons_seg.huvec,
+                        encode_cons_seg.k562])
         return variant, variant_impacts
 
     def _prepare_samples(self):
@@ -402,6 +693,17 @@ class GeminiLoader(object):
             for idx, sample in enumerate(self.samples):
                 self.sample_to_id[sample] = idx + 1
 
+        self._read_ped_file()
+        for sample in self.samples:
+            sample_list = self._get_sample_row(sample)
+            # a resumed load stored the samples when it started
+            if not self.resumed:
+                database.insert_sample(self.c, sample_list)
+
+    def _read_ped_file(self):
+        """
+        Read the PED file (if any) into self.ped_hash, keyed by sample.
+        """
         self.ped_hash = {}
         if self.args.ped_file is not None:
             header = get_ped_fields(self.args.ped_file)
@@ -412,21 +714,104 @@ class GeminiLoader(object):
                 linedict = dict(zip(header, line.split()))
                 self.ped_hash[fields[1]] = fields
 
-        sample_list = []
-        for sample in self.samples:
-            i = self.sample_to_id[sample]
-            if sample in self.ped_hash:
-                fields = self.ped_hash[sample]
-                sample_list = [i] + fields
-            elif len(self.ped_hash) > 0:
-                sys.exit("EXITING: sample %s found in the VCF but "
-                                 "not in the PED file.\n" % (sample))
-            else:
-                # if there is no ped file given, just fill in the name and
-                # sample_id and set the other required fields to None
-                sample_list = [i, None, sample]
-                sample_list += list(repeat(None, len(default_ped_fields) - 2))
-            database.insert_sample(self.c, sample_list)
+    def _get_sample_row(self, sample):
+        """
+        Return the row of the samples table for a sample.
+        """
+        i = self.sample_to_id[sample]
+        if sample in self.ped_hash:
+            fields = self.ped_hash[sample]
+            sample_list = [i] + fields
+        elif len(self.ped_hash) > 0:
+            sys.exit("EXITING: sample %s found in the VCF but "
+                             "not in the PED file.\n" % (sample))
+        else:
+            # if there is no ped file given, just fill in the name and
+            # sample_id and set the other required fields to None
+            sample_list = [i, None, sample]
+            sample_list += list(repeat(None, len(default_ped_fields) - 2))
+        return sample_list
+
+    def _prepare_appended_samples(self):
+        """
+        Match the samples of the VCF to those already in the database.
+        Samples new to the database are added after the existing ones, and
+        the stored genotypes are widened to include them.
+        """
+        self.c.execute("select sample_id, name from samples "
+                       "order by sample_id")
+        self.samples = [str(name) for sample_id, name in self.c]
+        self.sample_to_id = dict((sample, idx + 1)
+                                 for idx, sample in enumerate(self.samples))
+        vcf_samples = self.vcf_reader.samples
+        new_samples = [sample for sample in vcf_samples
+                       if sample not in self.sample_to_id]
+        if new_samples:
+            self._read_ped_file()
+            for sample in new_samples:
+                self.samples.append(sample)
+                self.sample_to_id[sample] = len(self.samples)
+            self._widen_stored_genotypes(new_samples)
+        if vcf_samples != self.samples:
+            self.sample_positions = np.array([self.sample_to_id[sample] - 1
+                                              for sample in vcf_samples])
+
+    def _widen_stored_genotypes(self, new_samples):
+        """
+        Add the new samples to the database, with no genotype call for any
+        of the variants already stored.
+
+        The genotype BLOBs of every stored variant are re-encoded once, a
+        batch of WIDEN_BATCH_SIZE variants at a time, by appending the
+        missing value of each array for the new samples.  The variant-level
+        tallies change only in num_unknown and call_rate, which are updated
+        with a single statement. It all happens in one transaction, so
+        either every variant is widened or none is.
+        """
+        num_samples = len(self.samples)
+        num_old = num_samples - len(new_samples)
+        sys.stderr.write("pid " + str(os.getpid()) + ": adding " +
+                         str(len(new_samples)) + " samples to the " +
+                         "genotypes of the existing variants.\n")
+        self.c.execute("select * from samples limit 1")
+        num_columns = len(self.c.description)
+        rows = [self._get_sample_row(sample) for sample in new_samples]
+        if any(len(row) != num_columns for row in rows):
+            sys.exit("ERROR: the PED file does not have the same columns "
+                     "as the samples already in %s.\n" % self.args.db)
+
+        self.c.execute("select max(variant_id) from variants")
+        max_vid = self.c.fetchone()[0] or 0
+        positions = np.arange(num_old)
+        select = "select variant_id, " + ", ".join(GT_BLOB_NAMES) + \
+            " from variants where variant_id between ? and ?"
+        update = "update variants set " + \
+            ", ".join(name + " = ?" for name in GT_BLOB_NAMES) + \
+            " where variant_id = ?"
+
+        self.c.execute("BEGIN TRANSACTION")
+        self.c.executemany("insert into samples values (%s)"
+                           % ",".join("?" * num_columns), rows)
+        for start in xrange(1, max_vid + 1, WIDEN_BATCH_SIZE):
+            self.c.execute(select, (start, start + WIDEN_BATCH_SIZE - 1))
+            widened = []
+            for row in self.c.fetchall():
+                blobs = [pack_blob(spread(unpack_genotype_blob(blob),
+                                          positions, num_samples, missing))
+                         for blob, missing in zip(row[1:], MISSING_GENOTYPE)]
+                widened.append(blobs + [row[0]])
+            self.c.executemany(update, widened)
+        self.c.execute("update variants set num_unknown = num_unknown + ?, "
+                       "call_rate = (num_hom_ref + num_het + num_hom_alt) "
+                       "* 1.0 / ?", (len(new_samples), num_samples))
+        # the new samples have no call at any of the stored variants
+        self.c.execute("select count(*) from variants")
+        num_variants = self.c.fetchone()[0]
+        self.c.executemany("insert into sample_genotype_counts "
+                           "values (?,0,0,0,?)",
+                           [(idx, num_variants)
+                            for idx in range(num_old, num_samples)])
+        self.c.execute("END")
 
     def _init_sample_gt_counts(self):
         """
@@ -442,27 +827,49 @@ class GeminiLoader(object):
         """
         self.sample_gt_counts = np.array(np.zeros((len(self.samples), 4)),
                                          dtype='uint32')
+        self.sample_idxs = np.arange(len(self.samples))
 
     def _update_sample_gt_counts(self, gt_types):
         """
         Update the count of each gt type for each sample
         """
-        for idx, gt_type in enumerate(gt_types):
-            self.sample_gt_counts[idx][gt_type] += 1
+        self.sample_gt_counts[self.sample_idxs, gt_types] += 1
+
+    def _restore_sample_gt_counts(self):
+        """
+        Restore the genotype counts as of the last checkpoint
+        of the load that we are resuming.
+        """
+        self.c.execute("""select sample_id, num_hom_ref, num_het, \
+                                 num_hom_alt, num_unknown \
+                          from sample_genotype_counts""")
+        for idx, hom_ref, het, hom_alt, unknown in self.c:
+            self.sample_gt_counts[idx, HOM_REF] = hom_ref
+            self.sample_gt_counts[idx, HET] = het
+            self.sample_gt_counts[idx, HOM_ALT] = hom_alt
+            self.sample_gt_counts[idx, UNKNOWN] = unknown
+
+    def _write_sample_gt_counts(self):
+        """
+        Replace the sample_genotype_counts with the current counts.
+        """
+        self.c.execute("delete from sample_genotype_counts")
+        self.c.executemany("""insert into sample_genotype_counts values \
+                            (?,?,?,?,?)""",
+                           [[idx,
+                             int(gt_counts[HOM_REF]),  # hom_ref
+                             int(gt_counts[HET]),  # het
+                             int(gt_counts[HOM_ALT]),  # hom_alt
+                             int(gt_counts[UNKNOWN])]  # missing
+                            for idx, gt_counts
+                            in enumerate(self.sample_gt_counts)])
 
     def store_sample_gt_counts(self):
         """
         Update the count of each gt type for each sample
         """
         self.c.execute("BEGIN TRANSACTION")
-        for idx, gt_counts in enumerate(self.sample_gt_counts):
-            self.c.execute("""insert into sample_genotype_counts values \
-                            (?,?,?,?,?)""",
-                           [idx,
-                            int(gt_counts[HOM_REF]),  # hom_ref
-                            int(gt_counts[HET]),  # het
-                            int(gt_counts[HOM_ALT]),  # hom_alt
-                            int(gt_counts[UNKNOWN])])  # missing
+        self._write_sample_gt_counts()
         self.c.execute("END")
 
 
@@ -488,3 +895,59 @@ def load(parser, args):
 
     if not args.no_genotypes and not args.no_load_genotypes:
         gemini_loader.store_sample_gt_counts()
+    gemini_loader.mark_load_complete()
+
+    report_peak_memory()
+
+
+def get_vcf_signature(vcf):
+    """
+    Identify the VCF file by its path, size and modification time.
+    """
+    if vcf == "-":
+        return [vcf, None, None]
+    stat = os.stat(vcf)
+    return [os.path.abspath(vcf), stat.st_size, stat.st_mtime]
+
+
+def get_config_hash(args):
+    """
+    Hash the settings that determine what is stored for each variant: the
+    gemini version, the annotation files and the relevant load options.
+    """
+    config = [version.__version__, annotations.get_resources(),
+              args.anno_type, args.ped_file, args.load_gerp_bp,
+              args.no_genotypes, args.no_load_genotypes]
+    return hashlib.md5(json.dumps(config)).hexdigest()
+
+
+def get_load_identity(args):
+    """
+    Describe what a load (or a chunk of a parallel load) is loading, so
+    that it can be resumed only if none of it has changed.
+    """
+    identity = {'vcf': get_vcf_signature(args.vcf),
+                'config_hash': get_config_hash(args),
+                'chunk': getattr(args, 'chunk', None),
+                'first_variant_id': int(getattr(args, 'offset', 1))}
+    # compare the values as they read back from the database
+    return json.loads(json.dumps(identity))
+
+
+def get_peak_memory_mb():
+    """
+    Return the peak resident memory (RSS) used by this process, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X, but kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024.0
+
+
+def report_peak_memory():
+    """
+    Report the peak resident memory (RSS) used by this process.
+    """
+    sys.stderr.write("pid " + str(os.getpid()) + ": peak memory usage " +
+                     "%.1f MB.\n" % get_peak_memory_mb())
@@ -9,7 +9,8 @@ import gemini_query
 import \
     gemini_region, gemini_stats, gemini_dump, \
     gemini_annotate, gemini_windower, \
-    gemini_browser, gemini_dbinfo, gemini_merge_chunks, gemini_update
+    gemini_browser, gemini_dbinfo, gemini_merge_chunks, gemini_update, \
+    gemini_benchmark
 import gemini.version
 
 import tool_compound_hets
@@ -53,6 +54,7 @@ def examples(parser, args):
     print "[region] - access variants in specific genomic regions:"
     print "   gemini region --reg chr1:100-200 my.db"
     print "   gemini region --gene TP53 my.db"
+    print "   gemini region --bed panel.bed my.db"
     print
 
     print "[tools] - there are also many specific tools available"
@@ -127,6 +129,67 @@ def main():
     parser_load.add_argument('--torque-queue',
                              dest='torque_queue',
                              help="Queue name to use for a Torque based scheduler")
+    parser_load.add_argument('--no-merge',
+                             dest='no_merge',
+                             action='store_true',
+                             help="With --cores, keep the chunk databases as the shards of a sharded database "
+                             "rather than merging them. db is then a manifest of the shards that can be queried directly.",
+                             default=False)
+    parser_load.add_argument('--shard-by',
+                             dest='shard_by',
+                             choices=['chrom'],
+                             default=None,
+                             help="Write one database shard per chromosome (implies --no-merge). "
+                             "The VCF must be sorted by chromosome.")
+    parser_load.add_argument('--max-buffer-mb',
+                             dest='max_buffer_mb',
+                             type=float,
+                             default=None,
+                             metavar='MB',
+                             help="Flush buffered variants to the database before they use more than this many MB of memory. Split evenly across --cores.")
+    parser_load.add_argument('--chunk-mb',
+                             dest='chunk_mb',
+                             type=float,
+                             default=None,
+                             metavar='MB',
+                             help="With --cores, cut the VCF into chunks of at least this many MB (default: 4), "
+                             "and at most 8 per core.")
+    parser_load.add_argument('--resume',
+                             dest='resume',
+                             action='store_true',
+                             help="Continue an interrupted load of the same VCF from its last checkpoint "
+                             "(or, with --cores, from the chunks that were finished) rather than starting over.",
+                             default=False)
+    parser_load.add_argument('--append',
+                             dest='append',
+                             action='store_true',
+                             help="Add the variants (and any new samples) of the VCF to the existing database "
+                             "rather than replacing it. The VCF must be annotated like the variants already loaded.",
+                             default=False)
+    parser_load.add_argument('--indexes',
+                             dest='indexes',
+                             choices=['minimal', 'default', 'all'],
+                             default='default',
+                             help="Which indices to build once the variants are loaded: minimal (chrom/start, gene "
+                             "and sample name), default, or all (default plus the variant_impacts indices).")
+    parser_load.add_argument('--vacuum',
+                             dest='vacuum',
+                             action='store_true',
+                             help="VACUUM the database once it is loaded, so that each table is stored contiguously. "
+                             "Needs as much free disk space as the database itself.",
+                             default=False)
+    parser_load.add_argument('--profile',
+                             dest='profile',
+                             action='store_true',
+                             help="Report the time spent in each stage of the load (parsing, each annotation, "
+                             "impacts, BLOB packing, database writes, ...), the variants loaded per second "
+                             "and the peak memory use.",
+                             default=False)
+    parser_load.add_argument('--profile-json',
+                             dest='profile_json',
+                             metavar='FILE',
+                             default=None,
+                             help="Also write the --profile report to FILE as JSON.")
 
     parser_load.set_defaults(func=gemini_load.load)
 
@@ -172,6 +235,12 @@ def main():
                                   action='store_true',
                                   help='Load GERP scores at base pair resolution. Slow. Off by default.',
                                   default=False)
+    parser_loadchunk.add_argument('--max-buffer-mb',
+                                  dest='max_buffer_mb',
+                                  type=float,
+                                  default=None,
+                                  metavar='MB',
+                                  help="Flush buffered variants to the database before they use more than this many MB of memory.")
     parser_loadchunk.set_defaults(func=gemini_load_chunk.load)
 
     #########################################
@@ -186,6 +255,11 @@ def main():
             nargs='*',
             dest='chunkdbs',
             action='append')
+    parser_mergechunks.add_argument('--indexes',
+            dest='indexes',
+            choices=['minimal', 'default', 'all'],
+            default='default',
+            help='Which indices to build on the merged database.')
 
     parser_mergechunks.set_defaults(func=gemini_merge_chunks.merge_chunks)
 
@@ -254,6 +328,64 @@ def main():
                               default=None,
                               help=('Restrict query to this region, '
                                     'e.g. chr1:10-20.'))
+    parser_query.add_argument('--profile',
+                              dest='profile',
+                              action='store_true',
+                              help=('Report the time spent in each stage of '
+                                    'the query and the number of rows it '
+                                    'scanned and returned.'),
+                              default=False)
+    parser_query.add_argument('--profile-json',
+                              dest='profile_json',
+                              metavar='FILE',
+                              help=('Also write the --profile report to '
+                                    'FILE as JSON.'),
+                              default=None)
+    parser_query.add_argument('--count',
+                              dest='count',
+                              action='store_true',
+                              help=('Report only the number of rows that '
+                                    'the query (and --gt-filter) returns.'),
+                              default=False)
+    parser_query.add_argument('--max-rows',
+                              dest='max_rows',
+                              metavar='INTEGER',
+                              type=int,
+                              help=('Report at most this many rows that '
+                                    'pass the --gt-filter (and sample '
+                                    'filters), stopping once they are '
+                                    'found. Unlike LIMIT, which applies '
+                                    'before them.'),
+                              default=None)
+    parser_query.add_argument('--page-size',
+                              dest='page_size',
+                              metavar='INTEGER',
+                              type=int,
+                              help=('Report one page of this many rows, '
+                                    'writing the token for the next page '
+                                    'to stderr.'),
+                              default=None)
+    parser_query.add_argument('--page-token',
+                              dest='page_token',
+                              metavar='STRING',
+                              help=('Report the page after the one that '
+                                    'gave this token (with --page-size).'),
+                              default=None)
+    parser_query.add_argument('--explain',
+                              dest='explain',
+                              action='store_true',
+                              help=('Rather than running the query, show '
+                                    'how SQLite would run it, estimate the '
+                                    'genotype BLOBs it would decompress and '
+                                    'suggest indices for the columns it '
+                                    'filters on.'),
+                              default=False)
+    parser_query.add_argument('--create-indexes',
+                              dest='create_indexes',
+                              action='store_true',
+                              help=('With --explain, also create the '
+                                    'suggested indices.'),
+                              default=False)
 
     parser_query.set_defaults(func=gemini_query.query)
 
@@ -313,6 +445,11 @@ def main():
             dest='gene',
             metavar='STRING',
             help='Specify a gene of interest')
+    parser_region.add_argument('--bed',
+            dest='bed',
+            metavar='FILE',
+            help='Report the variants in each region of a BED file, '
+                 'tagged with the names of the regions (4th column)')
     parser_region.add_argument('--header',
             dest='use_header',
             action='store_true',
@@ -327,6 +464,10 @@ def main():
             dest='filter',
             metavar='STRING',
             help='Restrictions to apply to variants (SQL syntax)')
+    parser_region.add_argument('--gt-filter',
+            dest='gt_filter',
+            metavar='STRING',
+            help='Restrictions to apply to genotype values')
     parser_region.add_argument('--format',
                               dest='format',
                               default='default',
@@ -729,6 +870,53 @@ def main():
     parser_update = subparsers.add_parser("update", help="Update gemini software and data files.")
     parser_update.set_defaults(func=gemini_update.release)
 
+    #########################################
+    # $ gemini benchmark
+    #########################################
+    parser_benchmark = subparsers.add_parser('benchmark',
+            help='Time gemini on synthetic data.')
+    parser_benchmark.add_argument('-n', '--variants', dest='num_variants',
+            type=int, default=10000, metavar='INTEGER',
+            help='The number of variants to simulate (default: 10000).')
+    parser_benchmark.add_argument('-m', '--samples', dest='num_samples',
+            type=int, default=90, metavar='INTEGER',
+            help='The number of samples to simulate, in trios '
+                 '(default: 90).')
+    parser_benchmark.add_argument('--min-aaf', dest='min_aaf',
+            type=float, default=0.01, metavar='FLOAT',
+            help='The lowest alternate allele frequency (default: 0.01).')
+    parser_benchmark.add_argument('--max-aaf', dest='max_aaf',
+            type=float, default=0.5, metavar='FLOAT',
+            help='The highest alternate allele frequency (default: 0.5).')
+    parser_benchmark.add_argument('-t', dest='anno_type',
+            default='snpEff', choices=['snpEff', 'VEP'],
+            help='Annotate the variants as snpEff or VEP would '
+                 '(default: snpEff).')
+    parser_benchmark.add_argument('--cores', dest='cores',
+            type=int, default=2, metavar='INTEGER',
+            help='The number of cores for the multicore load (default: 2).')
+    parser_benchmark.add_argument('--seed', dest='seed',
+            type=int, default=42, metavar='INTEGER',
+            help='The random seed for the synthetic data (default: 42).')
+    parser_benchmark.add_argument('--steps', dest='steps',
+            default=None, metavar='STRING',
+            help='A comma-separated list of the steps to time '
+                 '(default: all). Options are: '
+                 + ', '.join(gemini_benchmark.STEPS) + '. The steps '
+                 'after load_multicore query the database of the load '
+                 'step or, without it, the one that an earlier run '
+                 'left in --dir; they are skipped if there is neither.')
+    parser_benchmark.add_argument('--dir', dest='dir',
+            default=None, metavar='DIRECTORY',
+            help='Keep the synthetic data and databases in this '
+                 'directory (default: a temporary directory that is '
+                 'removed afterwards).')
+    parser_benchmark.add_argument('--history', dest='history',
+            default='gemini_benchmark.json', metavar='FILE',
+            help='The JSON file that each run\'s timings are added to '
+                 '(default: gemini_benchmark.json).')
+    parser_benchmark.set_defaults(func=gemini_benchmark.benchmark)
+
     #######################################################
     # parse the args and call the selected function
     #######################################################
@@ -736,7 +924,7 @@ def main():
 
     # make sure database is found if provided
     if len(sys.argv) > 2 and sys.argv[1] not in \
-       ["load", "merge_chunks", "load_chunk"]:
+       ["load", "merge_chunks", "load_chunk", "benchmark"]:
         if args.db is not None and not os.path.exists(args.db):
             sys.stderr.write("Requested GEMINI database (%s) not found. "
                              "Please confirm the provided filename.\n"
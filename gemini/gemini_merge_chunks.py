@@ -1,156 +1,170 @@
 #!/usr/bin/env python
 import sqlite3
 import os
+import sys
+import numpy as np
 import database as gemini_db
 import gemini_utils as util
 
+# SQLite's default limit on the number of attached databases
+MAX_ATTACHED = 10
 
-def append_variant_info(main_curr, chunk_db):
+
+def append_variant_info(main_curr, chunk):
     """
-    Append the variant and variant_info data from a chunk_db
-    to the main database.
+    Append the variant and variant_info data from an attached
+    chunk database to the main database.
     """
-
-    cmd = "attach ? as toMerge"
-    main_curr.execute(cmd, (chunk_db, ))
-
-    cmd = "INSERT INTO variants SELECT * FROM toMerge.variants"
+    cmd = "INSERT INTO main.variants SELECT * FROM %s.variants" % chunk
     main_curr.execute(cmd)
 
-    cmd = \
-        "INSERT INTO variant_impacts SELECT * FROM toMerge.variant_impacts"
-    main_curr.execute(cmd)
-    cmd = "detach toMerge"
+    cmd = "INSERT INTO main.variant_impacts \
+           SELECT * FROM %s.variant_impacts" % chunk
     main_curr.execute(cmd)
 
 
-def append_sample_genotype_counts(main_curr, chunk_db):
+def append_sample_info(main_curr, chunk):
     """
-    Append the sample_genotype_counts from a chunk_db
+    Append the sample info from an attached chunk database
     to the main database.
     """
-    cmd = "attach ? as toMerge"
-    main_curr.execute(cmd, (chunk_db, ))
-
-    cmd = "INSERT INTO sample_genotype_counts \
-           SELECT * FROM toMerge.sample_genotype_counts"
-    main_curr.execute(cmd)
-
-    cmd = "detach toMerge"
+    cmd = "INSERT INTO main.samples SELECT * FROM %s.samples" % chunk
     main_curr.execute(cmd)
 
 
-def append_sample_info(main_curr, chunk_db):
+def append_resource_info(main_curr, chunk):
     """
-    Append the sample info from a chunk_db
+    Append the resource info from an attached chunk database
     to the main database.
     """
-    cmd = "attach ? as toMerge"
-    main_curr.execute(cmd, (chunk_db, ))
-
-    cmd = "INSERT INTO samples SELECT * FROM toMerge.samples"
-    main_curr.execute(cmd)
-
-    cmd = "detach toMerge"
+    cmd = "INSERT INTO main.resources SELECT * FROM %s.resources" % chunk
     main_curr.execute(cmd)
 
 
-def append_resource_info(main_curr, chunk_db):
+def append_version_info(main_curr, chunk):
     """
-    Append the resource info from a chunk_db
+    Append the version info from an attached chunk database
     to the main database.
     """
-    cmd = "attach ? as toMerge"
-    main_curr.execute(cmd, (chunk_db, ))
-
-    cmd = "INSERT INTO resources SELECT * FROM toMerge.resources"
-    main_curr.execute(cmd)
-
-    cmd = "detach toMerge"
+    cmd = "INSERT INTO main.version SELECT * FROM %s.version" % chunk
     main_curr.execute(cmd)
 
 
-def append_version_info(main_curr, chunk_db):
+def create_sample_table(main_curr, chunk_db):
     """
-    Append the version info from a chunk_db
-    to the main database.
+    Create the samples table in the main database using the
+    table definition from a chunk database, as the columns
+    depend upon the PED file used to load the chunks.
     """
-    cmd = "attach ? as toMerge"
-    main_curr.execute(cmd, (chunk_db, ))
+    chunk_conn = sqlite3.connect(chunk_db)
+    chunk_curr = chunk_conn.cursor()
+    chunk_curr.execute("SELECT sql FROM sqlite_master \
+                        WHERE type = 'table' AND name = 'samples'")
+    main_curr.execute(chunk_curr.fetchone()[0])
+    chunk_conn.close()
 
-    cmd = "INSERT INTO version SELECT * FROM toMerge.version"
-    main_curr.execute(cmd)
 
-    cmd = "detach toMerge"
-    main_curr.execute(cmd)
-
-
-def update_sample_genotype_counts(main_curr, chunk_db):
+def sum_sample_genotype_counts(chunk_dbs):
     """
-    Update the main sample_genotype_counts table with the
-    counts observed in one of the chunked databases (chunk_db)
+    Sum the sample_genotype_counts of the chunk databases with numpy.
+    Returns the sample_ids and an array of their num_hom_ref, num_het,
+    num_hom_alt and num_unknown totals, or (None, None) if the chunks
+    have no genotype counts.
     """
-    curr_db_conn = sqlite3.connect(chunk_db)
-    curr_db_conn.isolation_level = None
-    curr_db_conn.row_factory = sqlite3.Row
-    curr_db_curr = curr_db_conn.cursor()
+    sample_ids = None
+    totals = None
+    for chunk_db in chunk_dbs:
+        chunk_conn = sqlite3.connect(chunk_db)
+        rows = chunk_conn.execute("SELECT sample_id, num_hom_ref, num_het, \
+                                          num_hom_alt, num_unknown \
+                                   FROM sample_genotype_counts \
+                                   ORDER BY sample_id").fetchall()
+        chunk_conn.close()
+        if not rows:
+            continue
+        counts = np.array(rows, dtype=np.int64)
+        if totals is None:
+            sample_ids = counts[:, 0]
+            totals = counts[:, 1:]
+        elif np.array_equal(sample_ids, counts[:, 0]):
+            totals += counts[:, 1:]
+        else:
+            sys.exit("ERROR: %s does not have the same samples "
+                     "as the other chunks." % chunk_db)
+    return sample_ids, totals
 
-    cmd = "SELECT sample_id, num_hom_ref, \
-                  num_het, num_hom_alt, \
-                  num_unknown FROM sample_genotype_counts"
-    curr_db_curr.execute(cmd)
-    for row in curr_db_curr:
-        main_curr.execute("""UPDATE sample_genotype_counts
-                          SET num_hom_ref = num_hom_ref + ?,
-                              num_het = num_het + ?,
-                              num_hom_alt = num_hom_alt + ?,
-                              num_unknown = num_unknown + ?
-                          WHERE sample_id= ? """,
-                          (row['num_hom_ref'],
-                           row['num_het'],
-                           row['num_hom_alt'],
-                           row['num_unknown'],
-                           row['sample_id']))
-    curr_db_curr.close()
 
+def store_sample_genotype_counts(curr, sample_ids, totals):
+    """
+    Write the summed genotype counts into the
+    (empty) sample_genotype_counts table.
+    """
+    if totals is None:
+        return
+    curr.executemany("INSERT INTO sample_genotype_counts VALUES (?,?,?,?,?)",
+                     np.column_stack((sample_ids, totals)).tolist())
 
-def merge_db_chunks(args):
 
+def merge_chunk_dbs(chunk_dbs, db, indexes='default', threads=1,
+                    vacuum=False):
+    """
+    Merge the chunk databases, given in variant_id order, into a new
+    gemini database (db). The chunks are attached in batches and each
+    row is copied exactly once; the indices (see database.INDEX_LEVELS)
+    are built at the end, sorting with up to `threads` threads.
+    """
     # open up a new database
-    if os.path.exists(args.db):
-        os.remove(args.db)
+    if os.path.exists(db):
+        os.remove(db)
 
-    main_conn = sqlite3.connect(args.db)
+    main_conn = sqlite3.connect(db)
     main_conn.isolation_level = None
     main_conn.row_factory = sqlite3.Row
     main_curr = main_conn.cursor()
-    main_curr.execute('PRAGMA synchronous = OFF')
+    gemini_db.set_load_pragmas(main_curr, new_db=True)
     main_curr.execute('PRAGMA journal_mode=MEMORY')
     # create the gemini database tables for the new DB
     gemini_db.create_tables(main_curr)
+    create_sample_table(main_curr, chunk_dbs[0])
 
-    databases = []
-    for database in args.chunkdbs:
-        databases.append(database)
-
-    for idx, database in enumerate(databases):
-
-        db = database[0]
-
-        append_variant_info(main_curr, db)
+    for batch_start in xrange(0, len(chunk_dbs), MAX_ATTACHED):
+        batch = chunk_dbs[batch_start:batch_start + MAX_ATTACHED]
+        chunks = ["chunk" + str(idx) for idx in range(len(batch))]
+        for chunk_db, chunk in zip(batch, chunks):
+            main_curr.execute("ATTACH ? AS %s" % chunk, (chunk_db, ))
 
+        main_curr.execute("BEGIN TRANSACTION")
+        for chunk in chunks:
+            append_variant_info(main_curr, chunk)
         # we only need to add these tables from one of the chunks.
-        if idx == 0:
-            append_sample_genotype_counts(main_curr, db)
-            append_sample_info(main_curr, db)
-            append_resource_info(main_curr, db)
-            append_version_info(main_curr, db)
-        else:
-            update_sample_genotype_counts(main_curr, db)
-
-    gemini_db.create_indices(main_curr)
+        if batch_start == 0:
+            append_sample_info(main_curr, chunks[0])
+            append_resource_info(main_curr, chunks[0])
+            append_version_info(main_curr, chunks[0])
+        main_curr.execute("END TRANSACTION")
+
+        for chunk in chunks:
+            main_curr.execute("DETACH %s" % chunk)
+
+    # the genotype counts are summed across all of the chunks at once
+    sample_ids, totals = sum_sample_genotype_counts(chunk_dbs)
+    main_curr.execute("BEGIN TRANSACTION")
+    store_sample_genotype_counts(main_curr, sample_ids, totals)
+    main_curr.execute("END TRANSACTION")
+
+    gemini_db.create_indices(main_curr, indexes, threads)
     main_conn.commit()
+    if vacuum:
+        gemini_db.vacuum(main_curr)
     main_curr.close()
+    main_conn.close()
+
+
+def merge_db_chunks(args):
+    # --chunkdb may be given more than once, each with several DBs
+    chunk_dbs = [chunk_db for chunk_group in args.chunkdbs
+                 for chunk_db in chunk_group]
+    merge_chunk_dbs(chunk_dbs, args.db, args.indexes)
 
 
 def merge_chunks(parser, args):
@@ -2,14 +2,19 @@
 
 import os
 import sys
+import time
+import sqlite3
 from itertools import tee, ifilterfalse
 
 # gemini imports
 import GeminiQuery
+import query_plan
 from gemini_subjects import get_family_dict
 from gemini_constants import *
 from gemini_region import add_region_to_query
 from gemini_subjects import Subject
+from profiler import timed
+from sql_utils import get_select_cols_and_rest
 
 def all_samples_predicate(args):
     """ returns a predicate that returns True if, for a variant,
@@ -120,19 +125,108 @@ def modify_query(args):
     if args.region:
         add_region_to_query(args)
 
-def run_query(args):
-
-    predicates = get_predicates(args)
-    modify_query(args)
-    gq = GeminiQuery.GeminiQuery(args.db, out_format=args.format)
-    gq.run(args.query, args.gt_filter, args.show_variant_samples,
-           args.sample_delim, predicates, needs_genotypes(args))
+def write_rows(args, gq, predicates):
+    """
+    Run the query and write its rows.
+    """
+    if args.page_size is None:
+        gq.run(args.query, args.gt_filter, args.show_variant_samples,
+               args.sample_delim, predicates, needs_genotypes(args),
+               limit_after_filter=args.max_rows)
+    else:
+        try:
+            gq.run_page(args.query, args.gt_filter, args.page_size,
+                        args.page_token,
+                        show_variant_samples=args.show_variant_samples,
+                        variant_samples_delim=args.sample_delim,
+                        predicates=predicates,
+                        needs_genotypes=needs_genotypes(args),
+                        limit_after_filter=args.max_rows)
+        except GeminiQuery.PageError as e:
+            sys.exit("ERROR: " + str(e))
 
     if args.use_header and gq.header:
         print gq.header
 
+    format_row = timed(gq.profiler, "format rows", str)
+    write = timed(gq.profiler, "output", sys.stdout.write)
     for row in gq:
-        print row
+        write(format_row(row) + "\n")
+
+    if args.page_size is not None and gq.next_page_token is not None:
+        sys.stderr.write("next page token: %s\n" % gq.next_page_token)
+
+def run_query(args):
+
+    predicates = get_predicates(args)
+    modify_query(args)
+    profile = args.profile or args.profile_json is not None
+    start = time.time()
+    gq = GeminiQuery.GeminiQuery(args.db, out_format=args.format,
+                                 profile=profile)
+    if args.count:
+        print gq.count(args.query, args.gt_filter, predicates,
+                       needs_genotypes(args))
+    else:
+        write_rows(args, gq, predicates)
+
+    if profile:
+        sys.stdout.flush()
+        gq.profiler.elapsed = time.time() - start
+        gq.profiler.report()
+        if args.profile_json is not None:
+            gq.profiler.write_json(args.profile_json)
+
+def explain_query(args):
+    """
+    Show how SQLite will run the query and how many genotype BLOBs it
+    must decompress, and suggest (or build) indices for the columns
+    that it filters on.
+    """
+    modify_query(args)
+    gq = GeminiQuery.GeminiQuery(args.db, out_format=args.format)
+    query = gq.formatter.format_query(args.query)
+    out = sys.stdout
+    try:
+        plan = query_plan.get_query_plan(gq.c, query)
+    except sqlite3.OperationalError as e:
+        sys.exit("ERROR: the query cannot be explained: %s\n" % e)
+    query_plan.write_plan(plan, out)
+
+    selects_genotypes = any(col.lower().startswith("gt") for col in
+                            get_select_cols_and_rest(query)[0])
+    if queries_variants(query) and \
+            (args.gt_filter or selects_genotypes or needs_genotypes(args)):
+        query_plan.write_genotype_work(gq.c, query, plan,
+                                       len(gq.sample_to_idx),
+                                       args.gt_filter, out)
+    else:
+        out.write("genotype work: none, no genotype BLOBs are "
+                  "decompressed.\n")
+
+    suggestions = query_plan.suggest_indices(gq.c, query)
+    if not suggestions:
+        out.write("index advice: the columns that the query filters on "
+                  "are already indexed.\n")
+    for name, table, column in suggestions:
+        out.write("index advice: %s.%s is not indexed; consider "
+                  "\"create index %s on %s(%s)\"\n"
+                  % (table, column, name, table, column))
+
+    if suggestions and args.create_indexes:
+        dbs = gq.shard_dbs or [args.db]
+        for db in dbs:
+            conn = sqlite3.connect(db)
+            query_plan.create_suggested_indices(conn.cursor(), suggestions)
+            conn.commit()
+            conn.close()
+        out.write("created %s.\n"
+                  % ", ".join(name for name, table, column in suggestions))
+        # a new connection plans the query with the new indices
+        conn = sqlite3.connect(dbs[0])
+        query_plan.write_plan(query_plan.get_query_plan(conn.cursor(), query),
+                              out)
+        conn.close()
 
 def query(parser, args):
 
@@ -140,7 +234,10 @@ def query(parser, args):
         parser.print_help()
 
     if os.path.exists(args.db):
-        run_query(args)
+        if args.explain or args.create_indexes:
+            explain_query(args)
+        else:
+            run_query(args)
 
 def partition(pred, iterable):
     'Use a predicate to partition entries into false entries and true entries'
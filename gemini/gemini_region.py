@@ -5,10 +5,17 @@ import os
 import sys
 
 import GeminiQuery
+import binning
+import database
+import regions
+import shards
 
-def _report_results(args, query, gq):
+def _report_results(args, query, gq, bed_regions=None):
     # report the results of the region query
-    gq.run(query)
+    if bed_regions is None:
+        gq.run(query, args.gt_filter)
+    else:
+        gq.run_regions(query, bed_regions, args.gt_filter)
     if args.use_header and gq.header:
         print gq.header
 
@@ -16,20 +23,45 @@ def _report_results(args, query, gq):
         print row
 
 
-def get_region(args, gq):
+def _parse_region(region_string):
+    """
+    Return the chrom, start and end of a region string, e.g. chr1:10-20
+    """
     region_regex = re.compile("(\S+):(\d+)-(\d+)")
 
     try:
-        region = region_regex.findall(args.region)[0]
+        region = region_regex.findall(region_string)[0]
     except IndexError:
         sys.exit("Malformed region (--reg) string")
 
     if len(region) != 3:
         sys.exit("Malformed region (--reg) string")
 
-    chrom = region[0]
-    start = region[1]
-    end = region[2]
+    return region[0], int(region[1]), int(region[2])
+
+
+def get_region_clause(cursor, chrom, start, end):
+    """
+    Return a WHERE clause selecting the variants on chrom that overlap
+    start-end: those that start or end in it, and those that span it.
+
+    The variant_bins table narrows the search to the bins that can hold
+    such variants, so even long variants that start well before the
+    region are found with an index lookup.
+    """
+    overlaps = "start <= %d AND end >= %d" % (end, start)
+    if not database.has_index(cursor, 'varbin_chr_bin_idx'):
+        # a database made before variant_bins existed
+        return "chrom = '%s' AND %s" % (chrom, overlaps)
+    bins = binning.overlapping_bins(max(0, start - 1), end + 1)
+    return ("chrom = '{0}' AND variant_id IN "
+            "(SELECT variant_id FROM variant_bins WHERE chrom = '{0}' "
+            "AND bin IN ({1}) AND {2})"
+            .format(chrom, ",".join(str(b) for b in bins), overlaps))
+
+
+def get_region(args, gq):
+    chrom, start, end = _parse_region(args.region)
 
     if args.columns is not None:
         query = "SELECT " + str(args.columns) + \
@@ -37,9 +69,7 @@ def get_region(args, gq):
     else:
         query = "SELECT * FROM variants "
 
-    query += "WHERE chrom = " + "'" + chrom + "'" + \
-        " AND ((start BETWEEN " + start + " AND " + end + ")" +\
-        " OR (end BETWEEN " + start + " AND " + end + "))"
+    query += "WHERE " + get_region_clause(gq.c, chrom, start, end)
 
     if args.filter:
         query += " AND " + args.filter
@@ -50,6 +80,19 @@ def get_region(args, gq):
 
 
 
+def get_gene_clause(cursor, gene):
+    """
+    Return a WHERE clause selecting the variants that affect any
+    transcript of the gene, not only those whose most severe impact
+    (variants.gene) is on it, using the gene_variants table.
+    """
+    if not database.has_index(cursor, 'genevar_gene_idx'):
+        # a database made before gene_variants existed
+        return "gene = '%s'" % gene
+    return ("variant_id IN (SELECT variant_id FROM gene_variants "
+            "WHERE gene = '%s')" % gene)
+
+
 def get_gene(args, gq):
     """
     Report all variants in a specific gene.
@@ -60,7 +103,7 @@ def get_gene(args, gq):
     else:
         query = "SELECT * FROM variants "
 
-    query += "WHERE gene = " + "'" + args.gene + "' "
+    query += "WHERE " + get_gene_clause(gq.c, args.gene) + " "
 
     if args.filter:
         query += " AND " + args.filter
@@ -69,25 +112,36 @@ def get_gene(args, gq):
 
     _report_results(args, query, gq)
 
-def add_region_to_query(args):
-    region_regex = re.compile("(\S+):(\d+)-(\d+)")
+def get_bed(args, gq):
+    """
+    Report the variants in each of the regions of a BED file,
+    tagged with the names of the regions they overlap.
+    """
+    bed_regions = regions.read_bed(args.bed)
+    if not bed_regions:
+        sys.exit("ERROR: %s has no regions." % args.bed)
 
+    if args.columns is not None:
+        query = "SELECT " + str(args.columns) + \
+                    " FROM variants "
+    else:
+        query = "SELECT * FROM variants "
 
-    try:
-        region = region_regex.findall(args.region)[0]
-    except IndexError:
-        sys.exit("Malformed region (--reg) string")
+    if args.filter:
+        query += "WHERE " + args.filter
 
-    if len(region) != 3:
-        sys.exit("Malformed region (--reg) string")
+    _report_results(args, query, gq, bed_regions)
 
-    chrom = region[0]
-    start = region[1]
-    end = region[2]
+def add_region_to_query(args):
+    chrom, start, end = _parse_region(args.region)
 
-    where_clause = " chrom = " + "'" + chrom + "'" + \
-        " AND ((start BETWEEN " + start + " AND " + end + ")" +\
-        " OR (end BETWEEN " + start + " AND " + end + "))"
+    # the tables of a sharded database are those of its first shard
+    db = args.db
+    if shards.is_manifest(db):
+        db = shards.read_manifest(db)[0]['db']
+    conn = sqlite3.connect(db)
+    where_clause = get_region_clause(conn.cursor(), chrom, start, end)
+    conn.close()
 
     args.query = _add_to_where_clause(args.query, where_clause)
 
@@ -110,9 +164,13 @@ def region(parser, args):
 
         gq = GeminiQuery.GeminiQuery(args.db, out_format=args.format)
 
-        if args.region is not None and args.gene is not None:
-            sys.exit('EXITING: Choose either --reg or --gene, not both.\n')
+        chosen = [arg for arg in (args.region, args.gene, args.bed)
+                  if arg is not None]
+        if len(chosen) > 1:
+            sys.exit('EXITING: Choose one of --reg, --gene or --bed.\n')
         elif args.region is not None:
             get_region(args, gq)
         elif args.gene is not None:
             get_gene(args, gq)
+        elif args.bed is not None:
+            get_bed(args, gq)
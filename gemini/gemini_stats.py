@@ -10,6 +10,30 @@ from collections import Counter
 import gemini_utils as util
 from gemini_constants import *
 import GeminiQuery
+import shards
+
+
+def get_counts(c, args, query):
+    """
+    Return the rows of a count query (e.g., SELECT ref, alt, count(1)
+    ... GROUP BY ref, alt) as tuples, with the count last. For a sharded
+    database, the counts are summed across the shards.
+    """
+    if args.shard_dbs is not None:
+        return shards.sum_counts(args.shard_dbs, query)
+    c.execute(query)
+    return [tuple(row) for row in c]
+
+
+def get_rows(c, args, query):
+    """
+    Return the rows of a query, from each shard in turn
+    for a sharded database.
+    """
+    if args.shard_dbs is not None:
+        return shards.query_shards(args.shard_dbs, query)
+    c.execute(query)
+    return c
 
 
 def get_tstv(c, args):
@@ -25,11 +49,9 @@ def get_tstv(c, args):
           WHERE type = \'snp\' \
           AND   sub_type = \'tv\'"
     # get the number of transitions
-    c.execute(ts_cmd)
-    ts = c.fetchone()[0]
+    ts = get_counts(c, args, ts_cmd)[0][0]
     # get the number of transversions
-    c.execute(tv_cmd)
-    tv = c.fetchone()[0]
+    tv = get_counts(c, args, tv_cmd)[0][0]
     # report the transitions, transversions, and the ts/tv ratio
     print "ts" + '\t' + \
           "tv" + '\t' + "ts/tv"
@@ -53,12 +75,10 @@ def get_tstv_coding(c, args):
           AND v.sub_type = \'tv\' \
           AND v.is_coding = 1"
     # get the number of transitions
-    c.execute(ts_cmd)
-    ts = c.fetchone()[0]
+    ts = get_counts(c, args, ts_cmd)[0][0]
 
     # get the number of transversions
-    c.execute(tv_cmd)
-    tv = c.fetchone()[0]
+    tv = get_counts(c, args, tv_cmd)[0][0]
 
     # report the transitions, transversions, and the ts/tv ratio
     print "ts" + '\t' + \
@@ -83,12 +103,10 @@ def get_tstv_noncoding(c, args):
           AND v.sub_type = \'tv\' \
           AND v.is_coding = 0"
     # get the number of transitions
-    c.execute(ts_cmd)
-    ts = c.fetchone()[0]
+    ts = get_counts(c, args, ts_cmd)[0][0]
 
     # get the number of transversions
-    c.execute(tv_cmd)
-    tv = c.fetchone()[0]
+    tv = get_counts(c, args, tv_cmd)[0][0]
 
     # report the transitions, transversions, and the ts/tv ratio
     print "ts" + '\t' + \
@@ -117,11 +135,9 @@ def get_snpcounts(c, args):
              GROUP BY ref, alt"
 
     # get the ref and alt alleles for all snps.
-    c.execute(query)
     print '\t'.join(['type', 'count'])
-    for row in c:
-        print '\t'.join([str(row['ref']) + "->" + str(row['alt']),
-                         str(row['count(1)'])])
+    for ref, alt, count in get_counts(c, args, query):
+        print '\t'.join([str(ref) + "->" + str(alt), str(count)])
 
 
 def get_sfs(c, args):
@@ -133,9 +149,8 @@ def get_sfs(c, args):
              FROM variants \
              GROUP BY round(aaf," + str(precision) + ")"
 
-    c.execute(query)
     print '\t'.join(['aaf', 'count'])
-    for row in c:
+    for row in get_counts(c, args, query):
         print '\t'.join([str(row[0]), str(row[1])])
 
 
@@ -151,14 +166,13 @@ def get_mds(c, args):
     query = "SELECT DISTINCT v.variant_id, v.gt_types\
     FROM variants v\
     WHERE v.type = 'snp'"
-    c.execute(query)
 
     # keep a list of numeric genotype values
     # for each sample
     genotypes = collections.defaultdict(list)
-    for row in c:
+    for row in get_rows(c, args, query):
 
-        gt_types = np.array(cPickle.loads(zlib.decompress(row['gt_types'])))
+        gt_types = np.array(cPickle.loads(zlib.decompress(row[1])))
 
         # at this point, gt_types is a numpy array
         # idx:  0 1 2 3 4 5 6 .. #samples
@@ -274,7 +288,15 @@ def summarize_query_by_sample(args):
 def stats(parser, args):
 
     if os.path.exists(args.db):
-        conn = sqlite3.connect(args.db)
+        # a sharded database's samples and sample_genotype_counts
+        # tables are the same in every shard.
+        args.shard_dbs = None
+        db = args.db
+        if shards.is_manifest(args.db):
+            args.shard_dbs = [shard['db']
+                              for shard in shards.read_manifest(args.db)]
+            db = args.shard_dbs[0]
+        conn = sqlite3.connect(db)
         conn.isolation_level = None
         conn.row_factory = sqlite3.Row
         c = conn.cursor()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+"""
+    Parse the FORMAT/sample columns of a raw VCF line directly into
+    the numpy arrays that are stored as genotype BLOBs, rather than
+    building (and then discarding) a call object per sample.
+"""
+
+import re
+import numpy as np
+
+from gemini_constants import *
+
+# sample values that cyvcf treats as "no data"
+MISSING_VALUES = frozenset(['.', './.', '.|.', ''])
+
+# a '.' or empty value in a comma-separated list of numbers
+MISSING_NUMBER = re.compile(r'(?<![^,])\.?(?![^,])')
+
+# the value of each genotype array (gts, gt_types, gt_phases, gt_depths,
+# gt_ref_depths, gt_alt_depths and gt_quals) for a sample with no call
+MISSING_GENOTYPE = ('./.', UNKNOWN, False, -1, -1, -1, -1)
+
+
+def _to_number(val):
+    """
+    Convert a FORMAT value to an int (or a float if it isn't integral),
+    using -1 to indicate a missing value.
+    """
+    if val in MISSING_VALUES:
+        return -1
+    try:
+        return int(val)
+    except ValueError:
+        return float(val)
+
+
+def _fill_numbers(arr, values):
+    """
+    Fill the numeric array arr with the FORMAT values for each sample,
+    using -1 for missing values.  The values are converted in one call
+    to numpy, falling back to one-at-a-time conversion for anything
+    numpy cannot parse.
+    """
+    joined = MISSING_NUMBER.sub('-1', ','.join(values))
+    parsed = np.fromstring(joined, dtype=np.float64, sep=',')
+    if len(parsed) == len(values):
+        arr[:] = parsed
+    else:
+        arr[:] = [_to_number(val) for val in values]
+
+
+def spread(values, positions, num_samples, missing):
+    """
+    Return an array for num_samples samples holding values at the
+    given positions and the missing value everywhere else.
+    """
+    dtype = values.dtype
+    if dtype.kind == 'S':
+        dtype = np.promote_types(dtype, 'S%d' % len(missing))
+    spread_values = np.empty(num_samples, dtype)
+    spread_values.fill(missing)
+    spread_values[positions] = values
+    return spread_values
+
+
+class Genotypes(object):
+    """
+    The genotype arrays and genotype tallies for a single variant.
+    """
+    __slots__ = ['gt_bases', 'gt_types', 'gt_phases', 'gt_depths',
+                 'gt_ref_depths', 'gt_alt_depths', 'gt_quals',
+                 'num_hom_ref', 'num_het', 'num_hom_alt', 'num_unknown',
+                 'num_alts']
+
+    @property
+    def num_called(self):
+        return self.num_hom_ref + self.num_het + self.num_hom_alt
+
+    @property
+    def call_rate(self):
+        """
+        The fraction of genotypes that were actually called.
+        """
+        return float(self.num_called) / float(len(self.gt_types))
+
+    @property
+    def aaf(self):
+        """
+        The alternate allele frequency among the _called_ genotypes.
+        None for sites with more than one alternate allele.
+        """
+        if self.num_alts > 1:
+            return None
+        num_chroms = 2.0 * self.num_called
+        if num_chroms == 0.0:
+            return 0.0
+        return float(self.num_het + 2 * self.num_hom_alt) / num_chroms
+
+    @property
+    def nucl_diversity(self):
+        """
+        pi_hat (estimation of nucleotide diversity) for the site.
+        None for sites with more than one alternate allele.
+        """
+        if self.num_alts > 1:
+            return None
+        p = self.aaf
+        q = 1.0 - p
+        num_chroms = 2.0 * self.num_called
+        return float(num_chroms / (num_chroms - 1.0)) * (2.0 * p * q)
+
+    def spread(self, positions, num_samples):
+        """
+        Return the genotypes for num_samples samples, where the samples we
+        have genotypes for are at the given positions and the others have
+        no call (e.g., when the VCF holds a subset of a database's samples).
+        """
+        genotypes = Genotypes()
+        for attr, missing in zip(self.__slots__[:7], MISSING_GENOTYPE):
+            setattr(genotypes, attr,
+                    spread(getattr(self, attr), positions, num_samples,
+                           missing))
+        genotypes.num_hom_ref = self.num_hom_ref
+        genotypes.num_het = self.num_het
+        genotypes.num_hom_alt = self.num_hom_alt
+        genotypes.num_unknown = self.num_unknown + \
+            num_samples - len(positions)
+        genotypes.num_alts = self.num_alts
+        return genotypes
+
+
+class GenotypeParser(object):
+    """
+    Parse the raw sample columns of VCF records into typed numpy arrays.
+
+    The numeric arrays are allocated once and re-filled for every
+    variant, so the arrays returned by parse() are only valid until the
+    next call. The loader packs them into BLOBs straight away.
+    """
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+        self.gt_types = np.empty(num_samples, np.int8)
+        self.gt_phases = np.empty(num_samples, np.bool)
+        self.gt_depths = np.empty(num_samples, np.int32)
+        self.gt_ref_depths = np.empty(num_samples, np.int32)
+        self.gt_alt_depths = np.empty(num_samples, np.int32)
+        self.gt_quals = np.empty(num_samples, np.float32)
+        # FORMAT string -> positions of the keys we care about
+        self._format_cache = {}
+
+    def _get_key_positions(self, format):
+        """
+        Return the number of FORMAT keys and the position of the
+        GT, DP, AD, RO, AO and GQ keys (None for absent keys).
+        """
+        try:
+            return self._format_cache[format]
+        except KeyError:
+            keys = format.split(':') if format else []
+            pos = dict((key, idx) for idx, key in enumerate(keys))
+            positions = (len(keys), pos.get('GT'), pos.get('DP'),
+                         pos.get('AD'), pos.get('RO'), pos.get('AO'),
+                         pos.get('GQ'))
+            self._format_cache[format] = positions
+            return positions
+
+    def _decode_gt(self, gt, alleles):
+        """
+        Return the (bases, type, phased) tuple for a GT string,
+        e.g. '0|1' -> ('A|G', HET, True)
+        """
+        if gt in MISSING_VALUES:
+            return ('./.', UNKNOWN, False)
+        phased = '|' in gt
+        phase_char = '|' if phased else '/'
+        allele_nums = gt.split(phase_char)
+        bases = phase_char.join([alleles[int(a)] if a != '.' else '.'
+                                 for a in allele_nums])
+        if len(set(allele_nums)) == 1:
+            if allele_nums[0] == '0':
+                gt_type = HOM_REF
+            else:
+                gt_type = HOM_ALT
+        else:
+            gt_type = HET
+        return (bases, gt_type, phased)
+
+    def parse(self, format, samples, alleles):
+        """
+        Parse the tab-delimited sample columns of a VCF record
+        (e.g., '0/1:12,3:15:99\t0/0:20,0:20:99') according to the FORMAT
+        string and return a Genotypes object. alleles is the list of
+        REF followed by the ALT alleles.
+        """
+        (num_keys, gt_pos, dp_pos, ad_pos, ro_pos, ao_pos, gq_pos) = \
+            self._get_key_positions(format)
+        num_samples = self.num_samples
+
+        # in the common case every sample reports every FORMAT key,
+        # and each key's values are a simple stride through one list.
+        # a sample with a field too many or too few would shift every
+        # later sample's values, so each sample's layout is checked.
+        sample_cols = samples.split('\t') if samples else []
+        num_colons = num_keys - 1
+        if num_keys and len(sample_cols) == num_samples and \
+                all(col.count(':') == num_colons for col in sample_cols):
+            flat = samples.replace('\t', ':').split(':')
+
+            def column(pos):
+                return flat[pos::num_keys]
+        else:
+            split = [sample.split(':') for sample in sample_cols]
+            split += [['.']] * (num_samples - len(split))
+
+            def column(pos):
+                return [vals[pos] if pos < len(vals) else '.'
+                        for vals in split]
+
+        # GT: the handful of distinct genotype strings at a site
+        # are decoded once each.
+        if gt_pos is not None:
+            gts = column(gt_pos)
+            distinct = list(set(gts))
+            lookup = dict((gt, idx) for idx, gt in enumerate(distinct))
+            decoded = [self._decode_gt(gt, alleles) for gt in distinct]
+            which = np.array([lookup[gt] for gt in gts], np.intp)
+            gt_bases = np.array([d[0] for d in decoded], np.str)[which]
+            self.gt_types[:] = np.array([d[1] for d in decoded],
+                                        np.int8)[which]
+            self.gt_phases[:] = np.array([d[2] for d in decoded],
+                                         np.bool)[which]
+        else:
+            gt_bases = np.array(['./.'] * num_samples, np.str)
+            self.gt_types.fill(UNKNOWN)
+            self.gt_phases.fill(False)
+
+        # DP: the depth of aligned sequence for each sample
+        if dp_pos is not None:
+            _fill_numbers(self.gt_depths, column(dp_pos))
+        else:
+            self.gt_depths.fill(-1)
+
+        # AD (GATK) or RO/AO (FreeBayes) allele depths.
+        # like cyvcf, we require bi-allelic depths. an AD with a
+        # missing depth (e.g., '3,.') is treated as missing entirely.
+        self.gt_ref_depths.fill(-1)
+        self.gt_alt_depths.fill(-1)
+        if ad_pos is not None:
+            depths = [ad.split(',') for ad in column(ad_pos)]
+            depths = [d if len(d) == 2 and '.' not in d and '' not in d
+                      else ('.', '.') for d in depths]
+            _fill_numbers(self.gt_ref_depths, [d[0] for d in depths])
+            _fill_numbers(self.gt_alt_depths, [d[1] for d in depths])
+        else:
+            if ro_pos is not None:
+                _fill_numbers(self.gt_ref_depths, column(ro_pos))
+            if ao_pos is not None:
+                _fill_numbers(self.gt_alt_depths,
+                              [ao if ',' not in ao else '.'
+                               for ao in column(ao_pos)])
+
+        # GQ: the genotype quality
+        if gq_pos is not None:
+            _fill_numbers(self.gt_quals, column(gq_pos))
+        else:
+            self.gt_quals.fill(-1)
+
+        counts = np.bincount(self.gt_types, minlength=4)
+
+        genotypes = Genotypes()
+        genotypes.gt_bases = gt_bases
+        genotypes.gt_types = self.gt_types
+        genotypes.gt_phases = self.gt_phases
+        genotypes.gt_depths = self.gt_depths
+        genotypes.gt_ref_depths = self.gt_ref_depths
+        genotypes.gt_alt_depths = self.gt_alt_depths
+        genotypes.gt_quals = self.gt_quals
+        genotypes.num_hom_ref = int(counts[HOM_REF])
+        genotypes.num_het = int(counts[HET])
+        genotypes.num_hom_alt = int(counts[HOM_ALT])
+        genotypes.num_unknown = int(counts[UNKNOWN])
+        genotypes.num_alts = len(alleles) - 1
+        return genotypes
@@ -155,3 +155,64 @@ def get_allele_bal(var):
     or None if it isn't present in the VCF.
     """
     return _safe_single_attr(var.INFO.get('AB'))
+
+
+# The INFO-derived columns of the variants table, in table order.
+# Each entry is (column name, INFO key, whether list values should be
+# reduced to their first element by _safe_single_attr).
+INFO_COLUMNS = [('anc_allele', 'AA', True),
+                ('rms_bq', 'BQ', False),
+                ('cigar', 'CIGAR', False),
+                ('depth', 'DP', True),
+                ('strand_bias', 'SB', False),
+                ('rms_map_qual', 'MQ', False),
+                ('in_hom_run', 'HRun', False),
+                ('num_mapq_zero', 'MQ0', False),
+                ('num_alleles', 'AN', True),
+                ('num_reads_w_dels', 'Dels', False),
+                ('haplotype_score', 'HaplotypeScore', False),
+                ('qual_depth', 'QD', False),
+                ('allele_count', 'AC', True),
+                ('allele_bal', 'AB', True),
+                ('in_hm2', 'H2', False),
+                ('in_hm3', 'H3', False),
+                ('is_somatic', 'SOMATIC', False)]
+
+
+class InfoExtractor(object):
+    """
+    Extract all of the INFO-derived variants columns in a single
+    walk of a variant's INFO dictionary, rather than issuing one
+    lookup (and one function call) per column.
+
+    The lookup table is compiled once from the VCF header: numeric
+    keys the header declares as Number=1 are already unwrapped to a
+    scalar by the VCF parser and need no further cleanup.
+    """
+    def __init__(self, vcf_infos=None, columns=INFO_COLUMNS):
+        vcf_infos = vcf_infos or {}
+        self.columns = [col for (col, key, single) in columns]
+        self.num_columns = len(columns)
+        # INFO key -> (slot in the output row, needs _safe_single_attr)
+        self.slots = {}
+        for idx, (col, key, single) in enumerate(columns):
+            header = vcf_infos.get(key)
+            if single and header is not None and header.num == 1 \
+                    and header.type != 'String':
+                single = False
+            self.slots[key] = (idx, single)
+
+    def extract(self, var):
+        """
+        Return a list of the INFO-derived column values for var,
+        in the order of self.columns. Absent keys are None.
+        """
+        row = [None] * self.num_columns
+        slots = self.slots
+        for key, value in var.INFO.iteritems():
+            slot = slots.get(key)
+            if slot is not None:
+                if slot[1]:
+                    value = _safe_single_attr(value)
+                row[slot[0]] = value
+        return row
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+    Add up the wall time spent in each stage of a load (parsing the VCF,
+    each annotation track, interpreting impacts, packing the genotype
+    BLOBs, writing to SQLite, ...) or of a query, and report it as a
+    table or as JSON.
+
+    The functions that each variant (or row) passes through are wrapped
+    with timed() once, so that a load or query that isn't being profiled
+    calls them directly, with no overhead.
+"""
+
+import json
+import sys
+import time
+
+
+class StageProfiler(object):
+    """
+    The total time and number of calls of each stage of a load, along
+    with the number of variants loaded, the overall wall time and the
+    peak memory use.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.num_variants = 0
+        self.elapsed = 0.0
+        self.peak_memory_mb = 0.0
+        self.num_chunks = 1
+
+    def add(self, stage, seconds, calls=1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def timed(self, stage, func):
+        """
+        Return a version of func that adds the time of each call to stage.
+        """
+        def timed_func(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - start)
+        return timed_func
+
+    def to_dict(self):
+        return {'num_variants': self.num_variants,
+                'elapsed': self.elapsed,
+                'peak_memory_mb': self.peak_memory_mb,
+                'num_chunks': self.num_chunks,
+                'stages': dict((stage, {'seconds': self.seconds[stage],
+                                        'calls': self.calls[stage]})
+                               for stage in self.seconds)}
+
+    @classmethod
+    def from_dict(cls, profile):
+        profiler = cls()
+        profiler.num_variants = profile['num_variants']
+        profiler.elapsed = profile['elapsed']
+        profiler.peak_memory_mb = profile['peak_memory_mb']
+        profiler.num_chunks = profile['num_chunks']
+        for stage, totals in profile['stages'].items():
+            profiler.add(stage, totals['seconds'], totals['calls'])
+        return profiler
+
+    @classmethod
+    def combine(cls, profiles):
+        """
+        Add up the profiles (as dicts) of the chunks of a parallel load.
+        The stage times are summed across the chunks, the peak memory is
+        that of the largest chunk and the overall wall time is left for
+        the caller to set.
+        """
+        combined = cls()
+        combined.num_chunks = 0
+        for profile in profiles:
+            chunk = cls.from_dict(profile)
+            for stage in chunk.seconds:
+                combined.add(stage, chunk.seconds[stage], chunk.calls[stage])
+            combined.num_variants += chunk.num_variants
+            combined.peak_memory_mb = max(combined.peak_memory_mb,
+                                          chunk.peak_memory_mb)
+            combined.num_chunks += chunk.num_chunks
+        return combined
+
+    def summary(self):
+        rate = self.num_variants / self.elapsed if self.elapsed else 0.0
+        summary = ("load profile: %d variants in %.2f seconds "
+                   "(%.1f variants/sec), peak memory %.1f MB.\n"
+                   % (self.num_variants, self.elapsed, rate,
+                      self.peak_memory_mb))
+        if self.num_chunks > 1:
+            summary += ("stage times are summed across %d chunks.\n"
+                        % self.num_chunks)
+        return summary
+
+    def report(self, out=sys.stderr):
+        """
+        Write a table of the time spent in each stage, slowest first.
+        """
+        out.write(self.summary())
+        total = sum(self.seconds.values())
+        out.write("%-36s %10s %7s %12s %12s\n"
+                  % ("stage", "seconds", "%", "calls", "usec/call"))
+        for stage in sorted(self.seconds, key=self.seconds.get,
+                            reverse=True):
+            seconds = self.seconds[stage]
+            calls = self.calls[stage]
+            out.write("%-36s %10.2f %7.1f %12d %12.1f\n"
+                      % (stage, seconds,
+                         100.0 * seconds / total if total else 0.0,
+                         calls, 1e6 * seconds / calls if calls else 0.0))
+
+    def write_json(self, path):
+        with open(path, 'w') as handle:
+            json.dump(self.to_dict(), handle, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+            handle.write("\n")
+
+
+class QueryProfiler(StageProfiler):
+    """
+    The total time and number of calls of each stage of a query (the
+    SQLite cursor, decompressing each genotype column, the gt_filter,
+    ...), along with the number of rows that the query scanned and the
+    number that it returned.
+    """
+    def __init__(self):
+        super(QueryProfiler, self).__init__()
+        self.rows_scanned = 0
+        self.rows_emitted = 0
+
+    def to_dict(self):
+        return {'rows_scanned': self.rows_scanned,
+                'rows_emitted': self.rows_emitted,
+                'elapsed': self.elapsed,
+                'stages': dict((stage, {'seconds': self.seconds[stage],
+                                        'calls': self.calls[stage]})
+                               for stage in self.seconds)}
+
+    def summary(self):
+        return ("query profile: %d rows scanned and %d rows returned "
+                "in %.2f seconds.\n"
+                % (self.rows_scanned, self.rows_emitted, self.elapsed))
+
+
+def timed(profiler, stage, func):
+    """
+    Return func, timed under stage if we are profiling (i.e., profiler
+    is not None).
+    """
+    if profiler is None:
+        return func
+    return profiler.timed(stage, func)
+
+
+class TimedModule(object):
+    """
+    Stands in for a module, timing each of its functions under a stage
+    named after the function (e.g., 'annotation: dbsnp_info' for
+    annotations.get_dbsnp_info).
+    """
+    def __init__(self, profiler, module, prefix):
+        self._profiler = profiler
+        self._module = module
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        func = getattr(self._module, name)
+        stage = self._prefix + (name[4:] if name.startswith("get_") else name)
+        timed_func = self._profiler.timed(stage, func)
+        # look each function up only once
+        setattr(self, name, timed_func)
+        return timed_func
+
+
+def timed_module(profiler, module, prefix):
+    """
+    Return module, or a TimedModule for it if we are profiling.
+    """
+    if profiler is None:
+        return module
+    return TimedModule(profiler, module, prefix)
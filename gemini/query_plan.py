@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+    Explain how SQLite will run a gemini query: its query plan, the
+    number of rows whose genotype BLOBs must be decompressed for a
+    genotype filter, and the indices that would help its WHERE clause.
+"""
+
+import re
+import sqlite3
+
+import database
+from GeminiQuery import GENOTYPE_COLUMNS
+
+# the tables that queries filter on, and the prefix of their index names
+INDEXED_TABLES = [('variants', 'var'), ('variant_impacts', 'varimp'),
+                  ('samples', 'sample')]
+# the clauses that end a WHERE clause
+END_OF_WHERE = re.compile(r"\b(group\s+by|order\s+by|limit|having)\b",
+                          re.IGNORECASE)
+# a (possibly table-qualified) column name
+IDENTIFIER = re.compile(r"\b([A-Za-z_]\w*)(?:\.([A-Za-z_]\w*))?\b")
+# a step of a query plan that reads a table, e.g. "SCAN variants" or
+# "SEARCH TABLE variants AS v USING INDEX var_gene_idx (gene=?)"
+PLAN_STEP = re.compile(r"(SCAN|SEARCH)(?: TABLE)? (\w+)(?: AS (\w+))?")
+# the first column of an index that a SEARCH looks up by equality
+EQUALITY_SEARCH = re.compile(r"USING (?:COVERING )?INDEX (\w+) \((\w+)=\?")
+# the rows sampled to estimate the size of the genotype BLOBs
+BLOB_SAMPLE_SIZE = 1000
+
+
+def get_query_plan(cursor, query):
+    """
+    Return SQLite's EXPLAIN QUERY PLAN for the query, as a list of
+    (depth, detail) tuples.
+    """
+    cursor.execute("EXPLAIN QUERY PLAN " + query)
+    # rows are (id, parent, notused, detail), where the steps of a
+    # subquery have the id of the subquery step as their parent
+    depths = {0: -1}
+    plan = []
+    for row in cursor.fetchall():
+        depth = depths.get(row[1], -1) + 1
+        depths[row[0]] = depth
+        plan.append((depth, row[3]))
+    return plan
+
+
+def get_queried_tables(query):
+    """
+    Return a dict mapping the names (and aliases) of the indexed
+    tables used by the query to the table names.
+    """
+    tables = {}
+    for table, prefix in INDEXED_TABLES:
+        for match in re.finditer(r"\b%s\b(?:\s+(?:as\s+)?([A-Za-z_]\w*))?"
+                                 % table, query, re.IGNORECASE):
+            tables[table] = table
+            alias = match.group(1)
+            if alias and alias.lower() not in \
+                    ("where", "join", "inner", "left", "cross", "natural",
+                     "on", "using", "group", "order", "limit"):
+                tables[alias] = table
+    return tables
+
+
+def get_filter_columns(cursor, query):
+    """
+    Return the (table, column) pairs that the query's WHERE and
+    JOIN ... ON clauses filter on, in the order they appear.
+    """
+    lowered = query.lower()
+    from_loc = lowered.find(" from ")
+    if from_loc < 0:
+        return []
+    rest = query[from_loc:]
+    end = END_OF_WHERE.search(rest)
+    if end is not None:
+        rest = rest[:end.start()]
+    # ignore quoted strings, e.g. gene = 'SCNN1D'
+    rest = re.sub(r"'[^']*'|\"[^\"]*\"", " ", rest)
+
+    tables = get_queried_tables(query)
+    columns = {}
+    for table in set(tables.values()):
+        cursor.execute("PRAGMA table_info(%s)" % table)
+        columns[table] = [col[1] for col in cursor.fetchall()]
+
+    found = []
+    for match in IDENTIFIER.finditer(rest):
+        if match.group(2) is not None:
+            candidates = [tables.get(match.group(1))]
+            column = match.group(2)
+        else:
+            candidates = sorted(set(tables.values()))
+            column = match.group(1)
+        for table in candidates:
+            if table is not None and column in columns[table]:
+                if (table, column) not in found:
+                    found.append((table, column))
+                break
+    return found
+
+
+def get_indexed_columns(cursor, table):
+    """
+    Return the set of columns that lead an index of the table,
+    including its INTEGER PRIMARY KEY.
+    """
+    indexed = set()
+    cursor.execute("PRAGMA table_info(%s)" % table)
+    primary_key = [col for col in cursor.fetchall() if col[5]]
+    if len(primary_key) == 1 and primary_key[0][2].lower() == "integer":
+        indexed.add(primary_key[0][1])
+    cursor.execute("PRAGMA index_list(%s)" % table)
+    for index in cursor.fetchall():
+        cursor.execute("PRAGMA index_info(%s)" % index[1])
+        info = sorted(cursor.fetchall(), key=lambda col: col[0])
+        if info:
+            indexed.add(info[0][2])
+    return indexed
+
+
+def get_index_name(table, column):
+    """
+    Return the name of the index on table(column): the one that
+    `gemini load` would build, if any, or else a name in the same style.
+    """
+    columns = "%s(%s)" % (table, column)
+    for name, (index_columns, unique) in database.INDICES.items():
+        if index_columns == columns:
+            return name
+    prefix = dict(INDEXED_TABLES).get(table, table)
+    return "%s_%s_idx" % (prefix, column)
+
+
+def suggest_indices(cursor, query):
+    """
+    Return the (name, table, column) of an index for each column that
+    the query filters on but that doesn't lead an existing index.
+    """
+    suggestions = []
+    indexed = {}
+    for table, column in get_filter_columns(cursor, query):
+        if column in GENOTYPE_COLUMNS:
+            continue
+        if table not in indexed:
+            indexed[table] = get_indexed_columns(cursor, table)
+        if column not in indexed[table]:
+            suggestions.append((get_index_name(table, column),
+                                table, column))
+    return suggestions
+
+
+def create_suggested_indices(cursor, suggestions):
+    """
+    Build the suggested indices and ANALYZE each of them, so that the
+    query planner will use them.
+    """
+    cursor.execute("PRAGMA analysis_limit = %d" % database.ANALYSIS_LIMIT)
+    for name, table, column in suggestions:
+        if name in database.INDICES:
+            database.create_index(cursor, name)
+        else:
+            cursor.execute("create index if not exists %s on %s(%s)"
+                           % (name, table, column))
+        cursor.execute("ANALYZE %s" % name)
+
+
+def count_table_rows(cursor, table):
+    """
+    Return the number of rows in the table, as recorded by ANALYZE
+    if it has been run, or else by counting them.
+    """
+    try:
+        cursor.execute("select stat from sqlite_stat1 where tbl = ? "
+                       "order by idx is null", (table,))
+        row = cursor.fetchone()
+    except sqlite3.OperationalError:
+        # the database has never been analyzed
+        row = None
+    if row is not None and row[0]:
+        return int(row[0].split()[0])
+    cursor.execute("select count(*) from %s" % table)
+    return cursor.fetchone()[0]
+
+
+def estimate_variant_rows(cursor, query, plan):
+    """
+    Estimate how many rows of the variants table the plan visits: all of
+    them for a SCAN, or the average number of rows per value of the
+    index used (as recorded by ANALYZE) for a SEARCH by equality.
+    Returns the estimate and whether it is only an upper bound.
+    """
+    names = set(name for name, table in get_queried_tables(query).items()
+                if table == "variants")
+    num_rows = count_table_rows(cursor, "variants")
+    for depth, detail in plan:
+        step = PLAN_STEP.match(detail)
+        if step is None or not names.intersection(step.group(2, 3)):
+            continue
+        if step.group(1) == "SCAN":
+            return num_rows, False
+        search = EQUALITY_SEARCH.search(detail)
+        if search is not None:
+            cursor.execute("select stat from sqlite_stat1 where idx = ?",
+                           (search.group(1),))
+            row = cursor.fetchone()
+            if row is not None and len(row[0].split()) > 1:
+                return int(row[0].split()[1]), False
+        break
+    return num_rows, True
+
+
+def get_blob_bytes_per_row(cursor):
+    """
+    The average compressed size of the genotype BLOBs of a variant,
+    from a sample of the variants.
+    """
+    cursor.execute("select avg(%s) from (select * from variants limit %d)"
+                   % (" + ".join("ifnull(length(%s), 0)" % col
+                                 for col in GENOTYPE_COLUMNS),
+                      BLOB_SAMPLE_SIZE))
+    return cursor.fetchone()[0] or 0.0
+
+
+def write_plan(plan, out):
+    out.write("query plan:\n")
+    for depth, detail in plan:
+        out.write("    %s%s\n" % ("  " * depth, detail))
+
+
+def write_genotype_work(cursor, query, plan, num_samples, gt_filter, out):
+    """
+    Estimate the genotype BLOBs that must be decompressed to
+    answer a query that needs the genotypes.
+    """
+    num_rows, upper_bound = estimate_variant_rows(cursor, query, plan)
+    blob_mb = num_rows * get_blob_bytes_per_row(cursor) / (1024.0 * 1024.0)
+    out.write("genotype work: %s%d variants x %d genotype BLOBs x %d "
+              "samples (%.1f MB compressed) are decompressed.\n"
+              % ("at most " if upper_bound else "about ", num_rows,
+                 len(GENOTYPE_COLUMNS), num_samples, blob_mb))
+    if gt_filter:
+        out.write("the genotype filter is evaluated in Python for each of "
+                  "those variants;\nfilter on the variants table's "
+                  "columns (e.g., num_het, aaf) in the WHERE clause\n"
+                  "to reduce them.\n")
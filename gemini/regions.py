@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+    Answer a batch of regions (e.g., the targets of a gene panel, from a
+    BED file) with one query: the regions are sorted and merged, the bins
+    of the merged regions are looked up together in the variant_bins
+    index, and each resulting variant is tagged with the names of the
+    regions that it overlaps as the (sorted) rows are read back.
+"""
+
+import collections
+import sys
+
+import binning
+import database
+
+# a region of a BED file: 0-based, half-open
+Region = collections.namedtuple('Region', ['chrom', 'start', 'end', 'name'])
+# the temporary table of the bins of the merged regions
+REGION_BINS_TABLE = "temp.gemini_region_bins"
+
+
+def read_bed(bed_file):
+    """
+    Return the regions of a BED file. Regions without a name (in the
+    fourth column) are named after their coordinates, e.g. chr1:10-20.
+    """
+    regions = []
+    with open(bed_file) as bed:
+        for line_num, line in enumerate(bed, 1):
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            try:
+                chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                sys.exit("ERROR: line %d of %s is not a BED region: %s"
+                         % (line_num, bed_file, line.rstrip()))
+            if len(fields) > 3 and fields[3].strip():
+                name = fields[3].strip()
+            else:
+                name = "%s:%d-%d" % (chrom, start, end)
+            regions.append(Region(chrom, start, end, name))
+    return regions
+
+
+def merge_regions(regions):
+    """
+    Sort the regions and merge those that overlap (or abut), returning
+    a list of (chrom, start, end).
+    """
+    merged = []
+    for region in sorted(regions):
+        if merged and merged[-1][0] == region.chrom and \
+                region.start <= merged[-1][2]:
+            chrom, start, end = merged[-1]
+            merged[-1] = (chrom, start, max(end, region.end))
+        else:
+            merged.append((region.chrom, region.start, region.end))
+    return merged
+
+
+def get_regions_clause(cursor, regions):
+    """
+    Fill the temporary table of the bins of the merged regions and
+    return a WHERE clause selecting the variants that overlap any of
+    the regions.
+    """
+    merged = merge_regions(regions)
+    chroms = sorted(set(chrom for chrom, start, end in merged))
+    cursor.execute("drop table if exists %s" % REGION_BINS_TABLE)
+    cursor.execute("create table %s (chrom text, bin integer, "
+                   "start integer, end integer)" % REGION_BINS_TABLE)
+    if database.has_index(cursor, 'varbin_chr_bin_idx'):
+        cursor.executemany("insert into %s values (?, ?, ?, ?)"
+                           % REGION_BINS_TABLE,
+                           ((chrom, b, start, end)
+                            for chrom, start, end in merged
+                            for b in binning.overlapping_bins(start, end)))
+        # CROSS JOIN makes SQLite sweep the (sorted) bins of the regions,
+        # looking each up in the variant_bins index, rather than the
+        # reverse
+        overlapping = ("SELECT b.variant_id FROM %s AS r "
+                       "CROSS JOIN variant_bins AS b ON b.chrom = r.chrom "
+                       "AND b.bin = r.bin AND b.start < r.end "
+                       "AND b.end > r.start" % REGION_BINS_TABLE)
+    else:
+        # a database made before variant_bins existed
+        cursor.executemany("insert into %s values (?, 0, ?, ?)"
+                           % REGION_BINS_TABLE, merged)
+        overlapping = ("SELECT v.variant_id FROM %s AS r "
+                       "CROSS JOIN variants AS v ON v.chrom = r.chrom "
+                       "AND v.start < r.end AND v.end > r.start"
+                       % REGION_BINS_TABLE)
+    return ("chrom IN (%s) AND variant_id IN (%s)"
+            % (", ".join("'%s'" % chrom for chrom in chroms), overlapping))
+
+
+class RegionTagger(object):
+    """
+    Name the regions that each of a series of variants overlaps. The
+    variants of each chromosome must come in order of their start.
+    """
+    def __init__(self, regions):
+        self.regions = collections.defaultdict(list)
+        for region in sorted(regions, key=lambda r: (r.chrom, r.start)):
+            self.regions[region.chrom].append(region)
+        # for each chromosome, the next region to consider and those
+        # that may still overlap the coming variants
+        self.next_region = collections.defaultdict(int)
+        self.active = collections.defaultdict(list)
+
+    def names(self, chrom, start, end, delim=','):
+        regions = self.regions[chrom]
+        active = self.active[chrom]
+        idx = self.next_region[chrom]
+        while idx < len(regions) and regions[idx].start < end:
+            active.append(regions[idx])
+            idx += 1
+        self.next_region[chrom] = idx
+        # the variants come in order of start, so a region that ends
+        # before this one starts overlaps none of them
+        active[:] = [region for region in active if region.end > start]
+        return delim.join(region.name for region in active
+                          if region.start < end)
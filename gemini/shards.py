@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+"""
+    Support for sharded gemini databases.
+
+    A sharded database is a set of ordinary gemini databases (e.g., the
+    chunk databases of a parallel load) that each hold a contiguous
+    range of the variants, listed in order in a small JSON manifest.
+    A GeminiQuery given a manifest in place of a database runs the
+    query against each shard in its own process and merges the results.
+
+    Shards that hold a single chromosome (`gemini load --shard-by chrom`)
+    have it recorded in the manifest, and queries that are restricted to
+    certain chromosomes are only run against their shards.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import heapq
+import multiprocessing
+import traceback
+
+import database
+from gemini_merge_chunks import sum_sample_genotype_counts, \
+    store_sample_genotype_counts
+
+MANIFEST_VERSION = 1
+# rows are passed back from the shard processes in batches of this many
+ROW_BATCH_SIZE = 100
+# and at most this many batches are queued up for each shard
+MAX_QUEUED_BATCHES = 16
+
+
+class ShardQueryError(Exception):
+    """
+    A query failed in one of the shard processes.
+    """
+    pass
+
+
+def is_manifest(path):
+    """
+    Is path a shard manifest, rather than a gemini (SQLite) database?
+    """
+    with open(path, 'rb') as handle:
+        return handle.read(1) == '{'
+
+
+def write_manifest(path, shards):
+    """
+    Write a manifest for the shards (a list of dicts, each with
+    the path to the shard's database under 'db') to path.
+    Database paths are stored relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    entries = []
+    for shard in shards:
+        entry = dict(shard)
+        entry['db'] = os.path.relpath(os.path.abspath(shard['db']), base)
+        entries.append(entry)
+    with open(path, 'w') as handle:
+        json.dump({'gemini_manifest': MANIFEST_VERSION, 'shards': entries},
+                  handle, indent=2)
+        handle.write("\n")
+
+
+def read_manifest(path):
+    """
+    Return the list of shards in the manifest at path,
+    with the absolute path to each shard's database under 'db'.
+    """
+    with open(path) as handle:
+        try:
+            manifest = json.load(handle)
+        except ValueError:
+            raise ValueError("%s is not a valid shard manifest." % path)
+    if manifest.get('gemini_manifest') != MANIFEST_VERSION:
+        raise ValueError("%s is not a valid shard manifest." % path)
+    base = os.path.dirname(os.path.abspath(path))
+    shards = manifest['shards']
+    for shard in shards:
+        shard['db'] = os.path.join(base, shard['db'])
+        if not os.path.exists(shard['db']):
+            raise ValueError("shard %s listed in %s does not exist."
+                             % (shard['db'], path))
+    return shards
+
+
+def share_sample_genotype_counts(shard_dbs):
+    """
+    Replace the sample_genotype_counts in each shard with the totals
+    across all of the shards, so that any one shard can answer for the
+    whole set (as it does for the samples table).
+    """
+    sample_ids, totals = sum_sample_genotype_counts(shard_dbs)
+    for shard_db in shard_dbs:
+        conn = sqlite3.connect(shard_db)
+        conn.execute("DELETE FROM sample_genotype_counts")
+        store_sample_genotype_counts(conn, sample_ids, totals)
+        # the shard's own counts are gone, so it can't be reused
+        # if the load is resumed.
+        database.set_load_state(conn, {'shared_counts': True})
+        conn.commit()
+        conn.close()
+
+
+def queries_sharded_tables(query):
+    """
+    Only the variants table and the tables derived from it (variant_impacts,
+    variant_bins and gene_variants) differ between shards. Queries of the
+    other tables can be answered by any one shard.
+    """
+    return re.search(r'\b(variants|variant_impacts|variant_bins|'
+                     r'gene_variants)\b', query, re.I) is not None
+
+
+def _mask_nested(query):
+    """
+    Blank out quoted strings and parenthesized expressions in query,
+    leaving only its top level (and each character in place).
+    """
+    masked = []
+    depth = 0
+    quote = None
+    for char in query:
+        if quote is not None:
+            if char == quote:
+                quote = None
+            masked.append(' ')
+        elif char in "'\"":
+            quote = char
+            masked.append(' ')
+        elif char == '(':
+            depth += 1
+            masked.append(' ')
+        elif char == ')':
+            depth -= 1
+            masked.append(' ')
+        else:
+            masked.append(char if depth == 0 else ' ')
+    return ''.join(masked)
+
+
+CHROM_EQUALS = re.compile(r"^(?:\w+\.)?chrom\s*=\s*'([^']*)'$", re.I)
+CHROM_IN = re.compile(r"^(?:\w+\.)?chrom\s+in\s*"
+                      r"\(\s*('[^']*'(?:\s*,\s*'[^']*')*)\s*\)$", re.I)
+
+
+def get_chroms(query):
+    """
+    Return the set of chromosomes that a query is restricted to by a
+    `chrom = '...'` or `chrom IN (...)` condition at the top level of
+    its WHERE clause, or None if it is not restricted.
+    """
+    masked = _mask_nested(query)
+    where = re.search(r'\bwhere\b', masked, re.I)
+    if where is None:
+        return None
+    end = re.search(r'\b(group\s+by|order\s+by|limit)\b',
+                    masked[where.end():], re.I)
+    end = len(masked) if end is None else where.end() + end.start()
+    clause = masked[where.end():end]
+    # with a top-level OR, no one condition restricts the whole query
+    if re.search(r'\bor\b', clause, re.I):
+        return None
+
+    # split the clause into its (top-level) AND-ed conditions
+    spans = []
+    pos = 0
+    for match in re.finditer(r'\band\b', clause, re.I):
+        spans.append((pos, match.start()))
+        pos = match.end()
+    spans.append((pos, len(clause)))
+
+    chroms = None
+    text = query[where.end():end]
+    for start, stop in spans:
+        condition = text[start:stop].strip()
+        match = CHROM_EQUALS.match(condition)
+        if match is not None:
+            found = set([match.group(1)])
+        else:
+            match = CHROM_IN.match(condition)
+            if match is None:
+                continue
+            found = set(re.findall(r"'([^']*)'", match.group(1)))
+        chroms = found if chroms is None else chroms & found
+    return chroms
+
+
+def select_shards(shards, query):
+    """
+    Return the databases of the shards that a query needs to be run
+    against: for chromosome shards, only those holding the chromosomes
+    the query is restricted to (but always at least one, so that the
+    query still yields a header).
+    """
+    chroms = get_chroms(query)
+    if chroms is None or not all('chrom' in shard for shard in shards):
+        return [shard['db'] for shard in shards]
+    selected = [shard['db'] for shard in shards if shard['chrom'] in chroms]
+    return selected or [shards[0]['db']]
+
+
+def _query_rows(task):
+    shard_db, query = task
+    conn = sqlite3.connect(shard_db)
+    # BLOBs come back as buffers, which can't be pickled
+    rows = [tuple(str(val) if isinstance(val, buffer) else val
+                  for val in row)
+            for row in conn.execute(query)]
+    conn.close()
+    return rows
+
+
+def query_shards(shard_dbs, query, processes=None):
+    """
+    Run a plain SQL query against each shard with a pool of processes,
+    yielding the resulting rows (as tuples) shard by shard.
+    """
+    processes = min(processes or multiprocessing.cpu_count(), len(shard_dbs))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for rows in pool.imap(_query_rows,
+                              [(shard_db, query) for shard_db in shard_dbs]):
+            for row in rows:
+                yield row
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def sum_counts(shard_dbs, query, processes=None):
+    """
+    Run a query whose last column is a count (e.g., SELECT ref, alt,
+    count(1) FROM variants GROUP BY ref, alt) against each shard and
+    return its rows with the counts summed across the shards, ordered
+    by the grouping columns.
+    """
+    totals = {}
+    for row in query_shards(shard_dbs, query, processes):
+        totals[row[:-1]] = totals.get(row[:-1], 0) + row[-1]
+    return [group + (totals[group], ) for group in sorted(totals)]
+
+
+def get_order_by(query):
+    """
+    Return the (column, descending) pairs of the query's ORDER BY
+    clause if it is a simple list of columns, else None.
+    """
+    match = re.search(r'\border\s+by\s+(.+?)(\s+limit\s+.*)?$', query,
+                      re.I | re.S)
+    if match is None:
+        return None
+    order_by = []
+    for term in match.group(1).split(','):
+        tokens = term.split()
+        if len(tokens) == 0 or len(tokens) > 2 or \
+                not re.match(r'^[\w.]+$', tokens[0]):
+            return None
+        descending = len(tokens) == 2 and tokens[1].lower() == "desc"
+        # the results are keyed by column name, without the table alias
+        order_by.append((tokens[0].split('.')[-1], descending))
+    return order_by
+
+
+def get_limit(query):
+    """
+    Return the row limit of the query (or None).
+    """
+    match = re.search(r'\blimit\s+(\d+)\s*$', query, re.I)
+    if match is not None:
+        return int(match.group(1))
+    if re.search(r'\blimit\b', query, re.I):
+        raise ShardQueryError("only LIMIT N (without an OFFSET) is "
+                              "supported when querying a sharded database")
+    return None
+
+
+class _Descending(object):
+    """
+    Invert the sort order of a value in a merge key.
+    """
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _query_shard(shard_db, queue, task):
+    """
+    Run a query against one shard with GeminiQuery, passing the
+    header and then batches of the resulting rows back on queue.
+    """
+    from GeminiQuery import GeminiQuery
+    try:
+        gq = GeminiQuery(shard_db, include_gt_cols=task['include_gt_cols'],
+                         out_format=task['out_format'])
+        gq.run(*task['run_args'])
+        queue.put(gq.header)
+        batch = []
+        for row in gq:
+            batch.append(row)
+            if len(batch) >= ROW_BATCH_SIZE:
+                queue.put(batch)
+                batch = []
+        if batch:
+            queue.put(batch)
+        queue.put(None)
+    except BaseException:
+        queue.put(ShardQueryError("query of shard %s failed:\n%s"
+                                  % (shard_db, traceback.format_exc())))
+
+
+class ShardedResults(object):
+    """
+    Iterate over the results of a query run against each shard in a
+    separate process.
+
+    By default, the results are reported shard by shard, in the order of
+    the manifest, which is variant_id order for an unordered query. At
+    most `processes` shards are queried at once. If order_by is given,
+    all of the shards are queried at once and their (already sorted)
+    results are merged.
+    """
+    def __init__(self, shard_dbs, task, order_by=None, limit=None,
+                 processes=None):
+        self.shard_dbs = shard_dbs
+        self.task = task
+        self.order_by = order_by
+        self.limit = limit
+        self.processes = processes or multiprocessing.cpu_count()
+        self.queues = [None] * len(shard_dbs)
+        self.procs = [None] * len(shard_dbs)
+        # the header from each shard (None for json output)
+        self.headers = {}
+        self.num_returned = 0
+        if order_by is not None:
+            for idx in range(len(shard_dbs)):
+                self._start(idx)
+            self.rows = self._merge_shards()
+        else:
+            self.rows = self._chain_shards()
+
+    def _start(self, idx):
+        if idx >= len(self.shard_dbs) or self.procs[idx] is not None:
+            return
+        self.queues[idx] = multiprocessing.Queue(MAX_QUEUED_BATCHES)
+        self.procs[idx] = multiprocessing.Process(
+            target=_query_shard,
+            args=(self.shard_dbs[idx], self.queues[idx], self.task))
+        self.procs[idx].daemon = True
+        self.procs[idx].start()
+
+    def _get(self, idx):
+        item = self.queues[idx].get()
+        if isinstance(item, ShardQueryError):
+            self.close()
+            raise item
+        return item
+
+    def _get_header(self, idx):
+        if idx not in self.headers:
+            self._start(idx)
+            self.headers[idx] = self._get(idx)
+        return self.headers[idx]
+
+    def _iter_shard(self, idx):
+        self._get_header(idx)
+        while True:
+            batch = self._get(idx)
+            if batch is None:
+                break
+            for row in batch:
+                yield row
+        self.procs[idx].join()
+
+    def _chain_shards(self):
+        for idx in range(len(self.shard_dbs)):
+            # keep the next few shards running while we read this one
+            for ahead in range(idx, idx + self.processes):
+                self._start(ahead)
+            for row in self._iter_shard(idx):
+                yield row
+
+    def _merge_shards(self):
+        def keyed(idx):
+            for seq, row in enumerate(self._iter_shard(idx)):
+                try:
+                    key = tuple(_Descending(row[col]) if descending
+                                else row[col]
+                                for col, descending in self.order_by)
+                except KeyError:
+                    self.close()
+                    raise ShardQueryError("the ORDER BY columns must be "
+                                          "selected when querying a "
+                                          "sharded database")
+                yield (key, idx, seq, row)
+        merged = heapq.merge(*[keyed(idx)
+                               for idx in range(len(self.shard_dbs))])
+        for key, idx, seq, row in merged:
+            yield row
+
+    @property
+    def header(self):
+        return self._get_header(0)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.limit is not None and self.num_returned >= self.limit:
+            self.close()
+            raise StopIteration
+        row = self.rows.next()
+        self.num_returned += 1
+        return row
+
+    def close(self):
+        """
+        Stop any shard processes that are still running.
+        """
+        for proc in self.procs:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
@@ -79,6 +79,9 @@ bash test-auto-dom.sh
 bash test-auto-rec.sh
 bash test-de-novo.sh
 
+# Test the benchmark tool
+bash test-benchmark.sh
+
 # cleanup
 rm ./*.db
 rm ./file.dot
@@ -6,9 +6,11 @@ gemini load -v test.clinvar.vcf test.clinvar.db
 gemini load -v test4.vep.snpeff.vcf -t snpEff test4.snpeff.db
 gemini load -v test4.vep.snpeff.vcf -t VEP test4.vep.db
 gemini load -v test5.vep.snpeff.vcf -t snpEff test5.snpeff.db
+gemini load -v test5.vep.snpeff.vcf -t snpEff --shard-by chrom test5.snpeff.sharded.db
 gemini load -v test5.vep.snpeff.vcf -t VEP test5.vep.db
 gemini load -v test.query.vcf -t snpEff test.query.db
 gemini load -v test.region.vep.vcf -t VEP test.region.db
+gemini load -v test.region.vep.vcf -t VEP --shard-by chrom test.region.sharded.db
 gemini load -v test.burden.vcf -t VEP -p test.burden.ped test.burden.db
 gemini load -v test.auto_dom.vcf -t snpEff -p test.auto_dom.ped test.auto_dom.db
 gemini load -v test.auto_rec.vcf -t snpEff -p test.auto_rec.ped test.auto_rec.db
@@ -0,0 +1,35 @@
+####################################################################
+# 1. Test that a benchmark run adds its timings to the history
+####################################################################
+echo "    benchmark.t01...\c"
+echo "1 50 6 load,query True" > exp
+gemini benchmark -n 50 -m 6 --steps load,query --dir benchmark \
+    --history benchmark.json > /dev/null 2> /dev/null
+python -c "
+import json
+runs = json.load(open('benchmark.json'))['runs']
+settings = runs[0]['settings']
+timings = runs[0]['timings']
+print len(runs), settings['num_variants'], settings['num_samples'], \
+    ','.join(sorted(timings)), \
+    all(seconds is not None for seconds in timings.values())
+" > obs
+check obs exp
+rm obs exp
+
+####################################################################
+# 2. Test that a later run reuses the database left in --dir
+####################################################################
+echo "    benchmark.t02...\c"
+echo "2 query_gt_filter True" > exp
+gemini benchmark -n 50 -m 6 --steps query_gt_filter --dir benchmark \
+    --history benchmark.json > /dev/null 2> /dev/null
+python -c "
+import json
+runs = json.load(open('benchmark.json'))['runs']
+timings = runs[-1]['timings']
+print len(runs), ','.join(sorted(timings)), \
+    all(seconds is not None for seconds in timings.values())
+" > obs
+check obs exp
+rm -r obs exp benchmark benchmark.json
@@ -218,3 +218,117 @@ gemini query -q "select chrom, end, ref, alt, \
 check obs exp
 #rm obs exp
 
+
+####################################################################
+# 9. Test the chunked genotype matrices of GeminiQuery.genotype_matrix()
+####################################################################
+echo "    genotypes.t09...\c"
+echo "[300, 300, 279]
+('chrom', 'start') (300, 2) int8 int32 object
+(600, 60) (279, 60)
+True
+ERROR: 1000G.snippet.db has no genotypes (was it loaded with --no-genotypes?)." > exp
+python -c "
+from gemini.GeminiQuery import GeminiQuery
+query = 'select chrom, start from variants'
+gq = GeminiQuery('test.query.db')
+samples = ['1094PC0012', '1094PC0005']
+chunks = list(gq.genotype_matrix(query, ('gt_types', 'gt_depths', 'gts'),
+                                 samples, chunk_variants=300))
+print [len(meta) for meta, genotypes in chunks]
+meta, genotypes = chunks[0]
+print meta.dtype.names, genotypes['gt_types'].shape, \
+    genotypes['gt_types'].dtype, genotypes['gt_depths'].dtype, \
+    genotypes['gts'].dtype
+print ' '.join(str(genotypes['gt_types'].shape) for meta, genotypes in
+               gq.genotype_matrix(query, ('gt_types', ), chunk_variants=600))
+# each row holds the genotypes of the samples, in the order given
+idxs = [gq.sample_to_idx[sample] for sample in samples]
+gq.run(query, needs_genotypes=True)
+rows = list(gq)
+print all([row['chrom'], row['start']] == list(meta[i]) and
+          list(row.gt_types[idxs]) == list(genotypes['gt_types'][i]) and
+          list(row.gt_depths[idxs]) == list(genotypes['gt_depths'][i]) and
+          list(row.gts[idxs]) == list(genotypes['gts'][i])
+          for row, (meta, genotypes, i) in
+          zip(rows, [(meta, genotypes, i) for meta, genotypes in chunks
+                     for i in range(len(meta))]))
+" > obs
+python -c "
+from gemini.GeminiQuery import GeminiQuery
+gq = GeminiQuery('1000G.snippet.db')
+list(gq.genotype_matrix('select chrom, start from variants'))
+" 2>> obs
+check obs exp
+rm obs exp
+
+####################################################################
+# 10. Test that GenotypeParser reads the sample columns as cyvcf does,
+#     including missing calls, multi-allelic and partly missing AD,
+#     reordered FORMAT keys, dropped trailing fields, samples with
+#     too many fields and haploid calls
+####################################################################
+echo "    genotypes.t10...\c"
+echo "test.parse.vcf 10 True
+test.query.vcf 879 True
+test4.vep.snpeff.vcf 9 True
+test.family.vcf 7 True" > exp
+python -c "
+import cyvcf
+import numpy as np
+from gemini.genotypes import GenotypeParser
+# the arrays that the loader used to build from cyvcf's calls
+dtypes = [('gt_bases', np.str), ('gt_types', np.int8),
+          ('gt_phases', np.bool), ('gt_depths', np.int32),
+          ('gt_ref_depths', np.int32), ('gt_alt_depths', np.int32),
+          ('gt_quals', np.float32)]
+counts = ['num_hom_ref', 'num_het', 'num_hom_alt', 'num_unknown']
+for vcf in ['test.parse.vcf', 'test.query.vcf',
+            'test4.vep.snpeff.vcf', 'test.family.vcf']:
+    reader = cyvcf.Reader(open(vcf))
+    parser = GenotypeParser(len(reader.samples))
+    lines = [line for line in open(vcf) if not line.startswith('#')]
+    same = True
+    for line, var in zip(lines, reader):
+        fields = line.rstrip('\n').split('\t', 9)
+        genotypes = parser.parse(fields[8], fields[9], var.alleles)
+        # cyvcf reports e.g. an AD of '3,.' as 3 and None, which the
+        # loader could not store: both depths are missing instead.
+        partial = [ref is None or alt is None for ref, alt
+                   in zip(var.gt_ref_depths, var.gt_alt_depths)]
+        for attr, dtype in dtypes:
+            values = getattr(var, attr)
+            if attr in ('gt_ref_depths', 'gt_alt_depths'):
+                values = [-1 if missing else value
+                          for value, missing in zip(values, partial)]
+            expected = np.array(values, dtype)
+            same &= np.array_equal(getattr(genotypes, attr), expected)
+        for attr in counts:
+            same &= getattr(genotypes, attr) == getattr(var, attr)
+    print vcf, len(lines), same
+" > obs
+check obs exp
+rm obs exp
+
+####################################################################
+# 11. Test that every chunk of GeminiQuery.genotype_matrix() has the
+#     same column dtypes, whether or not it holds NULLs
+####################################################################
+echo "    genotypes.t11...\c"
+echo "test.query.db 1 879 122 int64 object float64 object
+test.region.sharded.db 1 9 1 int64 object float64 object" > exp
+python -c "
+import numpy
+from gemini.GeminiQuery import GeminiQuery
+query = 'select start, chrom, num_reads_w_dels, depth from variants'
+for db in ['test.query.db', 'test.region.sharded.db']:
+    gq = GeminiQuery(db)
+    metas = [meta for meta, genotypes
+             in gq.genotype_matrix(query, ('gt_types',), chunk_variants=2)]
+    meta = numpy.concatenate(metas)
+    print db, len(set(m.dtype for m in metas)), len(meta), \
+        numpy.isnan(meta['num_reads_w_dels']).sum(), \
+        ' '.join(str(meta.dtype[name]) for name in meta.dtype.names)
+" > obs
+check obs exp
+rm obs exp
@@ -59,3 +59,188 @@ echo "sample_id	family_id	name	paternal_id	maternal_id	sex	phenotype	ethnicity	h
 gemini query --header -q "select * from samples" extended_ped_test.db > obs
 check obs exp
 rm obs exp
+
+###########################################################################################
+#4. Test resuming a load that already finished
+###########################################################################################
+gemini load -v ALL.wgs.phase1_release_v3.20101123.snps_indels_sv.sites.snippet.vcf \
+	        --no-genotypes --resume 1000G.snippet.db > obs
+echo "    load.t4...\c"
+echo "1000G.snippet.db is already completely loaded." > exp
+check obs exp
+rm obs exp
+
+###########################################################################################
+#5. Test appending a VCF with new samples to an existing database
+###########################################################################################
+gemini load -v test4.vep.snpeff.vcf append_test.db
+gemini load -v test.query.vcf --append append_test.db
+echo "    load.t5...\c"
+echo "sample	num_hom_ref	num_het	num_hom_alt	num_unknown	total
+M10475	3	1	2	882	888
+M10478	2	2	4	880	888
+M10500	2	2	4	880	888
+M128215	4	1	3	880	888
+1094PC0005	489	41	100	258	888" > exp
+gemini stats --gts-by-sample append_test.db | head -6 > obs
+check obs exp
+rm obs exp append_test.db
+
+###########################################################################################
+#6. Test writing a load profile
+###########################################################################################
+gemini load -v ALL.wgs.phase1_release_v3.20101123.snps_indels_sv.sites.snippet.vcf \
+	        --no-genotypes --profile-json profile.json profile_test.db 2> /dev/null
+echo "    load.t6...\c"
+echo '  "num_variants": 41,' > exp
+grep '"num_variants"' profile.json > obs
+check obs exp
+rm obs exp profile.json profile_test.db
+
+###########################################################################################
+#7. Test that a parallel load matches a single-core load
+###########################################################################################
+gemini load -v test.query.vcf -t snpEff --cores 2 test.query.cores.db
+echo "    load.t7...\c"
+gemini query -q "select * from variants" test.query.db > exp
+gemini query -q "select variant_id, gts, gt_depths from variants" test.query.db >> exp
+gemini stats --gts-by-sample test.query.db >> exp
+gemini query -q "select * from variants" test.query.cores.db > obs
+gemini query -q "select variant_id, gts, gt_depths from variants" test.query.cores.db >> obs
+gemini stats --gts-by-sample test.query.cores.db >> obs
+check obs exp
+rm obs exp test.query.cores.db
+
+###########################################################################################
+#8. Test a parallel load of a bgzipped VCF cut into more chunks than cores
+###########################################################################################
+bgzip -c test.query.vcf > test.query.vcf.gz
+gemini load -v test.query.vcf.gz -t snpEff --cores 2 --chunk-mb 0.05 \
+    test.query.chunks.db | grep "^Breaking" > obs
+echo "    load.t8...\c"
+echo "Breaking test.query.vcf.gz into 7 chunks." > exp
+gemini query -q "select * from variants" test.query.db >> exp
+gemini query -q "select variant_id, gts, gt_depths from variants" test.query.db >> exp
+gemini stats --gts-by-sample test.query.db >> exp
+gemini query -q "select * from variants" test.query.chunks.db >> obs
+gemini query -q "select variant_id, gts, gt_depths from variants" test.query.chunks.db >> obs
+gemini stats --gts-by-sample test.query.chunks.db >> obs
+check obs exp
+rm obs exp test.query.vcf.gz test.query.chunks.db
+
+###########################################################################################
+#9. Test loading with the minimal and the full set of indices
+###########################################################################################
+gemini load -v test.query.vcf -t snpEff --indexes minimal test.query.minimal.db
+gemini load -v test.query.vcf -t snpEff --indexes all test.query.all.db
+echo "    load.t9...\c"
+echo "genevar_gene_idx
+sample_name_idx
+var_chr_start_idx
+var_gene_idx
+varbin_chr_bin_idx
+genevar_gene_idx
+sample_name_idx
+var_aaf_idx
+var_chr_start_idx
+var_coding_idx
+var_depth_idx
+var_exonic_idx
+var_gene_idx
+var_gt_counts_idx
+var_in_call_rate_idx
+var_in_dbsnp_idx
+var_lof_idx
+var_type_idx
+varbin_chr_bin_idx
+varimp_coding_idx
+varimp_exonic_idx
+varimp_impact_idx
+varimp_lof_idx" > exp
+gemini query -q "select name from sqlite_master where type = 'index' \
+                 and name not like 'sqlite_%' order by name" test.query.minimal.db > obs
+gemini query -q "select name from sqlite_master where type = 'index' \
+                 and name not like 'sqlite_%' order by name" test.query.all.db >> obs
+for db in test.query.db test.query.minimal.db test.query.all.db; do
+    gemini query -q "select * from variants where chrom = 'chr1' and start > 1000000" $db > $db.txt
+    gemini query -q "select * from variants where gene = 'AGRN' and aaf > 0.1" $db >> $db.txt
+    gemini query -q "select variant_id, anno_id, gene, impact from variant_impacts \
+                     where is_exonic = 1 order by variant_id, anno_id" $db >> $db.txt
+done
+cat test.query.db.txt test.query.db.txt >> exp
+cat test.query.minimal.db.txt test.query.all.db.txt >> obs
+check obs exp
+rm obs exp test.query.*db.txt test.query.minimal.db test.query.all.db
+
+###########################################################################################
+#10. Test that vacuuming a loaded database leaves its contents unchanged
+###########################################################################################
+gemini load -v test.query.vcf -t snpEff --vacuum test.query.vacuum.db
+gemini load -v test.query.vcf -t snpEff --cores 2 --vacuum test.query.cores.vacuum.db
+echo "    load.t10...\c"
+for db in test.query.db test.query.vacuum.db test.query.cores.vacuum.db; do
+    gemini query -q "select * from variants" $db > $db.txt
+    gemini query -q "select variant_id, gts, gt_depths from variants" $db >> $db.txt
+    gemini query -q "select * from variant_impacts" $db >> $db.txt
+    gemini stats --gts-by-sample $db >> $db.txt
+done
+cat test.query.db.txt test.query.db.txt > exp
+cat test.query.vacuum.db.txt test.query.cores.vacuum.db.txt > obs
+check obs exp
+rm obs exp test.query.*db.txt test.query.vacuum.db test.query.cores.vacuum.db
+
+###########################################################################################
+#11. Test that the INFO-derived columns match those of the per-column get_* helpers
+###########################################################################################
+echo "    load.t11...\c"
+echo "test.parse.vcf 10 True
+test.query.vcf 879 True
+test4.vep.snpeff.vcf 9 True
+ALL.wgs.phase1_release_v3.20101123.snps_indels_sv.sites.snippet.vcf 41 True" > exp
+python -c "
+import cyvcf
+from gemini import infotag
+# the per-column helpers that the loader used to call
+getters = [infotag.get_ancestral_allele, infotag.get_rms_bq,
+           infotag.get_cigar, infotag.get_depth, infotag.get_strand_bias,
+           infotag.get_rms_map_qual, infotag.get_homopol_run,
+           infotag.get_map_qual_zero, infotag.get_num_of_alleles,
+           infotag.get_frac_dels, infotag.get_haplotype_score,
+           infotag.get_quality_by_depth, infotag.get_allele_count,
+           infotag.get_allele_bal, infotag.in_hm2, infotag.in_hm3,
+           infotag.is_somatic]
+for vcf in ['test.parse.vcf', 'test.query.vcf', 'test4.vep.snpeff.vcf',
+            'ALL.wgs.phase1_release_v3.20101123.snps_indels_sv.sites.snippet.vcf']:
+    reader = cyvcf.Reader(open(vcf))
+    extractor = infotag.InfoExtractor(reader.infos)
+    num_variants, same = 0, True
+    for var in reader:
+        num_variants += 1
+        same &= extractor.extract(var) == [get(var) for get in getters]
+    print vcf, num_variants, same
+" > obs
+check obs exp
+rm obs exp
+
+###########################################################################################
+#12. Test that a load with a tiny --max-buffer-mb flushes often and loads the same rows
+###########################################################################################
+gemini load -v test.query.vcf -t snpEff --max-buffer-mb 0.01 \
+    --profile-json profile.json test.query.buffer.db 2> /dev/null
+echo "    load.t12...\c"
+echo "True" > exp
+python -c "
+import json
+# a default load writes these variants in a single flush
+print json.load(open('profile.json'))['stages']['database writes']['calls'] > 100
+" > obs
+for db in test.query.db test.query.buffer.db; do
+    gemini query -q "select * from variants" $db > $db.txt
+    gemini query -q "select variant_id, gts, gt_depths from variants" $db >> $db.txt
+    gemini query -q "select * from variant_impacts" $db >> $db.txt
+    gemini stats --gts-by-sample $db >> $db.txt
+done
+cat test.query.db.txt >> exp
+cat test.query.buffer.db.txt >> obs
+check obs exp
+rm obs exp profile.json test.query.*db.txt test.query.buffer.db
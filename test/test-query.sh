@@ -487,3 +487,186 @@ echo "G/G,G/G,G/G,G/A	0,0,0,1" > exp
 gemini query  --in only all --sample-filter "phenotype=1 and hair_color='blue'" -q "select gts, gt_types from variants" extended_ped.db > obs
 check obs exp
 rm obs exp
+
+########################################################################
+# 29. Test that a profiled query counts the rows scanned and returned
+########################################################################
+echo "    query.t29...\c"
+echo "chr10	48003991
+  \"rows_emitted\": 1,
+  \"rows_scanned\": 7," > exp
+gemini query --profile-json profile.json -q "select chrom, start from variants" \
+             --gt-filter "gt_types.1_kid == HOM_ALT" test.family.db 2> /dev/null > obs
+grep '"rows_' profile.json >> obs
+check obs exp
+rm obs exp profile.json
+
+########################################################################
+# 30. Test that --explain suggests an index for an unindexed column
+########################################################################
+echo "    query.t30...\c"
+echo "index advice: variant_impacts.impact_severity is not indexed; consider \"create index varimp_impact_severity_idx on variant_impacts(impact_severity)\"" > exp
+gemini query --explain -q "select gene from variant_impacts where impact_severity = 'HIGH'" \
+             test.query.db | grep "index advice" > obs
+check obs exp
+rm obs exp
+
+########################################################################
+# 31. Test that --page-token resumes a paged query after the last page
+########################################################################
+echo "    query.t31...\c"
+echo "chr1	865218	G	A
+chr1	866937	G	A" > exp
+gemini query -q "select chrom, start, ref, alt from variants order by chrom, start" \
+             --gt-filter "gt_types.1094PC0012 == HET" --page-size 2 \
+             test.query.db 2> page1 > /dev/null
+gemini query -q "select chrom, start, ref, alt from variants order by chrom, start" \
+             --gt-filter "gt_types.1094PC0012 == HET" --page-size 2 \
+             --page-token `sed 's/next page token: //' page1` \
+             test.query.db 2> /dev/null > obs
+check obs exp
+rm obs exp page1
+
+########################################################################
+# 32. Test that --max-rows stops once enough rows pass the --gt-filter
+########################################################################
+echo "    query.t32...\c"
+echo "chr1	30866
+chr1	69510
+chr1	865218
+  \"rows_emitted\": 3,
+  \"rows_scanned\": 17," > exp
+gemini query --profile-json profile.json -q "select chrom, start from variants" \
+             --gt-filter "gt_types.1094PC0012 == HET" --max-rows 3 \
+             test.query.db 2> /dev/null > obs
+grep '"rows_' profile.json >> obs
+check obs exp
+rm obs exp profile.json
+
+########################################################################
+# 33. Test that --count counts the rows that pass the --gt-filter
+########################################################################
+echo "    query.t33...\c"
+echo "61" > exp
+gemini query -q "select chrom, start from variants" \
+             --gt-filter "gt_types.1094PC0012 == HET" --count \
+             test.query.db > obs
+check obs exp
+rm obs exp
+
+########################################################################
+# 34. Test --count of LIMIT and DISTINCT queries of a sharded database
+########################################################################
+echo "    query.t34...\c"
+echo "3
+2" > exp
+gemini query -q "select chrom, start from variants limit 3" --count \
+             test.region.sharded.db > obs
+gemini query -q "select distinct chrom from variants" --count \
+             test.region.sharded.db >> obs
+check obs exp
+rm obs exp
+
+########################################################################
+# 35. Test that a bad page token or page size is reported as an error,
+#     by the query tool and by the browser's /query_json
+########################################################################
+echo "    query.t35...\c"
+echo "ERROR: invalid page token.
+400 Bad Request
+{\"error\": \"invalid page token.\"}
+400 Bad Request
+{\"error\": \"page_size must be a positive integer.\"}" > exp
+gemini query -q "select chrom, start from variants" --page-size 2 \
+             --page-token bogus test.query.db 2> obs > /dev/null
+python -c "
+from gemini import gemini_browser
+gemini_browser.database = 'test.query.db'
+def start_response(status, headers):
+    print status
+for params in ('page_size=2&page_token=bogus', 'page_size=x'):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/query_json',
+               'QUERY_STRING': 'query=select+chrom+from+variants&' + params}
+    print ''.join(gemini_browser.app(environ, start_response))
+" >> obs
+check obs exp
+rm obs exp
+
+########################################################################
+# 36. Test that GeminiQuery.run_many() returns the rows of each query,
+#     as running them one at a time does
+########################################################################
+echo "    query.t36...\c"
+echo "122 True
+375 True
+61 True
+325 True
+[61, 325] True" > exp
+python -c "
+import StringIO
+from gemini.GeminiQuery import GeminiQuery
+queries = [(\"select chrom, start from variants where type = 'indel'\", None),
+           ('select chrom, start, gts.1094PC0012 from variants '
+            'where aaf > 0.1', None),
+           ('select chrom, start, ref from variants',
+            'gt_types.1094PC0012 == HET'),
+           ('select chrom, end from variants where start > 100000',
+            'gt_types.1094PC0012 != HOM_REF')]
+gq = GeminiQuery('test.query.db')
+many = [[] for query in queries]
+for idx, row in gq.run_many(queries):
+    many[idx].append(str(row))
+for (query, gt_filter), rows in zip(queries, many):
+    gq.run(query, gt_filter)
+    print len(rows), sorted(rows) == sorted(str(row) for row in gq)
+outputs = [StringIO.StringIO(), StringIO.StringIO()]
+print gq.run_many(queries[2:], outputs), \
+    [output.getvalue().splitlines() for output in outputs] == many[2:]
+" > obs
+check obs exp
+rm obs exp
+
+########################################################################
+# 37. Test that ordered queries of a --no-merge database return the
+#     rows of the merged database, in the same order
+########################################################################
+gemini load -v test.query.vcf -t snpEff --cores 2 --no-merge \
+    test.query.nomerge.db > /dev/null
+echo "    query.t37...\c"
+gemini query -q "select chrom, start, end, ref, alt, gene from variants \
+                 order by chrom, start" test.query.db > exp
+gemini query -q "select variant_id, chrom, start, gts from variants \
+                 order by variant_id" test.query.db >> exp
+gemini query -q "select chrom, start, end, ref, alt, gene from variants \
+                 order by chrom, start" test.query.nomerge.db > obs
+gemini query -q "select variant_id, chrom, start, gts from variants \
+                 order by variant_id" test.query.nomerge.db >> obs
+check obs exp
+rm obs exp test.query.nomerge.db test.query.nomerge.shard*.db
+
+########################################################################
+# 38. Test that a page that ends at the last row has no next page
+#     token, while a page before it does
+########################################################################
+echo "    query.t38...\c"
+echo "61
+0
+60
+1
+1
+0" > exp
+gemini query -q "select chrom, start from variants" \
+             --gt-filter "gt_types.1094PC0012 == HET" --page-size 61 \
+             test.query.db 2> page1 | wc -l | tr -d ' ' > obs
+grep -c "next page token" page1 >> obs
+gemini query -q "select chrom, start from variants" \
+             --gt-filter "gt_types.1094PC0012 == HET" --page-size 60 \
+             test.query.db 2> page1 | wc -l | tr -d ' ' >> obs
+grep -c "next page token" page1 >> obs
+gemini query -q "select chrom, start from variants" \
+             --gt-filter "gt_types.1094PC0012 == HET" --page-size 60 \
+             --page-token `sed 's/next page token: //' page1` \
+             test.query.db 2> page2 | wc -l | tr -d ' ' >> obs
+grep -c "next page token" page2 >> obs
+check obs exp
+rm obs exp page1 page2
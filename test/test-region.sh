@@ -52,3 +52,56 @@ echo "{\"chrom\": \"chr16\", \"start\": 72057281, \"end\": 72057282, \"ref\": \"
 gemini region --format json --gene DHODH --columns "chrom, start, end, ref, alt, gene" --filter "alt='G'" test.region.db > obs
 check obs exp
 rm obs exp
+
+#######################################################################################
+# 6. Test gemini region (--reg) on a database sharded by chromosome
+#######################################################################################
+echo "    region.t06...\c"
+echo "chr1	10000	10001	T	TC	DDX11L1
+chr1	10055	10056	A	C	DDX11L1" > exp
+
+gemini region --reg chr1:10000-10100 --columns "chrom, start, end, ref, alt, gene"  test.region.sharded.db > obs
+
+check obs exp
+rm obs exp
+
+#######################################################################################
+# 7. Test gemini region (--reg) finds a deletion that spans the whole region
+#######################################################################################
+echo "    region.t07...\c"
+echo "chr1	875158	875177	AGCCAGTGGACGCCGACCT	A" > exp
+
+gemini region --reg chr1:875165-875170 --columns "chrom, start, end, ref, alt" test.query.db > obs
+
+check obs exp
+rm obs exp
+
+#######################################################################################
+# 8. Test gemini region (--bed) tags each variant with the regions it overlaps
+#######################################################################################
+echo "    region.t08...\c"
+printf "chr1\t30800\t30900\tWASH7P\nchr1\t30860\t30870\nchr1\t69400\t69500\tOR4F5\n" > test.panel.bed
+echo "chr1	30859	30860	G	C	WASH7P
+chr1	30866	30869	CCT	C	WASH7P,chr1:30860-30870
+chr1	30894	30895	T	C	WASH7P
+chr1	69427	69428	T	G	OR4F5" > exp
+
+gemini region --bed test.panel.bed --columns "chrom, start, end, ref, alt" test.query.db > obs
+
+check obs exp
+rm obs exp test.panel.bed
+
+#######################################################################################
+# 9. Test gemini region (--gene) finds variants affecting any transcript of the gene
+#######################################################################################
+echo "    region.t09...\c"
+echo "chr1	30547	30548	FAM138A
+chr1	30859	30860	FAM138A
+chr1	30866	30869	FAM138A
+chr1	30894	30895	FAM138A
+chr1	30922	30923	FAM138A" > exp
+
+gemini region --gene MIR1302-10 --columns "chrom, start, end, gene" test.query.db > obs
+
+check obs exp
+rm obs exp
@@ -125,3 +125,17 @@ M10500	6	1	5" > exp
 gemini stats --summarize "select * from variants" test5.snpeff.db > obs
 check obs exp
 rm obs exp
+
+###################################################################
+# 10. Test site freq. spectrum on a database sharded by chromosome
+###################################################################
+echo "    stat.t10...\c"
+echo "aaf	count
+0.125	2
+0.375	1
+0.5	2
+1.0	4" > exp
+gemini stats --sfs test5.snpeff.sharded.db \
+       > obs
+check obs exp
+rm obs exp